@@ -0,0 +1,135 @@
+import importlib
+import json
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.dateparse import parse_duration
+from django.utils.text import slugify
+
+# keys of an export section that are timedeltas, written in the file as ISO 8601 durations like "PT4H"
+DURATION_KEYS = ('slice', 'tail_context')
+
+# keys of a section that name a function, written as "module:attribute", e.g. "upload.models:cell7validation"
+HOOK_KEYS = ('postprocess', 'validation', 'post_upload')
+
+UPLOAD_KEYS = ('ip', 'columns', 'tagnames', 'max_input')
+
+
+class Cell:
+    """
+    One cell from the registry. export is its cellconfig entry for the exporter (see export.models.Exporter), upload
+    is its PLC settings for the uploader, either is None if the cell doesn't do that.
+    """
+
+    def __init__(self, name, slug, common_name, export=None, upload=None):
+        self.name = name
+        self.slug = slug
+        self.common_name = common_name
+        self.export = export
+        self.upload = upload
+
+    def link(self, app):
+        return f"/{app}/{self.slug}"
+
+
+class CellRegistry:
+    """
+    Every cell the site knows about, read once from the cells file (settings.CELL_REGISTRY) and shared by the export
+    and upload apps. Cells are looked up by name or by the slug used in their URLs. Adding a cell is an edit to the
+    file, code is only needed for a new postprocess or validation function.
+    """
+
+    def __init__(self, cells):
+        """
+        :param cells: dict of cell name to its entry from the cells file
+        """
+        self.cells = {}
+        self.slugs = {}
+        for name, entry in cells.items():
+            cell = load_cell(name, entry)
+            if cell.slug in self.slugs:
+                raise ImproperlyConfigured(f"Cells {self.slugs[cell.slug]} and {name} both have the slug {cell.slug}")
+            self.cells[name] = cell
+            self.slugs[cell.slug] = name
+        # the exporter looks configs up by name on every export, keep the dict rather than building it each time
+        self.export_configs = {name: cell.export for name, cell in self.cells.items() if cell.export is not None}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def get(self, name):
+        """
+        :param name: cell name or slug
+        :return: the Cell, None if there isn't one
+        """
+        if name in self.cells:
+            return self.cells[name]
+        return self.cells.get(self.slugs.get(name))
+
+    def exportable(self):
+        return [cell for cell in self.cells.values() if cell.export is not None]
+
+    def uploadable(self):
+        return [cell for cell in self.cells.values() if cell.upload is not None]
+
+
+def load_cell(name, entry) -> Cell:
+    """
+    Builds a Cell from its entry in the cells file, turning durations into timedeltas, lists into tuples and hook
+    names into the functions.
+    """
+    export = entry.get('export')
+    if export is not None:
+        export = {key: tuple(value) if isinstance(value, list) else value for key, value in export.items()}
+        if 'fields' in export:
+            export['fields'] = {measurement: tuple(fields) for measurement, fields in export['fields'].items()}
+        for key in DURATION_KEYS:
+            if key in export:
+                duration = parse_duration(export[key])
+                if duration is None:
+                    raise ImproperlyConfigured(f"{name} {key} has to be an ISO 8601 duration like PT4H")
+                export[key] = duration
+        if 'database' not in export or 'measurements' not in export:
+            raise ImproperlyConfigured(f"{name} export needs a database and measurements")
+
+    upload = entry.get('upload')
+    if upload is not None:
+        missing = [key for key in UPLOAD_KEYS if key not in upload]
+        if missing:
+            raise ImproperlyConfigured(f"{name} upload is missing {', '.join(missing)}")
+        upload = {key: tuple(value) if isinstance(value, list) else value for key, value in upload.items()}
+        if len(upload['columns']) != len(upload['tagnames']):
+            raise ImproperlyConfigured(f"{name} upload needs a tag name for each column")
+
+    for section in (export, upload):
+        for key in HOOK_KEYS:
+            if section is not None and key in section:
+                section[key] = resolve(section[key])
+
+    return Cell(name, entry.get('slug') or slugify(name), entry.get('common_name', name), export, upload)
+
+
+def resolve(path):
+    """
+    :param path: "module:attribute", the attribute can be dotted to reach into a class
+    :return: the object
+    """
+    module, _, attributes = path.partition(':')
+    try:
+        value = importlib.import_module(module)
+        for attribute in attributes.split('.'):
+            value = getattr(value, attribute)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured(f"Can't find {path} from the cells file: {e}")
+    return value
+
+
+@lru_cache(maxsize=None)
+def get_registry() -> CellRegistry:
+    """
+    :return: the process wide CellRegistry loaded from settings.CELL_REGISTRY
+    """
+    return CellRegistry.from_file(settings.CELL_REGISTRY)
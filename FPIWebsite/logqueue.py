@@ -0,0 +1,233 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.config
+import queue
+import sys
+import threading
+import time
+
+import requests
+
+
+class BatchingQueueHandler(logging.Handler):
+    """
+    Logging handler that only puts the record on a bounded in-memory queue, so logging never waits on a file or on
+    Loki. A BatchingQueueListener thread started with the handler takes records off in batches and hands them to the
+    real handlers, named in `handlers`, which are configured like any other handler in settings.LOGGING. When the
+    queue is full the overflow policy decides which record is lost: 'drop_new' drops the one being logged,
+    'drop_oldest' makes room by dropping the oldest one waiting. Either way the listener logs how many were dropped.
+    Whatever is still queued is written out when the process exits. In settings.LOGGING `handlers` are names,
+    dict_config swaps them for the handler objects.
+    """
+
+    def __init__(self, handlers, capacity=10000, overflow='drop_oldest', batch_size=200, flush_interval=1.0,
+                 level=logging.NOTSET):
+        """
+        :param handlers: handlers the records go to
+        :param capacity: most records waiting at once
+        :param overflow: 'drop_oldest' or 'drop_new'
+        :param batch_size: most records handed on at once
+        :param flush_interval: seconds the listener waits for a batch to fill up
+        """
+        super().__init__(level)
+        if overflow not in ('drop_oldest', 'drop_new'):
+            raise ValueError(f"overflow has to be drop_oldest or drop_new, not {overflow}")
+        self.queue = queue.Queue(capacity)
+        self.overflow = overflow
+        self.dropped = 0
+        self.listener = BatchingQueueListener(self, handlers, batch_size, flush_interval)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        """
+        Copies the record with the traceback already rendered, so the listener thread doesn't depend on anything the
+        request changes afterwards. The message and its args are left alone, the loki handler reads args as labels.
+        """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == 'drop_oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()  # or flush() would wait for it forever
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(record)
+                except queue.Full:
+                    pass  # filled up again in between, this one's lost instead
+            self.dropped += 1  # no lock, losing a count in a burst of drops doesn't matter
+
+    def flush(self):
+        """
+        Waits until everything queued so far has been handed on.
+        """
+        if self.listener.is_alive():
+            self.queue.join()
+
+    def close(self):
+        self.listener.stop()
+        super().close()
+
+
+class BatchingQueueListener(threading.Thread):
+    """
+    Thread that moves records from a BatchingQueueHandler's queue to the real handlers a batch at a time. A handler
+    with an emit_batch method gets the whole batch in one call (one request to Loki), the rest get the records one by
+    one and are flushed once per batch.
+    """
+
+    STOP = object()
+
+    def __init__(self, source, handlers, batch_size, flush_interval):
+        super().__init__(name='log-listener', daemon=True)
+        self.source = source
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    def run(self):
+        records_queue = self.source.queue
+        while True:
+            batch = [records_queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not self.STOP:
+                try:
+                    batch.append(records_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is self.STOP
+            records = batch[:-1] if stopping else list(batch)
+            if self.source.dropped:
+                dropped, self.source.dropped = self.source.dropped, 0
+                records.insert(0, logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Log queue was full, dropped {dropped} records",
+                }))
+            self.handle(records)
+            for _ in batch:
+                records_queue.task_done()
+            if stopping:
+                return
+
+    def handle(self, records):
+        if not records:
+            return
+        for handler in self.handlers:
+            try:
+                if hasattr(handler, 'emit_batch'):
+                    handler.emit_batch([record for record in records if record.levelno >= handler.level and
+                                        handler.filter(record)])
+                else:
+                    for record in records:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+                    handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+
+    def stop(self, timeout=10):
+        """
+        Hands on whatever is still queued and stops the thread.
+        """
+        if self.is_alive():
+            self.source.queue.put(self.STOP)  # blocking, the stop marker must not be dropped
+            self.join(timeout)
+
+
+class LogConfigurator(logging.config.DictConfigurator):
+    """
+    dictConfig that gives a BatchingQueueHandler the handler objects its 'handlers' names, like 3.12 does for
+    QueueHandler. A handler that isn't built yet defers the queue handler the same way a MemoryHandler's target does.
+    """
+
+    def configure_handler(self, config):
+        if 'class' in config and issubclass(self.resolve(config['class']), BatchingQueueHandler):
+            names = list(config.get('handlers', []))
+            try:
+                handlers = [self.config['handlers'][name] for name in names]
+                if not all(isinstance(handler, logging.Handler) for handler in handlers):
+                    raise TypeError('target not configured yet')  # what dictConfig looks for to try it again later
+            except Exception as e:
+                raise ValueError(f"Unable to set the handlers {names}") from e
+            config['handlers'] = handlers
+        return super().configure_handler(config)
+
+
+def dict_config(config):
+    """
+    logging.config.dictConfig with LogConfigurator, settings.LOGGING_CONFIG
+    """
+    LogConfigurator(config).configure()
+
+
+class LokiBatchHandler(logging.Handler):
+    """
+    Pushes log records to Loki, a whole batch from BatchingQueueListener in one request. Labels are the job, the
+    level, the logger and the dict the views pass as the log call's args (action, cellname, ip). If Loki is down the
+    batch is dropped with a note on stderr, logging doesn't retry or block anything.
+    """
+
+    def __init__(self, url, job, timeout=5, level=logging.NOTSET):
+        """
+        :param url: Loki's push endpoint, e.g. http://host:3100/api/prom/push
+        :param job: job label
+        :param timeout: seconds a push can take
+        """
+        super().__init__(level)
+        self.url = url
+        self.job = job
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def labels(self, record) -> str:
+        labels = {'job': self.job, 'level': record.levelname.lower(), 'logger': record.name}
+        if isinstance(record.args, dict):
+            labels.update({str(key): str(value) for key, value in record.args.items()})
+        return '{' + ','.join(f'{key}={json.dumps(value)}' for key, value in sorted(labels.items())) + '}'
+
+    def line(self, record) -> str:
+        line = record.msg if isinstance(record.args, dict) else record.getMessage()  # dict args are labels
+        line = str(line)
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+    def payload(self, records) -> dict:
+        streams = {}
+        for record in records:
+            ts = datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat()
+            streams.setdefault(self.labels(record), []).append({'ts': ts, 'line': self.line(record)})
+        return {'streams': [{'labels': labels, 'entries': entries} for labels, entries in streams.items()]}
+
+    def emit_batch(self, records):
+        if not records:
+            return
+        try:
+            response = self.session.post(self.url, json=self.payload(records), timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Couldn't push {len(records)} log records to Loki: {e}", file=sys.stderr)
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def close(self):
+        self.session.close()
+        super().close()
@@ -0,0 +1,227 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# upper bounds of the histogram buckets in seconds, from a quick PLC read up to a month long export
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# cell the current request or export is for, spans without their own cell use it
+current_cell = contextvars.ContextVar('current_cell', default='')
+
+# per stage seconds of the current request for the Server-Timing header, None outside of a request
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+class Histogram:
+    """
+    Prometheus style histogram, a count per bucket plus the sum and count of everything observed.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Timings of every stage of exports and uploads, per cell: how long influx queries, parsing influx's response,
+    post processing, writing the file and PLC reads and writes take, along with how many rows and bytes went through
+    each. Plus how long each view takes. Kept in memory per process and read out in the Prometheus text format at
+    /metrics, so with several server processes each one is scraped separately.
+    """
+
+    def __init__(self):
+        self.stages = {}  # (cell, stage) -> Histogram
+        self.rows = {}  # (cell, stage) -> rows
+        self.bytes = {}  # (cell, stage) -> bytes
+        self.requests = {}  # (view, method, status) -> Histogram
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, cell=None, rows=None, size=None):
+        """
+        Records one run of a stage.
+        :param stage: name of the stage, e.g. 'query'
+        :param seconds: how long it took
+        :param cell: cell it was for, defaults to the current cell
+        :param rows: rows it handled, if that means anything for the stage
+        :param size: bytes it handled
+        """
+        key = (cell if cell is not None else current_cell.get(), stage)
+        timings = current_timings.get()
+        with self.lock:
+            if key not in self.stages:
+                self.stages[key] = Histogram()
+            self.stages[key].observe(seconds)
+            if rows is not None:
+                self.rows[key] = self.rows.get(key, 0) + rows
+            if size is not None:
+                self.bytes[key] = self.bytes.get(key, 0) + size
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0) + seconds  # threads of one request add to the same dict
+
+    def observe_request(self, view, method, status, seconds):
+        key = (view, method, str(status))
+        with self.lock:
+            if key not in self.requests:
+                self.requests[key] = Histogram()
+            self.requests[key].observe(seconds)
+
+    def render(self) -> str:
+        """
+        :return: everything in the Prometheus text exposition format
+        """
+        with self.lock:
+            lines = ['# HELP fpi_stage_seconds Time spent in each stage of exports and uploads',
+                     '# TYPE fpi_stage_seconds histogram']
+            for (cell, stage), histogram in sorted(self.stages.items()):
+                lines += histogram_lines('fpi_stage_seconds', {'cell': cell, 'stage': stage}, histogram)
+            for name, values, text in (('fpi_stage_rows_total', self.rows, 'Rows handled by each stage'),
+                                       ('fpi_stage_bytes_total', self.bytes, 'Bytes handled by each stage')):
+                lines += [f'# HELP {name} {text}', f'# TYPE {name} counter']
+                lines += [f'{name}{labels({"cell": cell, "stage": stage})} {value}'
+                          for (cell, stage), value in sorted(values.items())]
+            lines += ['# HELP fpi_request_seconds Time taken by each view',
+                      '# TYPE fpi_request_seconds histogram']
+            for (view, method, status), histogram in sorted(self.requests.items()):
+                lines += histogram_lines('fpi_request_seconds', {'view': view, 'method': method, 'status': status},
+                                         histogram)
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.rows.clear()
+            self.bytes.clear()
+            self.requests.clear()
+
+
+def labels(values) -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(values, escaped)) + '}'
+
+
+def histogram_lines(name, label_values, histogram) -> list:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{labels(dict(label_values, le=bound))} {cumulative}')
+    lines.append(f'{name}_sum{labels(label_values)} {histogram.sum}')
+    lines.append(f'{name}_count{labels(label_values)} {histogram.count}')
+    return lines
+
+
+metrics = Metrics()
+
+
+class Span:
+    """
+    What a span measured, set rows and size inside the with block to count them too.
+    """
+
+    def __init__(self):
+        self.rows = None
+        self.size = None
+        self.seconds = 0.0
+
+
+@contextmanager
+def span(stage, cell=None):
+    """
+    Times the with block as one run of a stage. Runs that raise are timed too.
+    :param stage: name of the stage
+    :param cell: cell it's for, defaults to the current cell
+    :return: Span to put the row and byte counts on
+    """
+    result = Span()
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result.seconds = time.perf_counter() - started
+        metrics.observe(stage, result.seconds, cell, result.rows, result.size)
+
+
+@contextmanager
+def for_cell(cellname):
+    """
+    Makes cellname the current cell for the spans in the with block.
+    """
+    token = current_cell.set(cellname)
+    try:
+        yield
+    finally:
+        current_cell.reset(token)
+
+
+def timed_stream(pieces, stage, cell=None):
+    """
+    Passes a generator's pieces through, timing only the time spent making them (not sending them) and counting their
+    size, text pieces by length rather than encoding them again just to count. Recorded once the stream is finished or
+    closed.
+    :param pieces: iterable of str or bytes
+    :return: generator of the same pieces
+    """
+    seconds = 0.0
+    size = 0
+    pieces = iter(pieces)
+    cell = cell if cell is not None else current_cell.get()
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                piece = next(pieces)
+            except StopIteration:
+                seconds += time.perf_counter() - started
+                return
+            seconds += time.perf_counter() - started
+            size += len(piece)
+            yield piece
+    finally:
+        metrics.observe(stage, seconds, cell, size=size)
+
+
+class MetricsMiddleware:
+    """
+    Times every request by its url pattern, and with settings.METRICS_SERVER_TIMING adds a Server-Timing
+    header with the time of each stage the request went through. A streamed response's header goes out before the
+    file is written, so that part only shows up in /metrics.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'METRICS_SERVER_TIMING', False)
+
+    def __call__(self, request):
+        timings = {}
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        seconds = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = '/' + match.route if match is not None else 'unmatched'  # the url pattern, not the url
+        metrics.observe_request(view, request.method, response.status_code, seconds)
+        if self.server_timing:
+            entries = [f'{stage};dur={value * 1000:.1f}' for stage, value in timings.items()]
+            response['Server-Timing'] = ', '.join(entries + [f'total;dur={seconds * 1000:.1f}'])
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'FPIWebsite.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'FPIWebsite.urls'
@@ -125,6 +126,77 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Add a Server-Timing header with the time each stage of the request took (influx query, post processing, PLC reads
+# and writes...) so it shows in the browser's network tab. The same timings are always on /metrics, see
+# FPIWebsite/metrics.py
+METRICS_SERVER_TIMING = True
+
+# Every cell the export and upload apps know about, with their influx and PLC settings, see FPIWebsite/cells.py
+CELL_REGISTRY = BASE_DIR / 'FPIWebsite' / 'cells.json'
+
+# On disk cache of finished exports, see export/cache.py. Set to None to turn it off.
+# RECENT_TTL is how many seconds an export that reaches into today can be reused for.
+EXPORT_CACHE = {
+    'DIR': BASE_DIR / 'cache' / 'export',
+    'MAX_BYTES': 2 * 1024 ** 3,
+    'RECENT_TTL': 60,
+}
+
+# Exports run in the background when the form asks for it, see export/jobs.py. Finished files are kept in DIR for
+# RETENTION seconds. Jobs still queued or running after STALE_AFTER seconds were lost to a restart and are marked
+# failed.
+EXPORT_JOBS = {
+    'DIR': BASE_DIR / 'cache' / 'jobs',
+    'WORKERS': 2,
+    'RETENTION': 24 * 60 * 60,
+    'STALE_AFTER': 6 * 60 * 60,
+}
+
+# Run the combine and postprocess step of exports in WORKERS separate processes, see export/processing.py. TIMEOUT
+# is how many seconds one export's post processing can take. Set WORKERS to 0 to do it in the request thread.
+EXPORT_POSTPROCESS = {
+    'WORKERS': 2,
+    'TIMEOUT': 300,
+}
+
+# Finished exports of past days kept as Parquet files so downloading a whole day is just a file read, see
+# export/rollup.py. Filled in by `manage.py rollup`, which should run daily, CATCH_UP_DAYS is how far back it looks
+# for days it missed. Set to None to turn it off.
+EXPORT_ROLLUPS = {
+    'DIR': BASE_DIR / 'cache' / 'rollups',
+    'CATCH_UP_DAYS': 7,
+}
+
+# Let influx do the column selection and resampling declared by the 'fields' and 'aggregate' cellconfig settings
+# instead of pulling every raw point, see export/models.py
+EXPORT_SERVER_AGGREGATION = False
+
+# Trim and downcast (for cells with 'downcast' set) each chunk from influx as it arrives to cut peak memory, see
+# export/models.py. Downcast cells come out as float32, which is a few less digits in the csv.
+EXPORT_LEAN_PIPELINE = False
+
+# Upload test points by reading the PLC arrays first and only writing the slices that changed (and zeros past the new
+# end), then reading them back to check, see upload/models.py. Off writes every array in full. Off by default, the
+# read before and the read back after cost more requests than a full write of the arrays we have saves.
+UPLOAD_DIFF_WRITES = False
+
+# Reuse a cell's points read from the PLC for TTL seconds when the upload page loads them, our own uploads clear it
+# straight away, see upload/cache.py. POLL keeps cells someone viewed in the last VIEW_TIMEOUT seconds warm by reading
+# them every POLL seconds in the background, None to only read on demand. Set to None to turn the cache off.
+UPLOAD_POINTS_CACHE = {
+    'TTL': 10,
+    'POLL': None,
+    'VIEW_TIMEOUT': 120,
+}
+
+# manage.py test swaps LOGGING for FPIWebsite.testrunner.TEST_LOGGING so tests don't write the logs or push to Loki
+TEST_RUNNER = 'FPIWebsite.testrunner.TestRunner'
+
+# Loggers only put records on a queue (the 'queue' handler), a background thread hands them to the handlers listed in
+# its 'handlers' in batches so a slow disk or Loki never holds up a request, see FPIWebsite/logqueue.py. The queue holds
+# 'capacity' records, past that 'overflow' drops the oldest ('drop_oldest') or the newest ('drop_new') ones.
+# FPIWebsite.logqueue.dict_config is dictConfig that hands the queue handler those handlers.
+LOGGING_CONFIG = 'FPIWebsite.logqueue.dict_config'
 LOGGING = {
     'version': 1,
     # Version of logging
@@ -137,18 +209,29 @@ LOGGING = {
         }
     },
 
+    'filters': {
+        'downloads': {
+            'name': 'export.views',
+        },
+        'uploads': {
+            'name': 'upload.views',
+        },
+    },
+
     'handlers': {
         'Downloads': {
             'level': 'INFO',
             'class': 'logging.FileHandler',
             'filename': 'logs/downloads.log',
             'formatter': 'Simple_Format',
+            'filters': ['downloads'],
         },
         'Uploads': {
             'level': 'INFO',
             'class': 'logging.FileHandler',
             'filename': 'logs/uploads.log',
             'formatter': 'Simple_Format',
+            'filters': ['uploads'],
         },
         'console': {
             'level': 'INFO',
@@ -159,23 +242,29 @@ LOGGING = {
             'level': 'INFO',
             'job': 'FPIWebsite',
             'url': "http://192.168.10.102:3100/api/prom/push",
-            'class': 'LokiLoggerFPI.LokiHandler',
-        }
+            'class': 'FPIWebsite.logqueue.LokiBatchHandler',
+        },
+        'queue': {
+            'level': 'INFO',
+            'class': 'FPIWebsite.logqueue.BatchingQueueHandler',
+            'handlers': ['console', 'Downloads', 'Uploads', 'loki'],
+            'capacity': 10000,
+            'overflow': 'drop_oldest',
+        },
     },
 
     'loggers': {
         'django': {
-            'handlers': ['console', 'loki'],
+            'handlers': ['queue'],
             'level': 'INFO',
         },
         'export.views': {
-            'handlers': ['console', 'Downloads', 'loki'],
+            'handlers': ['queue'],
             'level': 'INFO',
         },
         'upload.views': {
-            'handlers': ['console', 'Uploads', 'loki'],
+            'handlers': ['queue'],
             'level': 'INFO',
         }
     }
 }
-
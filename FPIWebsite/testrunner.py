@@ -0,0 +1,66 @@
+import logging.config
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+# logging while the tests run, errors to the console and nothing else
+TEST_LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'Simple_Format': {
+            'format': '{asctime} - {levelname}: {message}',
+            'style': '{',
+        }
+    },
+    'handlers': {
+        'console': {
+            'level': 'ERROR',
+            'class': 'logging.StreamHandler',
+            'formatter': 'Simple_Format',
+        },
+    },
+    'loggers': {
+        name: {'handlers': ['console'], 'level': 'INFO'} for name in ('django', 'export.views', 'upload.views')
+    },
+}
+
+# settings while the tests run, no export cache, rollups or postprocess workers so every export goes through the fetch
+# path in the test process whatever a developer has on disk, tests that want one patch in their own
+TEST_SETTINGS = {
+    'EXPORT_CACHE': None,
+    'EXPORT_ROLLUPS': None,
+    'EXPORT_POSTPROCESS': None,
+}
+
+
+def clear_getters():
+    """
+    Forgets the cache, rollup store and postprocess pool built from the settings, the next call builds them again.
+    """
+    from export.cache import get_cache
+    from export.processing import get_postprocess_pool
+    from export.rollup import get_rollup_store
+
+    for getter in (get_cache, get_postprocess_pool, get_rollup_store):
+        getter.cache_clear()
+
+
+class TestRunner(DiscoverRunner):
+    """
+    The default test runner with logging swapped for TEST_LOGGING first, so requests the tests make don't end up in
+    logs/downloads.log and logs/uploads.log or get pushed to the plant's Loki. Django only applies settings.LOGGING at
+    startup, override_settings can't do this. TEST_SETTINGS apply for the whole run.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        logging.config.dictConfig(TEST_LOGGING)  # closes the queue, file and Loki handlers from settings.LOGGING
+        super().setup_test_environment(**kwargs)
+        self.test_settings = override_settings(**TEST_SETTINGS)
+        self.test_settings.enable()
+        clear_getters()
+
+    def teardown_test_environment(self, **kwargs):
+        self.test_settings.disable()
+        clear_getters()
+        super().teardown_test_environment(**kwargs)
@@ -16,9 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('export/', include('export.urls')),
     path('upload/', include('upload.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('', include('mainmenu.urls')),
     #path('admin/', admin.site.urls),
 ]
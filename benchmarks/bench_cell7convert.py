@@ -0,0 +1,42 @@
+"""
+Times Exporter.cell7convert against the original row by row version on synthetic cell 7 data.
+
+    python benchmarks/bench_cell7convert.py [rows ...]
+
+Defaults to 100k and 1M plc rows.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from export.models import Exporter  # noqa: E402
+from export.tests import synthetic_cell7, legacy  # noqa: E402
+
+
+def best_of(func, df, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(df)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    exporter = Exporter()
+    print(f"{'rows':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>9}")
+    for rows in sizes:
+        df = synthetic_cell7(rows)
+        old = best_of(legacy, df, 1)
+        new = best_of(exporter.cell7convert, df, 3)
+        print(f"{rows:>10,} {old:>12.3f} {new:>15.3f} {old / new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000])
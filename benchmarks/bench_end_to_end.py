@@ -0,0 +1,237 @@
+"""
+End to end latency, throughput and peak memory of exports and uploads, from the request to the last byte of the
+response, going through the views with everything behind them real except the plant network: influx is
+benchmarks/fake_influx.py serving synthetic data over HTTP from its own process and the PLCs are benchmarks/fake_plc.py
+with a delay per request. The export cache and rollups are turned off so every run does the whole export.
+
+    python benchmarks/bench_end_to_end.py [--repeat 3] [--plc-latency 0.005] [--save] [--tolerance 0.2]
+
+Prints each scenario next to the saved baseline (benchmarks/baselines.json) and exits with 1 if any got slower or
+bigger by more than the tolerance. --save records this run as the new baseline instead. Peak memory is what
+tracemalloc sees in this process, post processing on the EXPORT_POSTPROCESS workers isn't part of it.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import ExitStack
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.test import Client  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from benchmarks import fake_influx  # noqa: E402
+from benchmarks.fake_plc import cell_plc  # noqa: E402
+from FPIWebsite.cells import get_registry  # noqa: E402
+from export.influx import ClientPool  # noqa: E402
+from upload.plc import ConnectionManager  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# name -> (cell slug, export form)
+EXPORTS = {
+    'export cell7 day csv': ('cell7', {'date': '03/01/2023', 'format': 'csv'}),
+    'export cell5 day csv': ('cell5', {'date': '03/01/2023', 'format': 'csv'}),
+    'export tribology week csv': ('tribology', {'date': '03/01/2023', 'end_date': '03/07/2023', 'format': 'csv'}),
+    'export tribology week parquet': ('tribology', {'date': '03/01/2023', 'end_date': '03/07/2023',
+                                                    'format': 'parquet'}),
+}
+
+# name -> cell, every upload changes every point so diff writes can't skip any
+UPLOADS = {
+    'upload cell7': 'cell7',
+    'upload cell8': 'cell8',
+    'upload stand4': 'Stand 4',
+}
+
+READS = {
+    'readpoints cell8': 'cell8',
+}
+
+
+def recipe(cellname, version):
+    """
+    :return: a full size recipe for a cell, posted the way the upload page does it, versions differ in every point
+    """
+    if cellname == 'cell7':
+        rows = [[hour, 5 * version] for hour in range(1, 13)]
+    elif cellname == 'cell8':
+        rows = [[n, 2 * n + version, 3 * n + version] for n in range(1, 601)]
+    else:
+        rows = [[n, n % 50 + version, n % 7 + version, n + version] for n in range(1, 101)]
+    return json.dumps([[str(value) for value in row] for row in rows], separators=(',', ':'))
+
+
+def export_run(client, slug, form):
+    def run():
+        response = client.post(f'/export/{slug}/', form)
+        if not response.streaming:
+            raise RuntimeError(f"{slug} export failed: {response.content[:200]}")
+        size = sum(len(piece) for piece in response.streaming_content)
+        response.close()
+        return size
+    return run
+
+
+def upload_run(client, cellname, slug):
+    recipes = [recipe(cellname, 0), recipe(cellname, 1)]
+    uploads = iter(range(sys.maxsize))
+
+    def run():
+        response = client.post(f'/upload/{slug}', {'data': recipes[next(uploads) % 2]})
+        if response.status_code != 200 or b'Invalid data' in response.content:
+            raise RuntimeError(f"{cellname} upload failed: {response.content[:200]}")
+        return len(response.content)
+    return run
+
+
+def read_run(client, slug):
+    def run():
+        response = client.get(f'/upload/{slug}/readpoints')
+        if response.status_code != 200:
+            raise RuntimeError(f"{slug} readpoints failed with {response.status_code}")
+        return len(response.content)
+    return run
+
+
+def measure(run, repeat, plc=None):
+    """
+    Times repeat runs after a warm up run, then one more under tracemalloc for the peak.
+    :return: dict of results
+    """
+    run()
+    requests = plc.requests if plc is not None else 0
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = run()
+        times.append(time.perf_counter() - started)
+    median = statistics.median(times)
+    result = {'median_ms': median * 1000, 'best_ms': min(times) * 1000, 'per_second': 1 / median}
+    if plc is None:
+        result['mb_per_second'] = size / median / 1024 ** 2
+    else:
+        result['plc_requests'] = (plc.requests - requests) / repeat
+
+    tracemalloc.start()
+    run()
+    result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return {key: round(value, 3) for key, value in result.items()}
+
+
+def run_all(args, port):
+    client = Client()
+    results = {}
+    with ExitStack() as patches:
+        # point every cell at the fake influx and make every export start from scratch
+        configs = get_registry().export_configs
+        for patcher in (mock.patch.dict(configs, {name: dict(config, host='127.0.0.1', port=port)
+                                                  for name, config in configs.items()}),
+                        mock.patch('export.models.pool', ClientPool()),
+                        mock.patch('export.models.get_cache', lambda: None),
+                        mock.patch('export.models.get_rollup_store', lambda: None)):
+            patches.enter_context(patcher)
+
+        for name, (slug, form) in EXPORTS.items():
+            results[name] = measure(export_run(client, slug, form), args.repeat)
+            print(f"{name:<30} {results[name]['median_ms']:>10.1f} ms", file=sys.stderr)
+
+        for name, cellname in {**UPLOADS, **READS}.items():
+            plc = cell_plc(cellname, args.plc_latency)
+            manager = ConnectionManager()
+            slug = get_registry().get(cellname).slug
+            with mock.patch('upload.plc.PLC', plc), mock.patch('upload.models.plcs', manager), \
+                    mock.patch('upload.views.get_points_cache', lambda: None):  # every read goes to the PLC
+                if name in UPLOADS:
+                    run = upload_run(client, cellname, slug)
+                else:
+                    plc.tags.update({tag: [n % 100 for n in range(len(value))] for tag, value in plc.tags.items()})
+                    run = read_run(client, slug)
+                results[name] = measure(run, args.repeat, plc)
+            manager.close()
+            print(f"{name:<30} {results[name]['median_ms']:>10.1f} ms", file=sys.stderr)
+    return results
+
+
+def environment(args) -> dict:
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'plc_latency': args.plc_latency,
+        'influx_rates': fake_influx.RATES,
+    }
+
+
+def compare(results, baseline, tolerance) -> bool:
+    """
+    Prints results next to the baseline.
+    :return: True if nothing got worse by more than tolerance
+    """
+    ok = True
+    print(f"{'scenario':<30} {'median (ms)':>12} {'baseline':>10} {'change':>8} {'per s':>8} {'peak (MB)':>10} "
+          f"{'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        line = f"{name:<30} {result['median_ms']:>12.1f}"
+        if old is None:
+            print(f"{line} {'-':>10} {'-':>8} {result['per_second']:>8.2f} {result['peak_mb']:>10.1f}")
+            continue
+        time_change = result['median_ms'] / old['median_ms'] - 1
+        # uploads only allocate a few hundred KB, growth under a MB is noise rather than a regression
+        memory_change = (result['peak_mb'] - old['peak_mb']) / max(old['peak_mb'], 1)
+        worse = [label for label, change in (('slower', time_change), ('bigger', memory_change)) if change > tolerance]
+        ok = ok and not worse
+        print(f"{line} {old['median_ms']:>10.1f} {time_change:>+8.0%} {result['per_second']:>8.2f} "
+              f"{result['peak_mb']:>10.1f} {old['peak_mb']:>10.1f} {memory_change:>+8.0%}  {', '.join(worse).upper()}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per scenario")
+    parser.add_argument('--plc-latency', type=float, default=0.005, help="seconds per PLC request")
+    parser.add_argument('--baseline', default=BASELINES, help="baseline file")
+    parser.add_argument('--save', action='store_true', help="save this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="how much worse than the baseline is a failure")
+    args = parser.parse_args()
+
+    setup_test_environment()  # lets the test client in past ALLOWED_HOSTS
+    logging.disable(logging.CRITICAL)  # keep benchmark requests out of the real download/upload logs and Loki
+    with fake_influx.running() as port:
+        results = run_all(args, port)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment(args):
+            print("The baseline was recorded with different settings or on a different machine, "
+                  "differences may not mean much", file=sys.stderr)
+    ok = compare(results, baseline.get('results', {}), args.tolerance)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'recorded': datetime.date.today().isoformat(), 'environment': environment(args),
+                       'results': results}, f, indent=2)
+            f.write('\n')
+        print(f"Saved as the baseline in {args.baseline}")
+    elif not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
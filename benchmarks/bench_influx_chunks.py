@@ -0,0 +1,63 @@
+"""
+Times reading a day of cell 7 PLC_Tags from the fake influx (benchmarks/fake_influx.py) unchunked, through
+influxdb-python's own chunked reader and through export.influx.query_chunks, at a few chunk sizes. Reading chunked
+has to stay about as fast as reading the whole response in one go, exits with 1 if query_chunks at the exporter's
+CHUNK_SIZE takes more than --limit times as long as the unchunked read.
+
+    python benchmarks/bench_influx_chunks.py [--limit 1.5] [--sizes 1000 10000 ...]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from influxdb import InfluxDBClient  # noqa: E402
+from benchmarks import fake_influx  # noqa: E402
+from export.influx import query_chunks  # noqa: E402
+from export.models import CHUNK_SIZE, Exporter  # noqa: E402
+
+QUERY = "select * from PLC_Tags where time >= 1677650400000000000 and time < 1677736800000000000"
+
+
+def timed(read):
+    """
+    :param read: function running the query, returning ResultSets
+    :return: (seconds from the request to the last dataframe, rows)
+    """
+    started = time.perf_counter()
+    rows = sum(len(Exporter.to_frame(points)) for result in read() for _, points in result.items())
+    return time.perf_counter() - started, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--limit', type=float, default=1.5, help="slowest query_chunks may be next to unchunked")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, CHUNK_SIZE], help="chunk sizes to time")
+    args = parser.parse_args()
+
+    with fake_influx.running() as port:
+        client = InfluxDBClient('127.0.0.1', port, database='cell7')
+        unchunked, rows = timed(lambda: [client.query(QUERY, epoch='ns')])
+        print(f"{'reader':<24} {'chunk size':>10} {'rows':>8} {'time (s)':>9}")
+        print(f"{'unchunked':<24} {'-':>10} {rows:>8,} {unchunked:>9.2f}")
+        ours = {}
+        for size in args.sizes:
+            seconds, rows = timed(lambda: client.query(QUERY, epoch='ns', chunked=True, chunk_size=size))
+            print(f"{'influxdb-python chunked':<24} {size:>10,} {rows:>8,} {seconds:>9.2f}")
+            ours[size], rows = timed(lambda: query_chunks(client, QUERY, 'cell7', size))
+            print(f"{'query_chunks':<24} {size:>10,} {rows:>8,} {ours[size]:>9.2f}")
+        client.close()
+
+    if CHUNK_SIZE in ours and ours[CHUNK_SIZE] > args.limit * unchunked:
+        print(f"query_chunks at CHUNK_SIZE {CHUNK_SIZE} is {ours[CHUNK_SIZE] / unchunked:.1f}x the unchunked read")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
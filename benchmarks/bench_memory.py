@@ -0,0 +1,60 @@
+"""
+Peak memory of a cell 7 export with and without the lean pipeline (EXPORT_LEAN_PIPELINE), measured with tracemalloc
+while Exporter.get_range runs against a fake influx holding synthetic data.
+
+    python benchmarks/bench_memory.py [rows ...]
+
+Defaults to 86,400 plc rows (a day at one a second) and 500k.
+"""
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import pandas as pd  # noqa: E402
+from export.influx import ClientPool  # noqa: E402
+from export.models import Exporter  # noqa: E402
+from export.tests import FakeInfluxClient, cell7_series, synthetic_cell7  # noqa: E402
+
+
+def measure(series, lean):
+    exporter = Exporter()
+    exporter.lean = lean
+    start = datetime.datetime(2023, 3, 1)
+    stop = start + datetime.timedelta(days=10)
+    with mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)), \
+            mock.patch('export.models.pool', ClientPool()), mock.patch('export.models.get_cache', lambda: None), \
+            mock.patch('export.models.get_rollup_store', lambda: None), \
+            mock.patch('export.models.get_postprocess_pool', lambda: None):
+        tracemalloc.start()
+        began = time.perf_counter()
+        df = exporter.get_range(start, stop, 'cell7')
+        elapsed = time.perf_counter() - began
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak, elapsed, df
+
+
+def main(sizes):
+    print(f"{'rows':>10} {'peak (MB)':>10} {'lean peak (MB)':>15} {'saved':>7} {'time (s)':>9} {'lean time (s)':>14} "
+          f"{'result (MB)':>12} {'lean result (MB)':>17}")
+    for rows in sizes:
+        series = cell7_series(synthetic_cell7(rows))
+        peak, elapsed, df = measure(series, lean=False)
+        lean_peak, lean_elapsed, lean_df = measure(series, lean=True)
+        pd.testing.assert_frame_equal(df, lean_df, check_dtype=False, check_exact=False, rtol=1e-5)
+        mb = 1024 ** 2
+        print(f"{rows:>10,} {peak / mb:>10.1f} {lean_peak / mb:>15.1f} {1 - lean_peak / peak:>7.0%} {elapsed:>9.2f} "
+              f"{lean_elapsed:>14.2f} {df.memory_usage().sum() / mb:>12.1f} {lean_df.memory_usage().sum() / mb:>17.1f}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [86_400, 500_000])
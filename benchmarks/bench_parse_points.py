@@ -0,0 +1,61 @@
+"""
+Times upload.models.parse_points against the original string splitting version on full size spreadsheet payloads,
+the way the upload page posts them (every cell a string, empty cells "").
+
+    python benchmarks/bench_parse_points.py [repeat]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from upload.models import parse_points, upload_config  # noqa: E402
+from upload.tests import legacy_cell7validation  # noqa: E402
+
+
+def legacy_parse_points(points, cellname):
+    points = points.replace('""', '0')
+    points = points.replace('"', '')
+    points_new = []
+    for inner in points[2:-2].split('],['):
+        points_new.append([int(item) for item in inner.split(',')])
+    if len(points_new) > upload_config(cellname)['max_input']:
+        return None
+    if cellname != 'cell7' or legacy_cell7validation(points_new):
+        return points_new
+
+
+def payloads():
+    cell7 = [[str(n // 2), str(30 * (n % 2))] for n in range(1, 12)] + [['', '']]
+    cell8 = [[str(n), str(2 * n), str(3 * n)] for n in range(1, 601)]
+    stand4 = [[str(n), str(n % 50), str(n % 7), ''] for n in range(1, 101)]
+    return [('cell7', cell7), ('cell8', cell8), ('Stand 4', stand4)]
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(repeat):
+    print(f"{'cell':>8} {'rows':>5} {'legacy (us)':>12} {'strict (us)':>12} {'speedup':>9}")
+    for cellname, rows in payloads():
+        text = json.dumps(rows, separators=(',', ':'))  # JSON.stringify doesn't put spaces in
+        assert parse_points(text, cellname).tolist() == legacy_parse_points(text, cellname)
+        old = best_of(lambda: legacy_parse_points(text, cellname), repeat) * 1e6
+        new = best_of(lambda: parse_points(text, cellname), repeat) * 1e6
+        print(f"{cellname:>8} {len(rows):>5} {old:>12.1f} {new:>12.1f} {old / new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
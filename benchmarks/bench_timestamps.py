@@ -0,0 +1,62 @@
+"""
+Times turning influx timestamps into the local time index, the old RFC3339 string repair against the epoch ns path.
+
+    python benchmarks/bench_timestamps.py [rows ...]
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FPIWebsite.settings')
+
+import django  # noqa: E402
+django.setup()
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from export.models import Exporter  # noqa: E402
+
+
+def legacy_to_frame(points):
+    df = pd.DataFrame(points)
+    mask = ~df.time.str.contains('\\.')
+    df.time.values[mask] = df.time[mask].str[:-1] + '.000000Z'
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.time, format="%Y-%m-%dT%H:%M:%S.%fZ") - datetime.timedelta(hours=6))
+    return df
+
+
+def points(rows, epoch):
+    # about one point a second, every tenth landing exactly on a whole second like influx sends them
+    stamps = pd.Timestamp('2023-03-01 06:00', tz='UTC').value + np.arange(rows) * 1_000_000_000
+    stamps[np.arange(rows) % 10 != 0] += 123_456_000
+    values = np.random.default_rng(0).random(rows)
+    if epoch:
+        times = stamps.tolist()
+    else:
+        index = pd.to_datetime(stamps, utc=True)
+        times = np.where(stamps % 1_000_000_000 == 0, index.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                         index.strftime('%Y-%m-%dT%H:%M:%S.%fZ')).tolist()
+    return [{'time': t, 'a': v} for t, v in zip(times, values)]
+
+
+def best_of(func, data, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    print(f"{'rows':>10} {'strings (s)':>12} {'epoch ns (s)':>13} {'speedup':>9}")
+    for rows in sizes:
+        old = best_of(legacy_to_frame, points(rows, epoch=False))
+        new = best_of(Exporter.to_frame, points(rows, epoch=True))
+        print(f"{rows:>10,} {old:>12.3f} {new:>13.3f} {old / new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000])
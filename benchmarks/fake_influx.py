@@ -0,0 +1,229 @@
+"""
+A local stand-in for the plant's InfluxDB, answering the exporter's select queries over HTTP with synthetic series so
+exports can be benchmarked end to end without the plant network. Every measurement the cells read has points at a
+fixed rate over a fixed run of days, the values are random but the same for the same query.
+
+    python benchmarks/fake_influx.py [--port 8086] [--start 2023-03-01] [--days 31] [--rate PLC_Tags=1 ...]
+
+The benchmarks start it in their own process with running(), so serving it doesn't share a GIL or a heap with the site.
+"""
+import argparse
+import json
+import multiprocessing
+import re
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+PLC_COLS = ['Air_Flow_MLPM', 'Oil_Temp_F', 'Oil_Temp_Cooler_In_F', 'Press_System_PSI', 'Water_Valve_CMD',
+            'Water_Flow_In_GPM', 'Water_Temp_In_F', 'Water_Temp_Out_F']
+TE_COLS = ["Density (dm/cc)", "Dialectric constant (-)", "Resistance (Ohms)", "Temperature (C)", "Viscosity (cp)"]
+TRIDENT_COLS = ["oil_rh", "s0_magnitude", "s0_phase", "s0_temp_post_ref", "s0_temp_post_sample", "s1_magnitude",
+                "s1_phase", "s1_temp_post_ref", "s1_temp_post_sample", "s2_magnitude", "s2_phase",
+                "s2_temp_post_sample", "s3_magnitude", "s3_phase", "s3_temp_post_sample", "s4_magnitude",
+                "s4_phase", "s4_temp_post_sample", "sweep_count"]
+
+# measurement -> random fields it has, PLC_Tags also gets the test counters, see points()
+COLUMNS = {
+    'PLC_Tags': PLC_COLS + ['Unused_Tag'],
+    'TE': TE_COLS,
+    'Trident': TRIDENT_COLS,
+    'data1': ['Speed_RPM', 'Torque_Nm', 'Oil_Temp_C', 'Oil_Press_PSI', 'Flow_GPM', 'Motor_Current_A'],
+    'data2': ['Vibration_X', 'Vibration_Y', 'Vibration_Z'],
+}
+
+# measurement -> seconds between points, about what the plant logs
+RATES = {'PLC_Tags': 1, 'TE': 30, 'Trident': 100, 'data1': 1, 'data2': 3}
+
+QUERY = re.compile(r"select (.+) from (\w+) where time (>=?) (\d+) and time < (\d+)"
+                   r"(?: group by time\((\d+)s\) fill\(none\))?")
+
+
+class SyntheticData:
+    """
+    The series the fake influx serves. Points sit on multiples of their measurement's rate from start for days days,
+    so any two queries that overlap agree on what's in the overlap.
+    """
+
+    def __init__(self, rates=None, start='2023-03-01', days=31, seed=0):
+        """
+        :param rates: dict of measurement to seconds between points, overrides RATES
+        :param start: first day there's data for, UTC
+        :param days: number of days there's data for
+        :param seed: random seed
+        """
+        self.rates = dict(RATES, **(rates or {}))
+        self.start = pd.Timestamp(start, tz='UTC').value
+        self.stop = self.start + days * 86_400 * 1_000_000_000
+        self.seed = seed
+
+    def points(self, measurement, start, stop, include_start=True) -> pd.DataFrame:
+        """
+        :param start: epoch ns
+        :param stop: epoch ns, not included
+        :return: dataframe with an epoch ns 'time' column and the measurement's fields, empty for unknown measurements
+        """
+        if measurement not in COLUMNS:
+            return pd.DataFrame({'time': np.array([], dtype=np.int64)})
+        period = int(self.rates[measurement] * 1_000_000_000)
+        first = max(start if include_start else start + 1, self.start)
+        first = self.start + -(-(first - self.start) // period) * period  # round up onto the grid
+        times = np.arange(first, min(stop, self.stop), period, dtype=np.int64)
+
+        # seeded by where the rows sit on the grid, not by the query, so the same point always has the same values
+        index = (first - self.start) // period
+        rng = np.random.default_rng([self.seed, zlib.crc32(measurement.encode()), index])
+        columns = COLUMNS[measurement]
+        df = pd.DataFrame(rng.normal(100, 10, (len(times), len(columns))), columns=columns)
+        df.insert(0, 'time', times)
+        if measurement == 'PLC_Tags':
+            seconds = (times - self.start) // 1_000_000_000
+            df['Testing_HMI'] = (seconds // 3600 % 8 < 6).astype(float)  # six hours of test then two off
+            df['Hours_Counter.ACC'] = (seconds // 3600).astype(float)
+            df['Minutes_Counter.ACC'] = (seconds % 3600 // 60).astype(float)
+            df['Seconds_Counter.ACC'] = (seconds % 60).astype(float)
+            df['Unused_Tag'] = 1.0  # something only select * picks up
+        return df
+
+    def query(self, query) -> (str, pd.DataFrame):
+        """
+        Runs one of the exporter's selects, see Exporter.build_query.
+        :return: (measurement, result dataframe)
+        """
+        match = QUERY.fullmatch(query.strip())
+        if match is None:
+            raise ValueError(f"fake influx doesn't understand {query}")
+        selection, measurement, op, start, stop, interval = match.groups()
+        df = self.points(measurement, int(start), int(stop), op == '>=')
+
+        if selection not in ('*', 'mean(*)'):
+            fields = list(dict.fromkeys(re.findall(r'"((?:[^"\\]|\\.)*)"', selection)))
+            df = df.reindex(columns=['time'] + fields)  # like influx, fields the measurement lacks come back null
+        if interval is not None:
+            width = int(interval) * 1_000_000_000
+            df = df.drop(columns='time').groupby(df.time // width * width).mean().dropna(how='all')
+            if selection == 'mean(*)':
+                df.columns = [f'mean_{col}' for col in df.columns]
+            df = df.rename_axis('time').reset_index()
+        return measurement, df
+
+
+def chunk_lines(measurement, df, chunk_size):
+    """
+    :return: generator of the lines of a chunked influx response, chunk_size rows each
+    """
+    columns = json.dumps(list(df.columns))
+    for i in range(0, len(df), chunk_size):
+        part = df.iloc[i:i + chunk_size]
+        partial = 'true' if i + chunk_size < len(df) else 'false'
+        yield (f'{{"results":[{{"statement_id":0,"series":[{{"name":"{measurement}","columns":{columns},'
+               f'"values":{part.to_json(orient="values", double_precision=6)},"partial":{partial}}}]}}]}}\n').encode()
+
+
+class InfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep alive, like the real one, so the client pool gets to reuse connections
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/ping':
+            self.send_response(204)
+            self.send_header('X-Influxdb-Version', '1.8.10')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif url.path == '/query':
+            self.query(parse_qs(url.query))
+        else:
+            self.reply(404, {'error': f'{url.path} not found'})
+
+    do_POST = do_GET
+
+    def query(self, params):
+        try:
+            measurement, df = self.server.data.query(params['q'][0])
+        except (KeyError, ValueError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+        chunk_size = int(params.get('chunk_size', ['10000'])[0])
+
+        if params.get('chunked', ['false'])[0] != 'true':
+            lines = list(chunk_lines(measurement, df, len(df) or 1))
+            self.reply(200, json.loads(lines[0]) if lines else {'results': [{'statement_id': 0}]})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in chunk_lines(measurement, df, chunk_size):
+            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8086, ready=None, **options):
+    """
+    Serves synthetic data until killed.
+    :param port: port to listen on, 0 for any free one
+    :param ready: connection the port is sent on once it's listening
+    :param options: SyntheticData options
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), InfluxHandler)
+    server.daemon_threads = True
+    server.data = SyntheticData(**options)
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+@contextmanager
+def running(**options):
+    """
+    Runs the fake influx in its own process for the duration of the with block.
+    :param options: SyntheticData options
+    :return: port it's listening on
+    """
+    receiving, sending = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('spawn').Process(target=serve, args=(0, sending), kwargs=options,
+                                                            daemon=True)
+    process.start()
+    try:
+        if not receiving.poll(30):
+            raise RuntimeError("fake influx didn't start")
+        yield receiving.recv()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def parse_rates(values) -> dict:
+    rates = {}
+    for value in values:
+        measurement, _, seconds = value.partition('=')
+        rates[measurement] = float(seconds)
+    return rates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--start', default='2023-03-01', help="first day with data")
+    parser.add_argument('--days', type=int, default=31, help="number of days with data")
+    parser.add_argument('--rate', action='append', default=[], metavar='MEASUREMENT=SECONDS',
+                        help="seconds between points of a measurement")
+    args = parser.parse_args()
+    print(f"Fake influx on http://127.0.0.1:{args.port}")
+    serve(args.port, start=args.start, days=args.days, rates=parse_rates(args.rate))
@@ -0,0 +1,46 @@
+"""
+A pylogix stand-in for benchmarking uploads without the plant network: upload.tests.FakePLC with a delay on every
+request that would go over the network, connecting included. Needs Django set up first, like the benchmarks do.
+"""
+import time
+
+from upload.models import upload_config
+from upload.tests import FakePLC, cell7_plc
+
+
+class SlowPLC(FakePLC):
+    """
+    FakePLC that takes latency seconds for each request, about an EtherNet/IP round trip on the plant network. Requests
+    are counted the way FakePLC does, an array takes a packet per ConnectionSize bytes and a batched write that's too
+    big is refused, so a benchmark pays for big arrays what the PLC would make it pay.
+    """
+
+    def __init__(self, tags, latency=0.005):
+        super().__init__(tags)
+        self.latency = latency
+
+    def connect(self):
+        time.sleep(self.latency)
+        return super().connect()
+
+    def Read(self, tag, count=1, datatype=None):
+        requests = self.requests
+        result = super().Read(tag, count, datatype)
+        time.sleep(self.latency * (self.requests - requests))
+        return result
+
+    def Write(self, tag, value=None, datatype=None):
+        requests = self.requests
+        result = super().Write(tag, value, datatype)
+        time.sleep(self.latency * (self.requests - requests))
+        return result
+
+
+def cell_plc(cellname, latency=0.005) -> SlowPLC:
+    """
+    :return: SlowPLC with a cell's test point arrays, max_input long like the ones in the real PLC
+    """
+    tags = cell7_plc().tags if cellname == 'cell7' else {}  # cell 7 has its post upload settings too
+    config = upload_config(cellname)
+    tags.update({tag: [0] * config['max_input'] for tag in config['tagnames']})
+    return SlowPLC(tags, latency)
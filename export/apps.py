@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ExportConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'export'
+
+    def ready(self):
+        from FPIWebsite.cells import get_registry
+        get_registry()  # load the cells file at startup so a mistake in it shows up straight away
@@ -0,0 +1,151 @@
+import hashlib
+import importlib
+import inspect
+import os
+import pickle
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+from django.conf import settings
+
+# bump by hand for a change to what exports come out as that none of PIPELINE_MODULES' source shows, e.g. a pandas
+# upgrade that formats or rounds differently, to make every cached export and rollup miss
+CACHE_VERSION = 1
+
+# modules every export's data goes through, an edit to any of them makes every cached export and rollup miss
+PIPELINE_MODULES = ('export.influx', 'export.merge', 'export.models', 'export.processing')
+
+
+class ExportCache:
+    """
+    On disk cache of finished export dataframes. Entries are pickles in one directory, the least recently used ones
+    are deleted once the directory goes over max_bytes. Entries can carry an expiry for ranges that are still filling up.
+    """
+
+    def __init__(self, directory, max_bytes, recent_ttl):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.recent_ttl = recent_ttl
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(cellname, start, stop, config) -> str:
+        """
+        Builds the cache key for one export. It covers the cell, the range and a version of the cellconfig entry so
+        changing the config or the code that processes it makes old entries miss.
+        :param cellname: name of the cellconfig entry
+        :param start: aware datetime of the start of the range
+        :param stop: aware datetime of the end of the range
+        :param config: the cellconfig entry
+        :return: hex digest to use as the key
+        """
+        text = f"{cellname}|{start.isoformat()}|{stop.isoformat()}|{config_version(config)}"
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: key from ExportCache.key
+        :return: the cached dataframe, None on a miss or an expired entry
+        """
+        path = self.directory / f"{key}.pkl"
+        try:
+            with open(path, 'rb') as f:
+                expires, df = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if expires is not None and expires < time.time():
+            self.discard(path)
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass
+        return df
+
+    def put(self, key, df: pd.DataFrame, complete=True):
+        """
+        Stores a dataframe, ranges that are not complete yet only live for recent_ttl seconds.
+        :param key: key from ExportCache.key
+        :param df: dataframe to store
+        :param complete: False if the range reaches into the future and can still change
+        """
+        if not complete and not self.recent_ttl:
+            return
+        expires = None if complete else time.time() + self.recent_ttl
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file and move it into place so a reader never sees half a pickle
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, df), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.directory / f"{key}.pkl")
+        except BaseException:
+            self.discard(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits in max_bytes.
+        """
+        with self.lock:
+            entries = []
+            for path in self.directory.glob('*.pkl'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self.discard(path)
+                total -= size
+
+    @staticmethod
+    def discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def config_version(config) -> str:
+    """
+    Hashes a cellconfig entry along with the code that turns influx's data into the export: CACHE_VERSION, the source
+    of PIPELINE_MODULES (reading, merging and post processing) and the source of the module each function in the entry
+    lives in, so an edit to a postprocess function or anything it calls changes the version.
+    :param config: the cellconfig entry
+    :return: hex digest
+    """
+    parts = [f"version={CACHE_VERSION}"] + [module_version(name) for name in PIPELINE_MODULES]
+    for name in sorted(config):
+        value = config[name]
+        if callable(value):
+            value = module_version(inspect.getmodule(value).__name__)
+        parts.append(f"{name}={value!r}")
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def module_version(module_name) -> str:
+    return hashlib.sha256(inspect.getsource(importlib.import_module(module_name)).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_cache():
+    """
+    :return: the process wide ExportCache built from settings.EXPORT_CACHE, None if caching is turned off
+    """
+    options = getattr(settings, 'EXPORT_CACHE', None)
+    if not options:
+        return None
+    return ExportCache(options['DIR'], options.get('MAX_BYTES', 1024 ** 3), options.get('RECENT_TTL', 0))
@@ -0,0 +1,133 @@
+import io
+import zlib
+from importlib.util import find_spec
+
+import pandas as pd
+
+# number of rows rendered into each piece of a streamed csv download
+CSV_CHUNK_ROWS = 10_000
+
+
+def stream_csv(df, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Generator that renders a dataframe to csv a block of rows at a time so the whole file never has to sit in memory
+    as one string. Output is the same as df.to_csv(). pandas writes a time zone naive index with one precision picked
+    from the whole index (dates only when every timestamp is a midnight, otherwise as many decimals as the finest one
+    needs), so blocks that would come out differently on their own get their timestamps written at the whole index's
+    precision.
+    :param df: dataframe to render
+    :param chunk_rows: number of rows per yielded piece
+    :return: generator of csv text
+    """
+    naive = isinstance(df.index, pd.DatetimeIndex) and df.index.tz is None and len(df) > chunk_rows
+    digits = timestamp_digits(df.index) if naive else None
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        if naive and timestamp_digits(chunk.index) != digits:
+            chunk = chunk.set_axis(format_timestamps(chunk.index, digits))
+        yield chunk.to_csv(header=start == 0)  # first piece carries the header
+
+
+def timestamp_digits(index) -> int:
+    """
+    :param index: time zone naive DatetimeIndex without NaT
+    :return: decimals pandas writes the index's seconds with, 0, 3, 6 or 9, or -1 when it writes dates only
+    """
+    values = index.asi8
+    if (values % 86_400_000_000_000 == 0).all():
+        return -1
+    for digits in (0, 3, 6):
+        if (values % 10 ** (9 - digits) == 0).all():
+            return digits
+    return 9
+
+
+def format_timestamps(index, digits) -> pd.Index:
+    """
+    Writes a time zone naive DatetimeIndex out the way pandas would at the given precision, see timestamp_digits.
+    """
+    if digits == -1:
+        return pd.Index(index.strftime('%Y-%m-%d'), name=index.name)
+    text = index.strftime('%Y-%m-%d %H:%M:%S')
+    if digits:
+        fraction = pd.Index(index.asi8 % 1_000_000_000 // 10 ** (9 - digits)).astype(str).str.zfill(digits)
+        text = text + '.' + fraction
+    return pd.Index(text, name=index.name)
+
+
+def stream_csv_gzip(df):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 is a gzip header and trailer
+    for text in stream_csv(df):
+        yield compressor.compress(text.encode())
+    yield compressor.flush()
+
+
+def stream_csv_zstd(df):
+    import zstandard
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for text in stream_csv(df):
+        yield compressor.compress(text.encode())
+    yield compressor.flush()
+
+
+def write_parquet(df):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer)
+    yield buffer.getvalue()
+
+
+def write_feather(df):
+    # feather can't store an index, so the timestamps go in as the first column
+    buffer = io.BytesIO()
+    index_name = df.index.name if df.index.name and df.index.name not in df.columns else 'timestamp'
+    df.reset_index(names=index_name).to_feather(buffer)
+    yield buffer.getvalue()
+
+
+"""
+Every download format the exporter offers. 'writer' takes the dataframe from Exporter.get_range and returns an
+iterable of the file contents, 'requires' is the optional package the format needs to be offered at all.
+"""
+FORMATS = {
+    'csv': {
+        'label': 'CSV',
+        'content_type': 'text/csv',
+        'extension': 'csv',
+        'writer': stream_csv,
+    },
+    'csv.gz': {
+        'label': 'CSV (gzip)',
+        'content_type': 'application/gzip',
+        'extension': 'csv.gz',
+        'writer': stream_csv_gzip,
+    },
+    'csv.zst': {
+        'label': 'CSV (zstd)',
+        'content_type': 'application/zstd',
+        'extension': 'csv.zst',
+        'writer': stream_csv_zstd,
+        'requires': 'zstandard',
+    },
+    'parquet': {
+        'label': 'Parquet',
+        'content_type': 'application/vnd.apache.parquet',
+        'extension': 'parquet',
+        'writer': write_parquet,
+        'requires': 'pyarrow',
+    },
+    'feather': {
+        'label': 'Arrow IPC (Feather)',
+        'content_type': 'application/vnd.apache.arrow.file',
+        'extension': 'arrow',
+        'writer': write_feather,
+        'requires': 'pyarrow',
+    },
+}
+
+
+def available_formats():
+    """
+    :return: (name, label) choices for every format whose optional dependency is installed
+    """
+    return [(name, fmt['label']) for name, fmt in FORMATS.items()
+            if 'requires' not in fmt or find_spec(fmt['requires']) is not None]
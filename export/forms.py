@@ -1,5 +1,49 @@
+import datetime
 from django import forms
+from .formats import available_formats
+
+# longest range a single export is allowed to cover
+MAX_RANGE_DAYS = 31
 
 
 class DateForm(forms.Form):
-    date = forms.DateTimeField(input_formats=['%m/%d/%Y'], label="", widget=forms.TextInput(attrs={'id': 'datepicker'}))
+    date = forms.DateTimeField(input_formats=['%m/%d/%Y', '%m/%d/%Y %H:%M'], label="",
+                               widget=forms.TextInput(attrs={'id': 'datepicker'}))
+    end_date = forms.DateTimeField(input_formats=['%m/%d/%Y'], label="Through (optional)", required=False,
+                                   widget=forms.TextInput(attrs={'id': 'enddatepicker'}))
+    hours = forms.IntegerField(label="Or duration in hours (optional)", required=False, min_value=1,
+                               max_value=MAX_RANGE_DAYS * 24)
+    format = forms.ChoiceField(choices=available_formats, initial='csv', label="File format")
+    background = forms.BooleanField(label="Run in the background (for long ranges)", required=False)
+
+    def clean(self):
+        """
+        Works out the range to export and stores it as 'start' and 'stop'. With just a date the range is that one day,
+        an end date makes it run through the end of that day and a duration makes it run that many hours from the
+        start date/time.
+        """
+        cleaned_data = super().clean()
+        start = cleaned_data.get('date')
+        if start is None:
+            return cleaned_data
+        start = start.replace(tzinfo=None)  # the picker is in plant local time, drop the server timezone
+        end_date = cleaned_data.get('end_date')
+        hours = cleaned_data.get('hours')
+
+        if end_date is not None and hours is not None:
+            raise forms.ValidationError("Use either an end date or a duration, not both.")
+        if end_date is not None:
+            stop = datetime.datetime(end_date.year, end_date.month, end_date.day) + datetime.timedelta(days=1)
+        elif hours is not None:
+            stop = start + datetime.timedelta(hours=hours)
+        else:
+            stop = datetime.datetime(start.year, start.month, start.day) + datetime.timedelta(days=1)
+
+        if stop <= start:
+            raise forms.ValidationError("End date is before the start date.")
+        if stop - start > datetime.timedelta(days=MAX_RANGE_DAYS):
+            raise forms.ValidationError(f"Exports are limited to {MAX_RANGE_DAYS} days at a time.")
+
+        cleaned_data['start'] = start
+        cleaned_data['stop'] = stop
+        return cleaned_data
@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import closing, contextmanager
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.resultset import ResultSet
+
+"""
+Connection settings used for any of these a cellconfig entry doesn't set itself.
+"""
+DEFAULT_CONNECTION = {
+    'host': '192.168.10.102',
+    'port': 8086,
+    'username': 'readonly',
+    'password': 'readonly',
+    'timeout': 20,
+}
+
+# bytes read off the socket at a time for chunked responses
+READ_SIZE = 64 * 1024
+
+
+class ClientPool:
+    """
+    Process wide pool of InfluxDB clients keyed by (host, port, username, database). Each client keeps its own
+    keep-alive HTTP session so repeated exports skip the connection handshake. A client is only ever used by the one
+    thread that checked it out, clients that sat idle for a while are pinged before being handed out again and ones
+    idle past idle_timeout are closed.
+    """
+
+    def __init__(self, idle_timeout=300, check_after=30, max_idle=8):
+        """
+        :param idle_timeout: seconds an unused client is kept before it gets closed
+        :param check_after: seconds idle after which a client is pinged before reuse
+        :param max_idle: most unused clients kept per key
+        """
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self.idle = {}  # key -> deque of (client, time it was returned)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def settings(config):
+        """
+        :param config: cellconfig entry
+        :return: connection settings for the entry with the defaults filled in
+        """
+        return {name: config.get(name, default) for name, default in DEFAULT_CONNECTION.items()}
+
+    @contextmanager
+    def client(self, config):
+        """
+        Checks out a client for a cellconfig entry's database for the duration of the with block. If the block raises
+        the client is thrown away instead of going back into the pool.
+        :param config: cellconfig entry
+        """
+        settings = self.settings(config)
+        key = (settings['host'], settings['port'], settings['username'], config['database'])
+        client = self.acquire(key, settings)
+        try:
+            yield client
+        except BaseException:
+            client.close()  # don't hand out a client that may be half way through a response
+            raise
+        self.release(key, client)
+
+    def acquire(self, key, settings) -> InfluxDBClient:
+        while True:
+            with self.lock:
+                self.evict()
+                clients = self.idle.get(key)
+                if not clients:
+                    break
+                client, returned = clients.pop()  # most recently used first, the rest can age out
+
+            if time.monotonic() - returned < self.check_after or self.healthy(client):
+                return client
+            client.close()
+
+        client = InfluxDBClient(**settings)
+        client.switch_database(key[3])
+        return client
+
+    def release(self, key, client):
+        with self.lock:
+            clients = self.idle.setdefault(key, deque())
+            if len(clients) >= self.max_idle:
+                client.close()
+                return
+            clients.append((client, time.monotonic()))
+
+    def evict(self):
+        """
+        Closes clients that have been idle longer than idle_timeout, call with the lock held.
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        for key, clients in list(self.idle.items()):
+            while clients and clients[0][1] < cutoff:
+                clients.popleft()[0].close()
+            if not clients:
+                del self.idle[key]
+
+    @staticmethod
+    def healthy(client) -> bool:
+        try:
+            client.ping()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        """
+        Closes every idle client.
+        """
+        with self.lock:
+            for clients in self.idle.values():
+                for client, _ in clients:
+                    client.close()
+            self.idle.clear()
+
+
+pool = ClientPool()
+
+
+def query_chunks(client, query, database, chunk_size):
+    """
+    Runs a select with a chunked response, one ResultSet per chunk like client.query(chunked=True), but reads the
+    response READ_SIZE bytes at a time and splits lines only in what was just read. influxdb-python reads 512 bytes at a
+    time and splits everything it's holding again on every read, so a chunk's line (about 80 bytes a point) takes time
+    quadratic in chunk_size, seconds for a 10k point chunk.
+    Influx can fail a query part way through, e.g. on max-select-point, after some chunks already went out. That comes
+    as an error in the next chunk and raises, rather than passing for the end of the data.
+    :param client: InfluxDBClient
+    :param query: InfluxQL select
+    :param database: database to run it on
+    :param chunk_size: points per chunk
+    :return: generator of ResultSet
+    :raises InfluxDBClientError: for an error in any chunk
+    """
+    params = {'q': query, 'db': database, 'epoch': 'ns', 'chunked': 'true', 'chunk_size': chunk_size}
+    response = client.request(url='query', method='GET', params=params, stream=True, expected_response_code=200)
+    with closing(response):
+        for line in read_lines(response.iter_content(READ_SIZE)):
+            data = json.loads(line)
+            errors = [data['error']] if 'error' in data else []
+            errors += [result['error'] for result in data.get('results', []) if 'error' in result]
+            if errors:
+                raise InfluxDBClientError(f"{query}: {'; '.join(errors)}")
+            result_set = {}
+            for result in data.get('results', []):
+                for key, value in result.items():
+                    if isinstance(value, list):
+                        result_set.setdefault(key, []).extend(value)
+            yield ResultSet(result_set, raise_errors=True)
+
+
+def read_lines(pieces):
+    """
+    :param pieces: iterable of bytes
+    :return: generator of the non empty lines in them, without the newlines
+    """
+    pending = []
+    for piece in pieces:
+        start = 0
+        end = piece.find(b'\n')
+        while end != -1:
+            pending.append(piece[start:end])
+            line = b''.join(pending)
+            pending = []
+            if line.strip():
+                yield line
+            start = end + 1
+            end = piece.find(b'\n', start)
+        pending.append(piece[start:])
+    line = b''.join(pending)
+    if line.strip():
+        yield line
@@ -0,0 +1,177 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import requests
+from dateutil import tz
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+from django.utils import timezone
+
+from FPIWebsite.metrics import timed_stream
+
+from .formats import FORMATS
+from .models import Exporter, ExportJob, TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+# least seconds between saves of a job's progress, the last query's always gets saved
+PROGRESS_INTERVAL = 1
+
+
+def job_settings():
+    """
+    :return: settings.EXPORT_JOBS with the defaults filled in
+    """
+    options = getattr(settings, 'EXPORT_JOBS', None) or {}
+    return {
+        'DIR': Path(options.get('DIR', Path(settings.BASE_DIR) / 'cache' / 'jobs')),
+        'WORKERS': options.get('WORKERS', 2),
+        'RETENTION': options.get('RETENTION', 24 * 60 * 60),
+        'STALE_AFTER': options.get('STALE_AFTER', 6 * 60 * 60),
+    }
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """
+    :return: the process wide pool background exports run on
+    """
+    return ThreadPoolExecutor(max_workers=job_settings()['WORKERS'], thread_name_prefix='export-job')
+
+
+def submit(cellname, start, stop, format) -> ExportJob:
+    """
+    Creates a job for an export and queues it to run in the background.
+    :param cellname: name of the cellconfig entry
+    :param start: datetime of the start of the range, local time
+    :param stop: datetime of the end of the range, local time
+    :param format: key of FORMATS to write the file as
+    :return: the new job
+    """
+    cleanup_jobs()
+    timezone_ = tz.gettz(TIMEZONE)
+    job = ExportJob.objects.create(cellname=cellname, start=start.replace(tzinfo=timezone_),
+                                   stop=stop.replace(tzinfo=timezone_), format=format)
+    get_executor().submit(run_job, job.pk)
+    return job
+
+
+def run_job(job_id):
+    """
+    Runs one queued job, saving its progress as the queries finish and writing the file to the job directory. Whatever
+    goes wrong ends the job as failed, the executor would otherwise drop the exception and leave it running forever.
+    :param job_id: primary key of the ExportJob
+    """
+    from .views import describe_range, range_filename  # views imports this module
+
+    close_old_connections()
+    tmp = None
+    try:
+        job = ExportJob.objects.get(pk=job_id)
+        job.status = ExportJob.RUNNING
+        job.save(update_fields=['status'])
+
+        job_thread = threading.current_thread()
+        progress_lock = threading.Lock()
+        saved = [0.0]  # when progress was last saved
+
+        def progress(done, total):
+            # called from the fetch threads, one at a time so the updates don't fight each other over sqlite's lock
+            with progress_lock:
+                now = time.monotonic()
+                if done < total and now - saved[0] < PROGRESS_INTERVAL:
+                    return
+                saved[0] = now
+                try:
+                    # the postprocess step after the queries gets the last 10%
+                    ExportJob.objects.filter(pk=job_id).update(progress=0.9 * done / total)
+                except DatabaseError:
+                    logger.warning(f"Couldn't save the progress of export job {job_id}", exc_info=True)  # carry on
+                finally:
+                    if threading.current_thread() is not job_thread:
+                        connection.close()  # the fetch thread's own, nothing else would close it
+
+        timezone_ = tz.gettz(TIMEZONE)
+        start = job.start.astimezone(timezone_).replace(tzinfo=None)
+        stop = job.stop.astimezone(timezone_).replace(tzinfo=None)
+        exporter = Exporter()
+        exporter.progress = progress
+        try:
+            df = exporter.get_range(start, stop, job.cellname)
+            if df is None:
+                finish(job, ExportJob.FAILED, f'No data available for {describe_range(start, stop)}.')
+                return
+
+            fmt = FORMATS[job.format]
+            directory = job_settings()['DIR']
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{job.pk}.{fmt['extension']}"
+            tmp = path.with_suffix(path.suffix + '.tmp')
+            with open(tmp, 'wb') as f:
+                for piece in timed_stream(fmt['writer'](df), 'render', job.cellname):
+                    f.write(piece.encode() if isinstance(piece, str) else piece)
+            os.replace(tmp, path)
+        except requests.exceptions.ConnectionError as e:
+            finish(job, ExportJob.FAILED, f"Connection error occurred with database. Please contact site admin. {e}")
+            return
+        except Exception as e:
+            logger.exception(f"Export job {job_id} failed")
+            finish(job, ExportJob.FAILED, f"Unknown error occurred. {e}")
+            return
+        finally:
+            if tmp is not None and tmp.exists():
+                os.remove(tmp)  # only still there if writing it failed
+
+        job.file = str(path)
+        job.filename = range_filename(job.cellname, start, stop, fmt['extension'])
+        finish(job, ExportJob.DONE)
+    except Exception:
+        logger.exception(f"Export job {job_id} failed")  # the job itself couldn't be loaded or saved
+    finally:
+        close_old_connections()  # this thread's connection would otherwise stay open until the process exits
+
+
+def finish(job, status, message=''):
+    job.status = status
+    job.message = message
+    job.finished = timezone.now()
+    fields = ['status', 'message', 'finished', 'file', 'filename']
+    if status == ExportJob.DONE:
+        job.progress = 1
+        fields.append('progress')
+    job.save(update_fields=fields)
+
+
+def cleanup_jobs(retention=None) -> int:
+    """
+    Fails jobs that have been queued or running for longer than STALE_AFTER seconds, they were lost to a restart, and
+    deletes jobs that finished more than retention seconds ago along with their files.
+    :param retention: seconds to keep finished jobs, defaults to the RETENTION setting
+    :return: number of jobs deleted
+    """
+    options = job_settings()
+    if retention is None:
+        retention = options['RETENTION']
+    now = timezone.now()
+    stale = ExportJob.objects.filter(status__in=[ExportJob.QUEUED, ExportJob.RUNNING],
+                                     created__lt=now - datetime.timedelta(seconds=options['STALE_AFTER']))
+    for job_id in stale.values_list('pk', flat=True):
+        for tmp in options['DIR'].glob(f"{job_id}.*.tmp"):
+            tmp.unlink(missing_ok=True)
+    if stale.update(status=ExportJob.FAILED, message="The export was interrupted, please try again.", finished=now):
+        logger.warning("Marked export jobs that never finished as failed")
+
+    expired = ExportJob.objects.filter(finished__lt=now - datetime.timedelta(seconds=retention))
+    for path in expired.exclude(file='').values_list('file', flat=True):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    count, _ = expired.delete()
+    return count
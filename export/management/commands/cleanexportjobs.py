@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from export.jobs import cleanup_jobs
+
+
+class Command(BaseCommand):
+    help = "Deletes finished background export jobs and their files once they are past the retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=int, default=None,
+                            help="seconds to keep finished jobs, defaults to EXPORT_JOBS['RETENTION']")
+
+    def handle(self, *args, **options):
+        count = cleanup_jobs(options['retention'])
+        self.stdout.write(f"Deleted {count} export job(s).")
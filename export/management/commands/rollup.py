@@ -0,0 +1,60 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from export.models import Exporter
+from export.rollup import get_rollup_store, rollup_range, rollup_recent, yesterday
+
+
+def parse_date(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f"Invalid date {text}, use YYYY-MM-DD")
+
+
+class Command(BaseCommand):
+    help = "Stores finished days of each cell as Parquet rollups so whole day exports don't hit influx. With no " \
+           "dates it fills in any of the last few days that are missing, run it daily from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="roll up one day, YYYY-MM-DD")
+        parser.add_argument('--start', help="first day of a backfill, YYYY-MM-DD")
+        parser.add_argument('--end', help="last day of a backfill (inclusive), defaults to yesterday")
+        parser.add_argument('--cell', action='append', dest='cells', help="cell to roll up, can be repeated")
+        parser.add_argument('--workers', type=int, default=4, help="days processed at once")
+        parser.add_argument('--force', action='store_true', help="rebuild days that are already stored")
+        parser.add_argument('--prune', action='store_true',
+                            help="delete rollups made with older versions of the cell configs")
+
+    def handle(self, *args, **options):
+        store = get_rollup_store()
+        if store is None:
+            raise CommandError("Rollups are turned off, set EXPORT_ROLLUPS and install pyarrow")
+        cellconfig = Exporter().cellconfig
+        for cellname in options['cells'] or []:
+            if cellname not in cellconfig:
+                raise CommandError(f"Unknown cell {cellname}")
+
+        if options['date']:
+            day = parse_date(options['date'])
+            results = rollup_range(day, day, options['cells'], options['workers'], options['force'])
+        elif options['start']:
+            first = parse_date(options['start'])
+            last = parse_date(options['end']) if options['end'] else yesterday()
+            results = rollup_range(first, last, options['cells'], options['workers'], options['force'])
+        else:
+            results = rollup_recent(cells=options['cells'])
+
+        failed = 0
+        for (cellname, day), result in results.items():
+            if isinstance(result, Exception):
+                failed += 1
+                self.stderr.write(f"{cellname} {day}: {result}")
+            elif result:
+                self.stdout.write(f"{cellname} {day}: rolled up")
+        self.stdout.write(f"{sum(result is True for result in results.values())} day(s) rolled up, {failed} failed.")
+
+        if options['prune']:
+            for cellname in options['cells'] or cellconfig:
+                store.prune(cellname, cellconfig[cellname])
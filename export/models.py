@@ -1,43 +1,82 @@
+import contextvars
 import datetime
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from django.conf import settings
 from django.db import models
-from influxdb import InfluxDBClient
 import numpy as np
 from dateutil import tz
+from FPIWebsite.cells import get_registry
+from FPIWebsite.metrics import for_cell, span
+from .cache import get_cache
+from .influx import pool, query_chunks
+from .merge import merge_sorted
+from .processing import get_postprocess_pool
+from .rollup import get_rollup_store
+
+# default number of points per chunk for chunked influx responses, this is influx's own default. Chunks are read with
+# export.influx.query_chunks, influxdb-python's own chunked reader gets quadratically slower with the chunk size
+CHUNK_SIZE = 10_000
+
+# plant time zone, everything is exported in local time
+TIMEZONE = 'America/Chicago'
+
+# how many influx queries a single export can have in flight at once
+QUERY_WORKERS = 4
+
+# Lists of the fields from each cell 7 table that we use.
+CELL7_TRIDENT_FIELDS = ("oil_rh", "s0_magnitude", "s0_phase", "s0_temp_post_ref", "s0_temp_post_sample", "s1_magnitude",
+                        "s1_phase", "s1_temp_post_ref", "s1_temp_post_sample", "s2_magnitude", "s2_phase",
+                        "s2_temp_post_sample", "s3_magnitude", "s3_phase", "s3_temp_post_sample", "s4_magnitude",
+                        "s4_phase", "s4_temp_post_sample", "sweep_count")
+CELL7_TE_FIELDS = ("Density (dm/cc)", "Dialectric constant (-)", "Resistance (Ohms)", "Temperature (C)",
+                   "Viscosity (cp)")
+CELL7_PLC_FIELDS = ('Air_Flow_MLPM', 'Oil_Temp_F', 'Oil_Temp_Cooler_In_F', 'Press_System_PSI',
+                    'Water_Valve_CMD', 'Water_Flow_In_GPM', 'Water_Temp_In_F', "Hours_Counter.ACC",
+                    "Minutes_Counter.ACC", "Seconds_Counter.ACC")
 
 
 class Exporter(models.Model):
 
+    class Meta:
+        managed = False  # nothing is stored, this just holds the export logic
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.client = None
+        self.server_aggregation = getattr(settings, 'EXPORT_SERVER_AGGREGATION', False)
+        self.lean = getattr(settings, 'EXPORT_LEAN_PIPELINE', False)
+        self.progress = None  # optional callback(queries done, total queries) while fetching
 
         """
-        The dictionary below `cellconfig` defines what data to grab where it is and how to process it for each possible
-        export. Here is a list of the attributes: 
+        `cellconfig` is what data to grab where it is and how to process it for each possible export, the "export"
+        sections of the cells file (settings.CELL_REGISTRY, loaded once and shared, don't modify it). Here is a list
+        of the attributes:
         'database' is the database from the server to grab the data from,
-        'host' (optional) is the server to grab from, defaults to localhost
+        'host', 'port', 'username', 'password', 'timeout' (optional) are the connection settings for the server to grab
+        from, anything left out comes from influx.DEFAULT_CONNECTION
         'measurements' is a tuple of what measurements in the influxdb database to pull data from
-        'postprocess' (optional) is a function reference to any specific post processing that needs to be done
-        """
-
-        self.cellconfig = {
-            'cell7': {
-                'database': 'cell7',
-                'postprocess': self.cell7convert,
-                'measurements': ('PLC_Tags', 'TE', 'Trident')
-            },
-            'tribology': {
-                'database': 'data',
-                'host': '10.253.3.20',
-                'measurements': ('TE',)
-            },
-            'cell5': {
-                'database': 'cell5',
-                'postprocess': self.cell5convert,
-                'measurements': ('data1', 'data2')
-            }
-        }
+        'postprocess' (optional) is a function that takes the combined dataframe and does any specific post processing,
+        "module:function" in the file
+        'slice' (optional) is a timedelta, each day is queried in sub-windows of this size instead of all at once
+        'chunk_size' (optional) is how many points influx sends per chunk of a response, defaults to CHUNK_SIZE
+        'concurrent' (optional) set to False to run the queries for an export one after another
+        'max_concurrency' (optional) is the most queries one export runs at once, defaults to QUERY_WORKERS
+        'fields' (optional) is a dict of measurement to the fields postprocess needs, with server side aggregation on
+        only these are selected instead of *
+        'aggregate' (optional) is an interval like '45s' that postprocess resamples to with a plain mean, with server
+        side aggregation on influx does the mean with GROUP BY time() and only the buckets come back. The interval has
+        to divide evenly into an hour so influx's buckets line up with the ones pandas makes from local midnight.
+        'resample' (optional) is the interval postprocess resamples to when it isn't a plain mean, tail exports use it
+        (or 'aggregate') to re-send the last bucket. Same rule about dividing into an hour
+        'tail_context' (optional) is a timedelta of data before the new rows that tail exports also fetch, so post
+        processing that carries state forward (fills, the cell 7 test state) comes out the same as in a full export
+        'downcast' (optional) set to True if the data is fine as float32 and small ints, the lean pipeline then stores
+        it that way to use about half the memory. With the lean pipeline (settings.EXPORT_LEAN_PIPELINE) each chunk from
+        influx is also cut down to 'fields' as it arrives, before anything gets concatenated
+        Timedeltas are written as ISO 8601 durations in the file, e.g. "PT4H".
+        """
+        self.cellconfig = get_registry().export_configs
 
     def get_day(self, day, month, year, cellname) -> pd.DataFrame:
         """
@@ -45,83 +84,350 @@ class Exporter(models.Model):
         :param cellname: name of configuration to use, check the list in the constructor
         :return: dataframe of day of data requested
         """
+        start = datetime.datetime(year, month, day)
+        return self.get_range(start, start + datetime.timedelta(days=1), cellname)
+
+    def get_range(self, start, stop, cellname) -> pd.DataFrame:
+        """
+        Queries the specified test for all data between two local times, which can span any number of days. The whole
+        range is post processed as one piece so resampling carries straight across midnight.
+        :param start: datetime of the start of the range, local time
+        :param stop: datetime of the end of the range, local time
+        :param cellname: name of configuration to use, check the list in the constructor
+        :return: dataframe of the range of data requested
+        """
         if cellname not in self.cellconfig:
-            raise NotImplemented(f"Support for {cellname} not implemented.")
+            raise NotImplementedError(f"Support for {cellname} not implemented.")
         config = self.cellconfig[cellname]
 
-        # get host from config, if no host use default connection
-        if 'host' not in config:
-            host = '192.168.10.102'
+        # re-wrap the times so only the date and time parts of what was passed in get used
+        timezone = tz.gettz(TIMEZONE)
+        start = datetime.datetime(start.year, start.month, start.day, start.hour, start.minute, tzinfo=timezone)
+        stop = datetime.datetime(stop.year, stop.month, stop.day, stop.hour, stop.minute, tzinfo=timezone)
+
+        with for_cell(cellname):
+            # whole past days are usually rolled up already, see rollup.py
+            rollups = get_rollup_store()
+            if rollups is not None and start.hour == start.minute == 0 and stop == start + datetime.timedelta(days=1) \
+                    and stop <= datetime.datetime.now(timezone):
+                with span('rollup') as timing:
+                    df = rollups.get(cellname, start.date(), config)
+                    timing.rows = None if df is None else len(df)
+                if df is not None:
+                    return df
+
+            config = self.options(config)  # also keeps these results apart in the cache
+
+            # finished ranges never change so they can come straight out of the cache
+            cache = get_cache()
+            if cache is not None:
+                key = cache.key(cellname, start, stop, config)
+                with span('cache') as timing:
+                    cached = cache.get(key)
+                    timing.rows = None if cached is None else len(cached)
+                if cached is not None:
+                    return cached
+
+            data = self.timed_fetch(start, stop, config)
+
+            if len(data) > 0:  # make sure there is data before continuing
+                df = self.process(cellname, data, config)
+                if cache is not None:
+                    cache.put(key, df, complete=stop <= datetime.datetime.now(timezone))
+                return df
+
+    def get_tail(self, cellname, since=None, until=None):
+        """
+        Reads only what is new since a cursor, for clients that keep polling a running test. For cells that resample,
+        the bucket the cursor is in gets fetched and sent again since it may have still been filling up last time, and
+        config['tail_context'] of data before it is fetched too so stateful post processing comes out the same as in a
+        full export.
+        :param cellname: name of configuration to use, check the list in the constructor
+        :param since: cursor from the last call, epoch nanoseconds of the last row received. None starts from local
+        midnight today
+        :param until: aware datetime to read up to, defaults to now
+        :return: (dataframe or None if there is nothing new, cursor to pass next time)
+        """
+        if cellname not in self.cellconfig:
+            raise NotImplementedError(f"Support for {cellname} not implemented.")
+        config = self.cellconfig[cellname]
+        config = self.options(config)
+
+        timezone = tz.gettz(TIMEZONE)
+        until = until or datetime.datetime.now(timezone)
+        if since is None:
+            cursor = pd.Timestamp(until.astimezone(timezone).date()).tz_localize(timezone)
+        else:
+            cursor = pd.Timestamp(since, unit='ns', tz='UTC').tz_convert(timezone)
+
+        # resample buckets line up with local midnight, plant offsets are whole hours and intervals divide into an
+        # hour so flooring in utc lands on the same edge
+        interval = config.get('resample', config.get('aggregate'))
+        first = cursor.tz_convert('UTC').floor(interval).tz_convert(timezone) if interval else cursor
+        start = first - config.get('tail_context', datetime.timedelta(0)) - datetime.timedelta(microseconds=1)
+
+        with for_cell(cellname):
+            data = self.timed_fetch(start.to_pydatetime(), until, config)
+            if len(data) == 0:
+                return None, cursor.value
+            df = self.process(cellname, data, config)
+        df = df[df.index >= first] if interval else df[df.index > cursor]
+        if len(df) == 0:
+            return None, cursor.value
+        return df, df.index[-1].value
+
+    def options(self, config) -> dict:
+        """
+        :return: the cellconfig entry with this exporter's settings added, the entry itself if there are none
+        """
+        if self.server_aggregation:
+            config = dict(config, server_aggregation=True)
+        if self.lean:
+            config = dict(config, lean=True)
+        return config
+
+    def process(self, cellname, data, config) -> pd.DataFrame:
+        """
+        Runs combine, on the postprocess pool when there is one and the cell has post processing. Timed as the
+        'combine' stage, the 'merge' and 'postprocess' stages inside it are only recorded when it runs in this process.
+        """
+        with span('combine', cellname) as timing:
+            postprocess_pool = get_postprocess_pool()
+            if postprocess_pool is not None and 'postprocess' in config:
+                df = postprocess_pool.combine(cellname, data)  # keep the heavy pandas work off this process's GIL
+            else:
+                df = self.combine(data, config)
+            timing.rows = len(df)
+        return df
+
+    def timed_fetch(self, start, stop, config):
+        """
+        fetch, timed as the 'query' stage with the rows that came back. Parsing influx's responses happens as they
+        arrive so the 'parse' stage is part of this time.
+        """
+        with span('query') as timing:
+            data = self.fetch(start, stop, config)
+            timing.rows = sum(len(df) for _, df in data)
+        return data
+
+    @staticmethod
+    def split_days(start, stop):
+        """
+        Splits a range into windows that end on local midnights, so a window is 23 or 25 hours long on the days
+        daylight savings changes.
+        :param start: aware datetime of the start of the range
+        :param stop: aware datetime of the end of the range
+        :return: list of (start, stop) datetime pairs
+        """
+        windows = []
+        window_start = start
+        while window_start < stop:
+            next_day = datetime.datetime(window_start.year, window_start.month, window_start.day, tzinfo=start.tzinfo)
+            window_stop = min(next_day + datetime.timedelta(days=1), stop)
+            windows.append((window_start, window_stop))
+            window_start = window_stop
+        return windows
+
+    def combine(self, data, config) -> pd.DataFrame:
+        """
+        Merges the results of every measurement into one time sorted dataframe and runs any post processing.
+        :param data: list of (measurement name, dataframe) pairs in cellconfig order
+        :param config: cellconfig entry the data belongs to
+        :return: finished dataframe
+        """
+        if len(data) > 1:  # if more than one table was read
+            # check if any overlap in columns names between tables
+            cols = [col for _, dataframe in data for col in dataframe.columns]
+
+            # everyone has 'time' column, it comes free with your fucking xbox
+            cols = list(filter(lambda c: c != "time", cols))
+            if len(set(cols)) != len(cols):
+                for measurement, dataframe in data:
+                    # rename all columns with measurement name appended except time column
+                    dataframe.columns = [f"{col}_{measurement}" if col != 'time' else col for col in dataframe.columns]
+
+        frames = [dataframe for _, dataframe in data]
+        if config.get('lean'):
+            data.clear()  # the caller's list was the last thing holding the measurement frames besides this one
+        # each measurement comes back from influx in time order already, so merging them beats concat and a full sort
+        with span('merge') as timing:
+            sorted_data = merge_sorted(frames)
+            timing.rows = len(sorted_data)
+        del frames
+
+        # If this configuration has special post-processing to perform, do it before returning dataframe
+        if 'postprocess' in config:
+            with span('postprocess') as timing:
+                df = config['postprocess'](sorted_data)
+                timing.rows = len(df)
+            return df
         else:
-            host = config['host']
+            return sorted_data
+
+    def fetch(self, start, stop, config):
+        """
+        Reads every measurement of a cellconfig entry between start and stop. The range is split into one query per
+        day (and per config['slice'] within a day) for each measurement and, unless config['concurrent'] is False, the
+        queries run at the same time on a pool of up to config['max_concurrency'] threads. Results are put back
+        together in measurement and time order.
+        :param start: aware datetime of the start of the range (exclusive)
+        :param stop: aware datetime of the end of the range (exclusive)
+        :param config: cellconfig entry to read
+        :return: list of (measurement name, dataframe) pairs in cellconfig order, measurements without data left out
+        """
+        # influx's buckets can't be split between queries, so aggregated queries stick to whole days
+        aggregate = config.get('server_aggregation') and 'aggregate' in config
+        windows = self.split_slices(start, stop, None if aggregate else config.get('slice'))
+        tasks = [(measurement, a, b, a != start) for measurement in config['measurements'] for a, b in windows]
 
-        self.client = InfluxDBClient(host=host, port=8086, username='readonly', password='readonly', timeout=20)
-        self.client.switch_database(config['database'])
+        finished = []
+
+        def run(task):
+            frames = self.query_window(*task, config)
+            finished.append(task)  # list.append is atomic, so this is a safe counter across the pool
+            if self.progress is not None:
+                self.progress(len(finished), len(tasks))
+            return frames
+
+        workers = min(config.get('max_concurrency', QUERY_WORKERS), len(tasks))
+        if config.get('concurrent', True) and workers > 1:
+            # each query gets a copy of this thread's context so its timings still count for this cell and request
+            contexts = [contextvars.copy_context() for _ in tasks]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda context, task: context.run(run, task), contexts, tasks))
+        else:
+            results = [run(task) for task in tasks]
+
+        chunks = {measurement: [] for measurement in config['measurements']}
+        for task, task_frames in zip(tasks, results):
+            chunks[task[0]].extend(task_frames)
+        del results
 
-        timezone = tz.gettz('America/Chicago')
-        todays_date = datetime.datetime(year, month, day, tzinfo=timezone)
-        start_stamp = int(todays_date.timestamp()) * 1_000_000_000
-        stop_date = todays_date + datetime.timedelta(days=1)
-        stop_stamp = int(stop_date.timestamp()) * 1_000_000_000
         data = []
         for measurement in config['measurements']:
-            query = f"select * from {measurement} where time > {start_stamp} and time < {stop_stamp}"
-
-            r = self.client.query(query)
-            if len(r) > 0:
-                df = pd.DataFrame(r.items()[0][1])  # convert result to dataframe
-
-                # if the time ends exactly with zero nanoseconds the conversion does not work.
-                # So we check the rows and add the .000000Z to any row that needs it.
-                # for some godforsaken reason the '.' character needs to be escaped, ignore the warning.
-                mask = ~df.time.str.contains('\.')
-                df.time.values[mask] = df.time[mask].str[:-1] + '.000000Z'
-                df.index = pd.DatetimeIndex(pd.to_datetime(df.time, format="%Y-%m-%dT%H:%M:%S.%fZ") - datetime.timedelta(hours=6))
-
-                data.append(df)  # add to running list of data
-
-        self.client.close()  # close client to prevent memory leaks
-        self.client = None
-        if len(data) > 0:  # make sure there is data before continuing
-            if len(data) > 1:  # if more than one table was read
-                # check if any overlap in columns names between tables
-                cols = [col for dataframe in data for col in dataframe.columns]
-
-                # everyone has 'time' column, it comes free with your fucking xbox
-                cols = list(filter(lambda c: c != "time", cols))
-                if len(set(cols)) != len(cols):
-                    for i, dataframe in enumerate(data):
-                        # rename all columns with measurement name appended except time column
-                        dataframe.columns = [f"{col}_{config['measurements'][i]}" if col != 'time' else col for col in dataframe.columns]
-
-                data = pd.concat(data)  # combine all results from all queries
-            sorted_data = data.sort_index()
-
-            # If this configuration has special post-processing to perform, do it before returning dataframe
-            if 'postprocess' in config:
-                return config['postprocess'](sorted_data)
-            else:
-                return sorted_data
+            frames = chunks.pop(measurement)  # so each measurement's chunks can be freed once they're concatenated
+            if len(frames) > 0:
+                data.append((measurement, pd.concat(frames) if len(frames) > 1 else frames[0]))
+        return data
 
-    def close(self):
+    @classmethod
+    def split_slices(cls, start, stop, step=None):
         """
-        This exists so the connection can be closed if there is an error, get_day closes the connection at the end
-        but not when there is an error.
+        Splits a range into days with split_days and then each day into pieces no longer than step.
+        :param start: aware datetime of the start of the range
+        :param stop: aware datetime of the end of the range
+        :param step: timedelta, longest piece to make, None to keep whole days
+        :return: list of (start, stop) datetime pairs
         """
-        if self.client is not None:
-            self.client.close()
+        slices = []
+        for day_start, day_stop in cls.split_days(start, stop):
+            slice_start = day_start
+            while slice_start < day_stop:
+                slice_stop = day_stop if step is None else min(slice_start + step, day_stop)
+                slices.append((slice_start, slice_stop))
+                slice_start = slice_stop
+        return slices
+
+    def query_window(self, measurement, start, stop, include_start, config) -> list:
+        """
+        Queries one measurement between start and stop. The response is read back in chunks of config['chunk_size']
+        points, so each piece is parsed as it arrives and no single response has to hold the whole window.
+        :param measurement: name of the measurement to read
+        :param start: datetime of the start of the window
+        :param stop: datetime of the end of the window (exclusive)
+        :param include_start: include points exactly at start, used when picking up where another window stopped
+        :param config: cellconfig entry the measurement belongs to
+        :return: list of dataframes indexed by time, one per chunk
+        """
+        query = self.build_query(measurement, start, stop, include_start, config)
+
+        # with server side aggregation influx already only sends the fields
+        wanted = config.get('fields', {}).get(measurement) if not config.get('server_aggregation') else None
+
+        frames = []
+        with pool.client(config) as client:
+            for chunk in query_chunks(client, query, config['database'], config.get('chunk_size', CHUNK_SIZE)):
+                for _, points in chunk.items():
+                    with span('parse') as timing:
+                        df = self.to_frame(points)
+                        timing.rows = len(df)
+                    if config.get('lean'):
+                        if wanted is not None:
+                            df = df[[col for col in df.columns if col in wanted]]
+                        if config.get('downcast'):
+                            df = self.downcast(df)
+                    frames.append(df)
+
+        if config.get('server_aggregation'):
+            for df in frames:
+                if 'aggregate' in config and measurement not in config.get('fields', {}):
+                    df.columns = [col[len('mean_'):] for col in df.columns]  # mean(*) names every column mean_<field>
+                if measurement in config.get('fields', {}):
+                    # influx hands back a column for every selected field, drop the ones the measurement doesn't have
+                    # so postprocess sees the same columns it would from select *
+                    df.dropna(axis=1, how='all', inplace=True)
+        return frames
+
+    @staticmethod
+    def build_query(measurement, start, stop, include_start, config) -> str:
+        """
+        Builds the select for one window. Normally that is every field of every raw point, with server side
+        aggregation on it's only config['fields'] and, for configs with an 'aggregate' interval, their means per bucket.
+        :return: InfluxQL query string
+        """
+        fields = config.get('fields', {}).get(measurement) if config.get('server_aggregation') else None
+        aggregate = config.get('aggregate') if config.get('server_aggregation') else None
+
+        if fields is None:
+            selection = 'mean(*)' if aggregate else '*'
+        else:
+            quoted = ['"' + field.replace('"', '\\"') + '"' for field in fields]
+            selection = ', '.join(f'mean({field}) AS {field}' if aggregate else field for field in quoted)
 
-    def cell7convert(self, df: pd.DataFrame) -> pd.DataFrame:
+        op = '>=' if include_start else '>'
+        query = f"select {selection} from {measurement} where time {op} {int(start.timestamp()) * 1_000_000_000} " \
+                f"and time < {int(stop.timestamp()) * 1_000_000_000}"
+        if aggregate:
+            query += f" group by time({aggregate}) fill(none)"
+        return query
+
+    @staticmethod
+    def to_frame(points) -> pd.DataFrame:
+        """
+        Converts the points from one influx series into a dataframe indexed by local time. The queries ask for epoch
+        nanosecond timestamps so this is one vectorized conversion, and the time zone handles daylight savings.
+        :param points: iterable of point dicts from a ResultSet
+        :return: dataframe of the points
+        """
+        df = pd.DataFrame(points)  # convert result to dataframe
+        times = pd.to_datetime(df.pop('time'), unit='ns', utc=True)
+        df.index = pd.DatetimeIndex(times, name='time').tz_convert(TIMEZONE)
+        return df
+
+    @staticmethod
+    def downcast(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Stores float columns as float32 and int columns as the smallest int type that fits them.
+        :param df: dataframe to shrink
+        :return: new dataframe, columns of other types are left alone
+        """
+        columns = {}
+        for col in df.columns:
+            kind = df[col].dtype.kind
+            if kind == 'f':
+                columns[col] = df[col].astype(np.float32)
+            elif kind in 'iu':
+                columns[col] = pd.to_numeric(df[col], downcast='integer')
+            else:
+                columns[col] = df[col]
+        return pd.DataFrame(columns, index=df.index)
+
+    @staticmethod
+    def cell7convert(df: pd.DataFrame) -> pd.DataFrame:
         # Lists of the columns from each table that we use.
-        trident_cols = ["oil_rh", "s0_magnitude", "s0_phase", "s0_temp_post_ref", "s0_temp_post_sample", "s1_magnitude",
-                        "s1_phase", "s1_temp_post_ref", "s1_temp_post_sample", "s2_magnitude", "s2_phase",
-                        "s2_temp_post_sample", "s3_magnitude", "s3_phase", "s3_temp_post_sample", "s4_magnitude",
-                        "s4_phase", "s4_temp_post_sample", "sweep_count"]
-        te_cols = ["Density (dm/cc)", "Dialectric constant (-)", "Resistance (Ohms)", "Temperature (C)",
-                   "Viscosity (cp)"]
-        main_cols = ['time', 'Air_Flow_MLPM', 'Oil_Temp_F', 'Oil_Temp_Cooler_In_F', 'Press_System_PSI',
-                     'Water_Valve_CMD', 'Water_Flow_In_GPM', 'Water_Temp_In_F', "Hours_Counter.ACC",
-                     "Minutes_Counter.ACC", "Seconds_Counter.ACC"]
+        trident_cols = list(CELL7_TRIDENT_FIELDS)
+        te_cols = list(CELL7_TE_FIELDS)
+        main_cols = list(CELL7_PLC_FIELDS)
         # this column was added so if the day requested is a while ago it won't exist
         if "Water_Temp_Out_F" in df.columns:
             main_cols.append("Water_Temp_Out_F")
@@ -145,52 +451,85 @@ class Exporter(models.Model):
         if te_present:
             columns_needed += te_cols
 
-        # Index the original dataframe with these columns to drop the columns we won't use.
-        df2 = df[columns_needed]
-
-        # very complex way of trimming out parts when the test is not running
-        good_rows = df.Testing_HMI == 1
-        on = df.Testing_HMI[0] == True
-        for i in range(len(df.Testing_HMI)):
-            row = df.Testing_HMI[i]
-            if on and row == False:
-                on = False
-            elif on:
-                good_rows[i] = True
-            elif row == True:
-                on = True
-                good_rows[i] = True
-        df2 = df2[good_rows]
+        # trim out the parts when the test is not running. Testing_HMI going to 1 turns the test on and 0 turns it off,
+        # rows from the other tables (NaN) and anything else keep whatever state the test was last in
+        hmi = df.Testing_HMI.to_numpy()
+        state = np.full(len(hmi), np.nan)
+        state[hmi == 1] = 1
+        state[hmi == 0] = 0
+        good_rows = pd.Series(state).ffill().fillna(0).to_numpy(dtype=bool)
+
+        # take the running rows and only the columns we use in one go, so the frame is only copied once
+        df2 = df.iloc[np.flatnonzero(good_rows), df.columns.get_indexer(columns_needed)]
 
         # resample with rate of 100s (approx rate of the trident sensor)
         df2 = df2.resample("100S").mean(numeric_only=True).dropna(how='all')
 
-        # add test elapse time column
-        df2['Elapse Hours'] = df2["Hours_Counter.ACC"] + df2["Minutes_Counter.ACC"] / 60 + df2["Seconds_Counter.ACC"] / 3600
-
-        df2 = df2[['Elapse Hours'] + df2.columns.tolist()[:-1]]  # move elapse to first column
-
-        # this whole block here is to fill in the time when the plc is not logging but is still running
-        in_nan_range = False
-        last = start = 0
-        for i in range(1, len(df2['Elapse Hours'])):
-            v = df2['Elapse Hours'][i]
-            if not in_nan_range and np.isnan(v):
-                in_nan_range = True
-                start = i
-                if i != 1:
-                    last = df2['Elapse Hours'][i - 1]
-            elif in_nan_range and not np.isnan(v):
-                in_nan_range = False
-                df2['Elapse Hours'][start - 1:i + 1] = np.linspace(last, df2['Elapse Hours'][i], i - start + 2)
+        # add test elapse time column as the first column, filling in the time when the plc is not logging but is
+        # still running
+        elapse = df2["Hours_Counter.ACC"] + df2["Minutes_Counter.ACC"] / 60 + df2["Seconds_Counter.ACC"] / 3600
+        df2.insert(0, 'Elapse Hours', Exporter.fill_gaps(elapse.to_numpy()))
 
         # drop the other time columns
-        df2.drop(["Hours_Counter.ACC", "Minutes_Counter.ACC", "Seconds_Counter.ACC"], axis=1, inplace=True)
+        df2 = df2.drop(["Hours_Counter.ACC", "Minutes_Counter.ACC", "Seconds_Counter.ACC"], axis=1)
 
-        df2.fillna(method='ffill', inplace=True)  # fill the nan values with the previous valid value
-        return df2
+        return df2.fillna(method='ffill')  # fill the nan values with the previous valid value
+
+    @staticmethod
+    def fill_gaps(values: np.ndarray) -> np.ndarray:
+        """
+        Fills each run of NaNs that has a value on both sides with evenly spaced values between those two values, the
+        same numbers np.linspace would give. Runs at the end are left for the forward fill. A run that starts on the
+        second row is drawn up from 0 rather than from the first row.
+        :param values: array of floats with gaps
+        :return: new array with the gaps filled
+        """
+        values = np.array(values, dtype=float)
+        missing = np.isnan(values)
+        if len(values) < 2 or missing[1:].all():
+            return values
+        if missing[1]:
+            values[0] = 0
+            missing[0] = False
+
+        positions = np.arange(len(values))
+        # position of the closest valid value before and after every row
+        before = np.maximum.accumulate(np.where(missing, -1, positions))
+        after = np.minimum.accumulate(np.where(missing, len(values), positions)[::-1])[::-1]
+        fill = missing & (before >= 0) & (after < len(values))
 
-    def cell5convert(self, df):
+        left, right = before[fill], after[fill]
+        step = (values[right] - values[left]) / (right - left)
+        values[fill] = (positions[fill] - left) * step + values[left]
+        return values
+
+    @staticmethod
+    def cell5convert(df):
         # resample with rate of 45s (approx rate of the trident sensor)
         df2 = df.resample("45S").mean(numeric_only=True).dropna(how='all')
-        return df2
\ No newline at end of file
+        return df2
+
+
+class ExportJob(models.Model):
+    """
+    An export running in the background, see jobs.py. start and stop are stored as aware datetimes and handed to the
+    exporter as local times.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    cellname = models.CharField(max_length=50)
+    start = models.DateTimeField()
+    stop = models.DateTimeField()
+    format = models.CharField(max_length=20)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    progress = models.FloatField(default=0)
+    message = models.TextField(blank=True)
+    file = models.CharField(max_length=255, blank=True)
+    filename = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
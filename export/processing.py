@@ -0,0 +1,181 @@
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from multiprocessing.shared_memory import SharedMemory
+
+from django.conf import settings
+
+
+class PostprocessPool:
+    """
+    Pool of worker processes that run the combine and postprocess step of an export, so the pandas work of several
+    exports at once isn't all fighting over the web server's GIL. The raw measurement frames are pickled with protocol
+    5 and their column data is handed over through shared memory instead of through the pipe, the finished frame comes
+    back the same way. Workers are started with spawn (forking a process full of threads isn't safe) and import django
+    and pandas once when they start, not once per export.
+    """
+
+    def __init__(self, workers, timeout=None):
+        """
+        :param workers: number of worker processes
+        :param timeout: seconds one export's postprocess is allowed to take, None for no limit
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=setup_worker,
+                                                    initargs=(os.environ.get('DJANGO_SETTINGS_MODULE'),))
+                for _ in range(self.workers):
+                    self.executor.submit(os.getpid)  # starts every worker now rather than on the first export
+            return self.executor
+
+    def combine(self, cellname, data):
+        """
+        Runs Exporter.combine for a cell in a worker process.
+        :param cellname: name of the cellconfig entry the data belongs to
+        :param data: list of (measurement name, dataframe) pairs from Exporter.fetch
+        :return: finished dataframe
+        """
+        header, name, spans = pack(data)
+        try:
+            executor = self.get_executor()
+            future = executor.submit(combine_in_worker, cellname, header, name, spans)
+            try:
+                result = future.result(timeout=self.timeout)
+            except TimeoutError:
+                self.reset(executor)  # the only way to stop a runaway worker is to replace the pool
+                raise TimeoutError(f"{cellname} post processing took longer than {self.timeout} seconds")
+            except BrokenProcessPool:
+                self.reset(executor)  # a worker died, start over with a fresh pool next time
+                raise
+        finally:
+            discard(name)
+
+        return receive(*result)
+
+    def reset(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        for process in list(getattr(executor, '_processes', {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def setup_worker(settings_module):
+    if settings_module:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+    from . import models  # noqa: F401 pulls in pandas and numpy
+
+
+def combine_in_worker(cellname, header, name, spans):
+    from .models import Exporter
+
+    data, shm = unpack(header, name, spans)
+    try:
+        exporter = Exporter()
+        result = pack(exporter.combine(data, exporter.cellconfig[cellname]))
+        del data
+    finally:
+        if shm is not None:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # something still points into it (e.g. a traceback), it gets unmapped when that is collected
+    return result
+
+
+def pack(obj):
+    """
+    Pickles an object with protocol 5, large buffers like numpy arrays are copied into one block of shared memory
+    instead of into the pickle itself. Whoever ends up with the name has to unlink the shared memory.
+    :param obj: object to pickle
+    :return: (pickle bytes, shared memory name or None, list of (offset, length) of each buffer)
+    """
+    buffers = []
+    header = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    views = [buffer.raw() for buffer in buffers]
+    size = sum(view.nbytes for view in views)
+    if not size:
+        return header, None, []
+
+    shm = SharedMemory(create=True, size=size)
+    spans = []
+    offset = 0
+    for view in views:
+        shm.buf[offset:offset + view.nbytes] = view
+        spans.append((offset, view.nbytes))
+        offset += view.nbytes
+    del views
+    shm.close()
+    return header, shm.name, spans
+
+
+def unpack(header, name, spans):
+    """
+    Reverse of pack. The object reads its buffers straight out of the shared memory, close the returned SharedMemory
+    once the object isn't needed anymore.
+    :return: (object, SharedMemory or None)
+    """
+    if name is None:
+        return pickle.loads(header), None
+    shm = SharedMemory(name=name)
+    return pickle.loads(header, buffers=[shm.buf[offset:offset + length] for offset, length in spans]), shm
+
+
+def receive(header, name, spans):
+    """
+    Unpickles what a worker packed and frees the shared memory. The buffers are copied out first so nothing in the
+    object still points into the shared memory once it's gone.
+    :return: the object
+    """
+    if name is None:
+        return pickle.loads(header)
+    shm = SharedMemory(name=name)
+    try:
+        buffers = [bytearray(shm.buf[offset:offset + length]) for offset, length in spans]
+    finally:
+        shm.close()
+        shm.unlink()
+    return pickle.loads(header, buffers=buffers)
+
+
+def discard(name):
+    if name is None:
+        return
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+@lru_cache(maxsize=None)
+def get_postprocess_pool():
+    """
+    :return: the process wide PostprocessPool built from settings.EXPORT_POSTPROCESS, None if it is turned off
+    """
+    options = getattr(settings, 'EXPORT_POSTPROCESS', None)
+    if not options or not options.get('WORKERS'):
+        return None
+    return PostprocessPool(options['WORKERS'], options.get('TIMEOUT'))
@@ -0,0 +1,173 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib.util import find_spec
+from pathlib import Path
+
+import pandas as pd
+from dateutil import tz
+from django.conf import settings
+
+from .cache import config_version
+
+logger = logging.getLogger(__name__)
+
+
+class RollupStore:
+    """
+    Finished exports of whole past days, one Parquet file per cell and day under
+    <directory>/<cellname>/<config version>/<YYYY-MM-DD>.parquet. The version is the same hash the export cache uses,
+    so editing a cellconfig entry or its postprocess function makes the old rollups miss until they're rebuilt. Days
+    without any data aren't stored, they go to influx every time, points can still turn up late or the query may have
+    come back empty for some other reason.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def folder(self, cellname, config) -> Path:
+        return self.directory / cellname / config_version(config)[:16]
+
+    def get(self, cellname, day, config):
+        """
+        :param cellname: name of the cellconfig entry
+        :param day: date of the rollup
+        :param config: the cellconfig entry
+        :return: the day's dataframe, None if it isn't rolled up
+        """
+        path = self.folder(cellname, config) / f"{day.isoformat()}.parquet"
+        try:
+            df = pd.read_parquet(path)
+        except FileNotFoundError:
+            return None
+        from .models import TIMEZONE
+        df.index = df.index.tz_convert(TIMEZONE)  # parquet hands the zone back as a different tzinfo type
+        return df
+
+    def put(self, cellname, day, config, df):
+        """
+        Stores a day, written to a temporary file of its own first so a reader never sees half of one and two runs
+        rolling up the same day at once don't write over each other's.
+        :param df: the finished export for the day
+        """
+        folder = self.folder(cellname, config)
+        folder.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                df.to_parquet(f)
+            os.replace(tmp, folder / f"{day.isoformat()}.parquet")
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def prune(self, cellname, config) -> int:
+        """
+        Deletes the rollups made with any other version of a cellconfig entry.
+        :return: number of versions deleted
+        """
+        current = self.folder(cellname, config)
+        count = 0
+        for folder in (self.directory / cellname).glob('*'):
+            if folder.is_dir() and folder != current:
+                shutil.rmtree(folder)
+                count += 1
+        return count
+
+
+@lru_cache(maxsize=None)
+def get_rollup_store():
+    """
+    :return: the RollupStore built from settings.EXPORT_ROLLUPS, None if it's turned off or pyarrow isn't installed
+    """
+    options = getattr(settings, 'EXPORT_ROLLUPS', None)
+    if not options or find_spec('pyarrow') is None:
+        return None
+    return RollupStore(options['DIR'])
+
+
+def rollup_day(cellname, day, force=False) -> bool:
+    """
+    Runs the export for one finished day and stores it. Goes straight to fetch and post processing so it doesn't
+    read back an old rollup or fill the export cache with every day of a backfill.
+    :param cellname: name of the cellconfig entry
+    :param day: date to roll up, has to be over already in plant time
+    :param force: rebuild it even if it's already stored
+    :return: True if the day was stored, False if it was already there or had no data
+    """
+    from .models import Exporter, TIMEZONE
+
+    store = get_rollup_store()
+    if store is None:
+        raise RuntimeError("Rollups are turned off, set EXPORT_ROLLUPS and install pyarrow")
+    exporter = Exporter()
+    config = exporter.cellconfig[cellname]
+    if not force and store.get(cellname, day, config) is not None:
+        return False
+
+    timezone = tz.gettz(TIMEZONE)
+    start = datetime.datetime(day.year, day.month, day.day, tzinfo=timezone)
+    stop = start + datetime.timedelta(days=1)
+    if stop > datetime.datetime.now(timezone):
+        raise ValueError(f"{day} isn't over yet")
+
+    data = exporter.fetch(start, stop, config)
+    if len(data) == 0:
+        return False
+    store.put(cellname, day, config, exporter.process(cellname, data, config))
+    return True
+
+
+def rollup_range(first, last, cells=None, workers=4, force=False) -> dict:
+    """
+    Rolls up every day from first through last for each cell, several days at once. Each day's post processing goes
+    through the postprocess pool when that is turned on, so the threads here mostly just wait on influx.
+    :param first: first date
+    :param last: last date, inclusive
+    :param cells: names of the cellconfig entries, None for all of them
+    :param workers: days worked on at once
+    :param force: rebuild days that are already stored
+    :return: dict of (cellname, date) to what rollup_day returned, or the exception it failed with
+    """
+    from .models import Exporter
+
+    cells = cells or list(Exporter().cellconfig)
+    days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+    tasks = [(cellname, day) for cellname in cells for day in days]
+
+    def run(task):
+        try:
+            return rollup_day(*task, force=force)
+        except Exception as e:
+            logger.exception(f"Rollup of {task[0]} for {task[1]} failed")
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(tasks, executor.map(run, tasks)))
+
+
+def rollup_recent(days=None, cells=None) -> dict:
+    """
+    Scheduler entry point, rolls up any of the last few finished days that are missing. Meant to be called once a day
+    shortly after midnight (cron running `manage.py rollup` or anything that can call a function), catching up
+    automatically if a run was missed.
+    :param days: how many days back to check, defaults to EXPORT_ROLLUPS['CATCH_UP_DAYS']
+    :param cells: names of the cellconfig entries, None for all of them
+    :return: same as rollup_range
+    """
+    if days is None:
+        days = (getattr(settings, 'EXPORT_ROLLUPS', None) or {}).get('CATCH_UP_DAYS', 7)
+    last = yesterday()
+    return rollup_range(last - datetime.timedelta(days=days - 1), last, cells)
+
+
+def yesterday():
+    """
+    :return: the date of the last finished day in plant time
+    """
+    from .models import TIMEZONE
+    return datetime.datetime.now(tz.gettz(TIMEZONE)).date() - datetime.timedelta(days=1)
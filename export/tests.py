@@ -1,3 +1,909 @@
-from django.test import TestCase
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from dateutil import tz
+from django.core.management import call_command
+from django.db import OperationalError
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from influxdb.exceptions import InfluxDBClientError
+from unittest import mock
 
-# Create your tests here.
+from .cache import ExportCache
+from .formats import FORMATS, available_formats, stream_csv
+from .forms import MAX_RANGE_DAYS, DateForm
+from . import jobs
+from .influx import ClientPool, query_chunks, read_lines
+from .merge import merge_sorted
+from .models import Exporter, ExportJob
+from .processing import PostprocessPool, pack, receive
+from .rollup import RollupStore, rollup_range
+from FPIWebsite.cells import get_registry
+from FPIWebsite.metrics import Metrics
+
+TRIDENT_COLS = ["oil_rh", "s0_magnitude", "s0_phase", "s0_temp_post_ref", "s0_temp_post_sample", "s1_magnitude",
+                "s1_phase", "s1_temp_post_ref", "s1_temp_post_sample", "s2_magnitude", "s2_phase",
+                "s2_temp_post_sample", "s3_magnitude", "s3_phase", "s3_temp_post_sample", "s4_magnitude",
+                "s4_phase", "s4_temp_post_sample", "sweep_count"]
+TE_COLS = ["Density (dm/cc)", "Dialectric constant (-)", "Resistance (Ohms)", "Temperature (C)", "Viscosity (cp)"]
+PLC_COLS = ['Air_Flow_MLPM', 'Oil_Temp_F', 'Oil_Temp_Cooler_In_F', 'Press_System_PSI', 'Water_Valve_CMD',
+            'Water_Flow_In_GPM', 'Water_Temp_In_F', 'Water_Temp_Out_F']
+
+
+def synthetic_cell7(rows, seed=0):
+    """
+    Builds a sorted frame shaped like the combined PLC_Tags/TE/Trident result get_day hands to cell7convert. The PLC
+    logs about once a second with the test switching on and off and a few long logging outages, TE every 30 rows and
+    Trident every 100.
+    :param rows: number of PLC rows
+    :param seed: random seed
+    :return: dataframe indexed by time
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2023-03-01')
+
+    plc_times = start + pd.to_timedelta(np.cumsum(rng.uniform(0.5, 1.5, rows)), unit='s')
+    plc = pd.DataFrame(rng.normal(100, 10, (rows, len(PLC_COLS))), columns=PLC_COLS, index=plc_times)
+    hmi = np.zeros(rows)
+    for run_start in range(rows // 20, rows, rows // 5):
+        hmi[run_start:run_start + rows // 8] = 1
+    plc['Testing_HMI'] = hmi
+    elapsed = np.cumsum(hmi) + 3600  # seconds of test time so far
+    plc["Hours_Counter.ACC"] = elapsed // 3600
+    plc["Minutes_Counter.ACC"] = (elapsed % 3600) // 60
+    plc["Seconds_Counter.ACC"] = elapsed % 60
+    plc['time'] = plc.index.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    # knock out a few stretches of plc logging while the other sensors keep going
+    keep = np.ones(rows, dtype=bool)
+    for outage in range(rows // 10, rows, rows // 4):
+        keep[outage:outage + 400] = False
+    plc = plc[keep]
+
+    span = (plc_times[-1] - start).total_seconds()
+    te_times = start + pd.to_timedelta(np.arange(0, span, 30) + 0.25, unit='s')
+    te = pd.DataFrame(rng.normal(1, 0.1, (len(te_times), len(TE_COLS))), columns=TE_COLS, index=te_times)
+    trident_times = start + pd.to_timedelta(np.arange(0, span, 100) + 0.5, unit='s')
+    trident = pd.DataFrame(rng.normal(5, 1, (len(trident_times), len(TRIDENT_COLS))), columns=TRIDENT_COLS,
+                           index=trident_times)
+
+    return pd.concat([plc, te, trident]).sort_index()
+
+
+def cell7_series(df):
+    """
+    Splits a synthetic combined cell 7 frame back into the three measurements influx would have.
+    """
+    times = df.index.tz_localize('America/Chicago').asi8
+    tables = {'PLC_Tags': PLC_COLS + ['Testing_HMI', "Hours_Counter.ACC", "Minutes_Counter.ACC",
+                                      "Seconds_Counter.ACC"],
+              'TE': TE_COLS, 'Trident': TRIDENT_COLS}
+    series = {}
+    for measurement, cols in tables.items():
+        cols = [col for col in cols if col in df.columns]
+        rows = df[cols].notna().any(axis=1).to_numpy()
+        series[measurement] = pd.DataFrame({'time': times[rows], **{col: df[col].to_numpy()[rows] for col in cols}})
+    series['PLC_Tags']['Unused_Tag'] = 1.0  # something only select * picks up
+    return series
+
+
+class FakeInfluxClient:
+    """
+    Stand-in for InfluxDBClient that answers the exporter's select queries from in memory series, with the chunked
+    JSON lines a real influx sends.
+    :param series: dict of measurement name to dataframe with an integer epoch ns 'time' column
+    :param read_size: most bytes handed out per read of a response, None for whatever is asked for
+    """
+
+    def __init__(self, series, read_size=None):
+        self.series = series
+        self.read_size = read_size
+        self.queries = []
+        self.closed = False
+
+    def switch_database(self, database):
+        pass
+
+    def ping(self):
+        return '1.8'
+
+    def close(self):
+        self.closed = True
+
+    def select(self, query):
+        """
+        :return: (measurement, dataframe with a 'time' column) answering the query
+        """
+        self.queries.append(query)
+        match = re.fullmatch(r"select (.+) from (\w+) where time (>=?) (\d+) and time < (\d+)"
+                             r"(?: group by time\((\d+)s\) fill\(none\))?", query)
+        selection, measurement, op, start, stop, interval = match.groups()
+        df = self.series.get(measurement, pd.DataFrame({'time': []}))
+        after = df.time >= int(start) if op == '>=' else df.time > int(start)
+        df = df[after & (df.time < int(stop))]
+
+        if selection not in ('*', 'mean(*)'):
+            fields = list(dict.fromkeys(re.findall(r'"((?:[^"\\]|\\.)*)"', selection)))
+            df = df.reindex(columns=['time'] + fields)  # like influx, fields the measurement lacks come back null
+        if interval is not None:
+            buckets = df.time // (int(interval) * 1_000_000_000) * (int(interval) * 1_000_000_000)
+            df = df.drop(columns='time').astype(float).groupby(buckets).mean().dropna(how='all')
+            if selection == 'mean(*)':
+                df.columns = [f'mean_{col}' for col in df.columns]
+            df = df.rename_axis('time').reset_index()
+        return measurement, df
+
+    def request(self, url, method='GET', params=None, data=None, stream=False, expected_response_code=200):
+        measurement, df = self.select(params['q'])
+        chunk_size = int(params.get('chunk_size') or 10_000)
+        lines = []
+        for i in range(0, len(df), chunk_size):
+            part = df.iloc[i:i + chunk_size].astype(object)
+            values = part.where(part.notna(), None).values.tolist()  # influx sends missing fields as null
+            series = {'name': measurement, 'columns': list(part.columns), 'values': values}
+            lines.append(json.dumps({'results': [{'statement_id': 0, 'series': [series]}]}).encode() + b'\n')
+        return FakeResponse(b''.join(lines), self.read_size)
+
+
+class FakeResponse:
+
+    def __init__(self, content, read_size=None):
+        self.content = content
+        self.read_size = read_size
+        self.reads = 0
+
+    def iter_content(self, chunk_size=1):
+        size = min(chunk_size, self.read_size or chunk_size)
+        for i in range(0, len(self.content), size):
+            self.reads += 1
+            yield self.content[i:i + size]
+
+    def close(self):
+        pass
+
+
+def legacy_cell7convert(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The original row by row cell7convert, kept as the reference the vectorized version has to match.
+    """
+    main_cols = ['time', 'Air_Flow_MLPM', 'Oil_Temp_F', 'Oil_Temp_Cooler_In_F', 'Press_System_PSI',
+                 'Water_Valve_CMD', 'Water_Flow_In_GPM', 'Water_Temp_In_F', "Hours_Counter.ACC",
+                 "Minutes_Counter.ACC", "Seconds_Counter.ACC"]
+    if "Water_Temp_Out_F" in df.columns:
+        main_cols.append("Water_Temp_Out_F")
+    columns_needed = main_cols
+    if all(col in df.columns for col in TRIDENT_COLS):
+        columns_needed += TRIDENT_COLS
+    if all(col in df.columns for col in TE_COLS):
+        columns_needed += TE_COLS
+    df2 = df[columns_needed]
+
+    good_rows = df.Testing_HMI == 1
+    on = df.Testing_HMI[0] == True
+    for i in range(len(df.Testing_HMI)):
+        row = df.Testing_HMI[i]
+        if on and row == False:
+            on = False
+        elif on:
+            good_rows[i] = True
+        elif row == True:
+            on = True
+            good_rows[i] = True
+    df2 = df2[good_rows]
+
+    df2 = df2.resample("100S").mean(numeric_only=True).dropna(how='all')
+    df2['Elapse Hours'] = df2["Hours_Counter.ACC"] + df2["Minutes_Counter.ACC"] / 60 + df2["Seconds_Counter.ACC"] / 3600
+    df2 = df2[['Elapse Hours'] + df2.columns.tolist()[:-1]]
+
+    in_nan_range = False
+    last = start = 0
+    for i in range(1, len(df2['Elapse Hours'])):
+        v = df2['Elapse Hours'][i]
+        if not in_nan_range and np.isnan(v):
+            in_nan_range = True
+            start = i
+            if i != 1:
+                last = df2['Elapse Hours'][i - 1]
+        elif in_nan_range and not np.isnan(v):
+            in_nan_range = False
+            df2['Elapse Hours'][start - 1:i + 1] = np.linspace(last, df2['Elapse Hours'][i], i - start + 2)
+
+    df2.drop(["Hours_Counter.ACC", "Minutes_Counter.ACC", "Seconds_Counter.ACC"], axis=1, inplace=True)
+    df2.fillna(method='ffill', inplace=True)
+    return df2
+
+
+def legacy(df):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return legacy_cell7convert(df)
+
+
+class Cell7ConvertTests(SimpleTestCase):
+
+    def test_matches_legacy_output(self):
+        df = synthetic_cell7(20_000)
+        pd.testing.assert_frame_equal(Exporter().cell7convert(df), legacy(df), check_exact=True)
+
+    def test_matches_legacy_when_test_starts_running(self):
+        # first rows are from the other tables and the test is already running when the plc shows up
+        df = synthetic_cell7(5_000, seed=1)
+        df.loc[df.index[df.Testing_HMI.notna()][0], 'Testing_HMI'] = 1
+        pd.testing.assert_frame_equal(Exporter().cell7convert(df), legacy(df), check_exact=True)
+
+    def test_fill_gaps(self):
+        nan = np.nan
+        values = np.array([1, 2, nan, nan, 5, nan, 9, nan])
+        np.testing.assert_array_equal(Exporter.fill_gaps(values), [1, 2, 3, 4, 5, 7, 9, nan])
+
+        # a gap starting on the second row is drawn up from zero, like the original loop did
+        np.testing.assert_array_equal(Exporter.fill_gaps(np.array([7, nan, 2])), [0, 1, 2])
+        np.testing.assert_array_equal(Exporter.fill_gaps(np.array([7, nan, nan])), [7, nan, nan])
+
+
+class DateFormTests(SimpleTestCase):
+
+    def clean(self, **data):
+        form = DateForm(dict(data, format='csv'))
+        return form.is_valid(), form
+
+    def test_ranges(self):
+        for data, start, stop in (
+                ({'date': '03/01/2023'}, datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2)),
+                ({'date': '03/01/2023 06:30'}, datetime.datetime(2023, 3, 1, 6, 30), datetime.datetime(2023, 3, 2)),
+                ({'date': '03/01/2023', 'end_date': '03/03/2023'}, datetime.datetime(2023, 3, 1),
+                 datetime.datetime(2023, 3, 4)),
+                ({'date': '03/01/2023 22:00', 'hours': '5'}, datetime.datetime(2023, 3, 1, 22),
+                 datetime.datetime(2023, 3, 2, 3))):
+            with self.subTest(**data):
+                valid, form = self.clean(**data)
+                self.assertTrue(valid, form.errors)
+                self.assertEqual((form.cleaned_data['start'], form.cleaned_data['stop']), (start, stop))
+
+    def test_rejected(self):
+        last_day = datetime.date(2023, 3, 1) + datetime.timedelta(days=MAX_RANGE_DAYS - 1)
+        valid, _ = self.clean(date='03/01/2023', end_date=last_day.strftime('%m/%d/%Y'))
+        self.assertTrue(valid)  # exactly MAX_RANGE_DAYS is fine
+
+        for data, message in (
+                ({'date': '03/01/2023', 'end_date': '03/02/2023', 'hours': '4'}, "either an end date or a duration"),
+                ({'date': '03/05/2023', 'end_date': '03/04/2023'}, "before the start date"),
+                ({'date': '03/01/2023', 'end_date': (last_day + datetime.timedelta(days=1)).strftime('%m/%d/%Y')},
+                 f"limited to {MAX_RANGE_DAYS} days"),
+                ({'date': '03/01/2023', 'hours': str(MAX_RANGE_DAYS * 24 + 1)}, "less than or equal to")):
+            with self.subTest(**data):
+                valid, form = self.clean(**data)
+                self.assertFalse(valid)
+                self.assertIn(message, str(form.errors))
+
+
+class FormatTests(SimpleTestCase):
+
+    def frames(self):
+        rng = np.random.default_rng(0)
+        local = pd.date_range('2023-03-01', periods=25, freq='1s', tz='America/Chicago')
+        yield 'local', pd.DataFrame({'a': rng.random(25), 'b': np.arange(25)}, index=local.rename('time'))
+        days = pd.date_range('2023-03-01', periods=25, freq='D')
+        yield 'midnights', pd.DataFrame({'a': rng.random(25)}, index=days)
+        # only the last block has a time of day, the blocks before it on their own are dates only
+        yield 'midnight blocks', pd.DataFrame({'a': rng.random(25)}, index=days.append(
+            pd.DatetimeIndex(['2023-04-01 06:30'])).delete(0))
+        yield 'milliseconds', pd.DataFrame({'a': rng.random(25)}, index=pd.DatetimeIndex(
+            list(days[:24]) + [pd.Timestamp('2023-04-01 00:00:01.5')]))
+        yield 'nanoseconds', pd.DataFrame({'a': rng.random(25)}, index=pd.DatetimeIndex(
+            list(pd.date_range('2023-03-01', periods=24, freq='s')) + [pd.Timestamp('2023-04-01 00:00:01.000000007')]))
+        yield 'not times', pd.DataFrame({'a': rng.random(25)})
+        yield 'empty', pd.DataFrame({'a': []}, index=pd.DatetimeIndex([]))
+
+    def test_stream_csv_matches_to_csv(self):
+        for name, df in self.frames():
+            for chunk_rows in (4, 10, 100):
+                with self.subTest(name, chunk_rows=chunk_rows):
+                    self.assertEqual(''.join(stream_csv(df, chunk_rows)), df.to_csv())
+
+
+    @staticmethod
+    def read(name, content):
+        """
+        :return: csv text for the csv formats, the dataframe back with its time index for the others
+        """
+        if name == 'csv':
+            return content.decode()
+        if name == 'csv.gz':
+            return gzip.decompress(content).decode()
+        if name == 'csv.zst':
+            import zstandard
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(content)) as reader:
+                return reader.read().decode()
+        if name == 'parquet':
+            return pd.read_parquet(io.BytesIO(content))
+        df = pd.read_feather(io.BytesIO(content))
+        return df.set_index(df.columns[0])  # feather can't store an index, it's the first column
+
+    def assert_round_trip(self, name, content, df):
+        result = self.read(name, content)
+        if isinstance(result, str):
+            self.assertEqual(result, df.to_csv())
+        else:
+            pd.testing.assert_frame_equal(result, df)
+
+    def test_writers_round_trip(self):
+        df = next(frame for name, frame in self.frames() if name == 'local')
+        df = pd.concat([df] * 1000)  # enough for a few csv blocks
+        for name, _ in available_formats():
+            with self.subTest(name):
+                pieces = FORMATS[name]['writer'](df)
+                content = b''.join(piece.encode() if isinstance(piece, str) else piece for piece in pieces)
+                self.assert_round_trip(name, content, df)
+
+    def test_view_formats(self):
+        times = pd.date_range('2023-03-01 06:00', '2023-03-02 06:00', freq='10s', tz='UTC', inclusive='left').asi8
+        series = {'TE': pd.DataFrame({'time': times, 'a': np.arange(len(times), dtype=float)})}
+        with mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)), \
+                mock.patch('export.models.pool', ClientPool()):
+            df = Exporter().get_range(datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'tribology')
+            for name, _ in available_formats():
+                with self.subTest(name):
+                    response = self.client.post('/export/tribology/', {'date': '03/01/2023', 'format': name})
+                    self.assertEqual(response['Content-Type'], FORMATS[name]['content_type'])
+                    self.assertIn(f'filename=tribology_3-1-2023.{FORMATS[name]["extension"]}',
+                                  response['Content-Disposition'])
+                    self.assert_round_trip(name, b''.join(response.streaming_content), df)
+
+
+class ExportCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_round_trip_and_expiry(self):
+        cache = ExportCache(self.tmp.name, max_bytes=10 ** 9, recent_ttl=60)
+        df = pd.DataFrame({'a': [1.0, 2.0]})
+        cache.put('done', df)
+        cache.put('today', df, complete=False)
+        pd.testing.assert_frame_equal(cache.get('done'), df)
+        pd.testing.assert_frame_equal(cache.get('today'), df)
+        self.assertIsNone(cache.get('missing'))
+
+        cache.recent_ttl = -1
+        cache.put('today', df, complete=False)
+        self.assertIsNone(cache.get('today'))
+
+    def test_least_recently_used_evicted_first(self):
+        df = pd.DataFrame({'a': np.arange(1000.0)})
+        cache = ExportCache(self.tmp.name, max_bytes=10 ** 9, recent_ttl=0)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, df)
+        now = time.time()
+        for age, key in enumerate(('b', 'a', 'c')):
+            os.utime(os.path.join(self.tmp.name, f'{key}.pkl'), (now - 100 + age, now - 100 + age))
+
+        cache.max_bytes = 2.5 * os.path.getsize(os.path.join(self.tmp.name, 'a.pkl'))
+        cache.evict()
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_key_changes_with_config(self):
+        exporter = Exporter()
+        start, stop = pd.Timestamp('2023-03-01', tz='America/Chicago'), pd.Timestamp('2023-03-02', tz='America/Chicago')
+        config = exporter.cellconfig['cell5']
+        key = ExportCache.key('cell5', start, stop, config)
+        self.assertEqual(key, ExportCache.key('cell5', start, stop, Exporter().cellconfig['cell5']))
+        self.assertNotEqual(key, ExportCache.key('cell5', start, stop, dict(config, measurements=('data1',))))
+        self.assertNotEqual(key, ExportCache.key('cell7', start, stop, config))
+
+    def test_key_changes_with_pipeline_code(self):
+        start, stop = pd.Timestamp('2023-03-01', tz='America/Chicago'), pd.Timestamp('2023-03-02', tz='America/Chicago')
+        config = Exporter().cellconfig['tribology']  # no postprocess, only the pipeline modules version it
+        with mock.patch('export.cache.module_version', lambda name: name):
+            key = ExportCache.key('tribology', start, stop, config)
+        for module in ('export.influx', 'export.merge', 'export.processing'):
+            with self.subTest(module), mock.patch('export.cache.module_version',
+                                                  lambda name: name + ' edited' if name == module else name):
+                self.assertNotEqual(ExportCache.key('tribology', start, stop, config), key)
+        with mock.patch('export.cache.module_version', lambda name: name), mock.patch('export.cache.CACHE_VERSION', 2):
+            self.assertNotEqual(ExportCache.key('tribology', start, stop, config), key)
+
+
+class TimestampTests(SimpleTestCase):
+
+    def test_to_frame_converts_epoch_to_local_time(self):
+        utc = pd.to_datetime(['2023-07-01 05:00:00.5', '2023-01-01 06:00:00'], utc=True)
+        df = Exporter.to_frame([{'time': t.value, 'a': 1.0} for t in utc])
+        self.assertEqual(list(df.columns), ['a'])
+        self.assertEqual(str(df.index.tz), 'America/Chicago')
+        self.assertEqual(df.index[0].strftime('%Y-%m-%d %H:%M:%S.%f %z'), '2023-07-01 00:00:00.500000 -0500')
+        self.assertEqual(df.index[1].strftime('%Y-%m-%d %H:%M:%S %z'), '2023-01-01 00:00:00 -0600')
+
+    def test_split_days_across_dst(self):
+        chicago = tz.gettz('America/Chicago')
+        start = datetime.datetime(2023, 3, 11, tzinfo=chicago)
+        windows = Exporter.split_days(start, datetime.datetime(2023, 3, 14, tzinfo=chicago))
+        hours = [(b.timestamp() - a.timestamp()) / 3600 for a, b in windows]
+        self.assertEqual(hours, [24, 23, 24])
+
+        start = datetime.datetime(2023, 11, 5, 12, tzinfo=chicago)
+        windows = Exporter.split_days(start, datetime.datetime(2023, 11, 7, tzinfo=chicago))
+        self.assertEqual([(b.timestamp() - a.timestamp()) / 3600 for a, b in windows], [12, 24])
+        self.assertEqual(windows[0][1], datetime.datetime(2023, 11, 6, tzinfo=chicago))
+
+    def hourly_day(self, day):
+        # one point on every real hour from an hour before the local day to an hour after it
+        local = pd.Timestamp(day, tz='America/Chicago')
+        times = pd.date_range(local - pd.Timedelta(hours=1), local + pd.Timedelta(hours=26), freq='H')
+        series = {'TE': pd.DataFrame({'time': times.asi8, 'a': np.arange(len(times), dtype=float)})}
+        with mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)), \
+                mock.patch('export.models.pool', ClientPool()):
+            return Exporter().get_day(local.day, local.month, local.year, 'tribology')
+
+    def test_spring_forward_day(self):
+        df = self.hourly_day('2023-03-12')
+        self.assertEqual(len(df), 23 - 1)  # the point at local midnight is excluded like always
+        self.assertTrue(df.index.is_monotonic_increasing and df.index.is_unique)
+        self.assertEqual(df.index[0].strftime('%H:%M %z'), '01:00 -0600')
+        self.assertEqual(df.index[1].strftime('%H:%M %z'), '03:00 -0500')
+        self.assertEqual(df.index[-1].strftime('%d %H:%M'), '12 23:00')
+
+    def test_fall_back_day(self):
+        df = self.hourly_day('2023-11-05')
+        self.assertEqual(len(df), 25 - 1)
+        self.assertTrue(df.index.is_monotonic_increasing and df.index.is_unique)
+        self.assertEqual([t.strftime('%H:%M %z') for t in df.index[:3]], ['01:00 -0500', '01:00 -0600', '02:00 -0600'])
+        self.assertEqual(df.index[-1].strftime('%d %H:%M'), '05 23:00')
+
+
+class ClientPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient({}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_clients_are_reused_per_database(self):
+        pool = ClientPool()
+        config = {'database': 'cell7'}
+        with pool.client(config) as first:
+            with pool.client(config) as second:
+                self.assertIsNot(first, second)  # checked out clients are never shared
+        with pool.client(config) as again:
+            self.assertIn(again, (first, second))
+        with pool.client({'database': 'cell5'}) as other:
+            self.assertNotIn(other, (first, second))
+
+    def test_failed_client_is_dropped(self):
+        pool = ClientPool()
+        with self.assertRaises(ValueError):
+            with pool.client({'database': 'cell7'}) as broken:
+                raise ValueError()
+        self.assertTrue(broken.closed)
+        with pool.client({'database': 'cell7'}) as client:
+            self.assertIsNot(client, broken)
+
+    def test_idle_clients_are_checked_and_evicted(self):
+        pool = ClientPool(idle_timeout=60, check_after=0)
+        with pool.client({'database': 'cell7'}) as stale:
+            pass
+        stale.ping = mock.Mock(side_effect=ConnectionError())
+        with pool.client({'database': 'cell7'}) as client:
+            self.assertIsNot(client, stale)
+        self.assertTrue(stale.closed)
+
+        pool.idle_timeout = -1
+        pool.evict()
+        self.assertTrue(client.closed)
+        self.assertEqual(pool.idle, {})
+
+
+class ChunkedReadTests(SimpleTestCase):
+
+    def test_read_lines(self):
+        text = b'{"a": 1}\n{"b": [2, 3]}\n\n{"c": 4}'
+        for size in (1, 3, 8, 100):
+            with self.subTest(size=size):
+                pieces = [text[i:i + size] for i in range(0, len(text), size)]
+                self.assertEqual(list(read_lines(pieces)), [b'{"a": 1}', b'{"b": [2, 3]}', b'{"c": 4}'])
+
+    def test_chunks_across_reads(self):
+        times = pd.Timestamp('2023-03-01', tz='UTC').value + np.arange(2500) * 1_000_000_000
+        series = {'TE': pd.DataFrame({'time': times, 'a': np.arange(2500) / 7, 'b': np.where(times % 3, 1.5, np.nan)})}
+        client = FakeInfluxClient(series, read_size=100)
+        query = f"select * from TE where time >= {times[0]} and time < {times[-1] + 1}"
+        chunks = [pd.DataFrame(list(result.get_points())) for result in query_chunks(client, query, 'data', 1000)]
+        self.assertEqual([len(chunk) for chunk in chunks], [1000, 1000, 500])
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), series['TE'])
+
+
+    def test_error_chunk_raises(self):
+        lines = [{'results': [{'statement_id': 0, 'series': [{'name': 'TE', 'columns': ['time', 'a'],
+                                                              'values': [[1, 0.5]]}]}]},
+                 {'results': [{'statement_id': 0, 'error': 'max-select-point limit exceeded: (10000/10000)'}]}]
+        client = mock.Mock()
+        client.request.return_value = FakeResponse(b''.join(json.dumps(line).encode() + b'\n' for line in lines))
+        chunks = query_chunks(client, "select * from TE", 'data', 1)
+        self.assertEqual(list(next(chunks).get_points()), [{'time': 1, 'a': 0.5}])
+        with self.assertRaisesRegex(InfluxDBClientError, 'max-select-point'):
+            next(chunks)
+
+
+class ConcurrentFetchTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        times = pd.date_range('2023-03-01 05:00', '2023-03-03 07:00', freq='7s', tz='UTC').asi8
+        self.series = {
+            'data1': pd.DataFrame({'time': times, 'a': rng.random(len(times)), 'b': rng.random(len(times))}),
+            'data2': pd.DataFrame({'time': times[::5], 'a': rng.random(len(times[::5]))}),
+        }
+        self.in_flight = self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+    def make_client(self, **kwargs):
+        client = FakeInfluxClient(self.series)
+        request = client.request
+
+        def slow_request(*args, **kw):
+            with self.lock:
+                self.in_flight += 1
+                self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            time.sleep(0.01)
+            with self.lock:
+                self.in_flight -= 1
+            return request(*args, **kw)
+        client.request = slow_request
+        return client
+
+    def get_range(self, **options):
+        exporter = Exporter()
+        exporter.cellconfig = dict(exporter.cellconfig, cell5=dict(exporter.cellconfig['cell5'], **options))
+        with mock.patch('export.influx.InfluxDBClient', self.make_client), mock.patch('export.models.pool', ClientPool()):
+            return exporter.get_range(datetime.datetime(2023, 3, 1, 6), datetime.datetime(2023, 3, 3), 'cell5')
+
+    def test_concurrent_matches_sequential(self):
+        sequential = self.get_range(concurrent=False, slice=datetime.timedelta(hours=5))
+        self.assertEqual(self.most_in_flight, 1)
+        concurrent = self.get_range(max_concurrency=3, slice=datetime.timedelta(hours=5))
+        self.assertEqual(self.most_in_flight, 3)
+
+        pd.testing.assert_frame_equal(sequential, concurrent)
+        self.assertEqual(list(concurrent.columns), ['a_data1', 'b_data1', 'a_data2'])  # colliding names get renamed
+        self.assertEqual(concurrent.index[0], pd.Timestamp('2023-03-01 06:00', tz='America/Chicago'))
+
+
+class ServerAggregationTests(SimpleTestCase):
+    """
+    Runs the same exports through the normal client side path and the server side aggregation path against the fake
+    influx, which answers field selections and GROUP BY time() means like the real one.
+    """
+
+    def export(self, series, cellname, start, stop, server_aggregation):
+        exporter = Exporter()
+        exporter.server_aggregation = server_aggregation
+        self.influx = FakeInfluxClient(series)
+        with mock.patch('export.influx.InfluxDBClient', lambda **kwargs: self.influx), \
+                mock.patch('export.models.pool', ClientPool()):
+            return exporter.get_range(start, stop, cellname)
+
+    def test_cell5_means_match(self):
+        rng = np.random.default_rng(0)
+        times = pd.Timestamp('2023-03-01 05:00', tz='UTC').value + np.cumsum(rng.integers(1, 6_000_000_000, 60_000))
+        series = {
+            'data1': pd.DataFrame({'time': times, 'a': rng.random(len(times)), 'b': rng.random(len(times))}),
+            'data2': pd.DataFrame({'time': times[::7], 'a': rng.random(len(times[::7]))}),
+        }
+        start, stop = datetime.datetime(2023, 3, 1, 6, 30), datetime.datetime(2023, 3, 3)
+
+        client_side = self.export(series, 'cell5', start, stop, False)
+        server_side = self.export(series, 'cell5', start, stop, True)
+        self.assertTrue(all('group by time(45s)' in query for query in self.influx.queries))
+        pd.testing.assert_frame_equal(client_side, server_side, check_exact=False, rtol=1e-9)
+        self.assertEqual(list(server_side.columns), ['a_data1', 'b_data1', 'a_data2'])
+
+    def test_cell7_field_selection_matches(self):
+        df = synthetic_cell7(20_000)
+        for data in (df, df.drop(columns='Water_Temp_Out_F')):  # older days don't have Water_Temp_Out_F
+            series = cell7_series(data)
+            start, stop = datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2)
+
+            client_side = self.export(series, 'cell7', start, stop, False)
+            server_side = self.export(series, 'cell7', start, stop, True)
+            self.assertTrue(all(query.startswith('select "Air_Flow_MLPM"') or '"oil_rh"' in query
+                                or '"Density (dm/cc)"' in query for query in self.influx.queries))
+            pd.testing.assert_frame_equal(client_side, server_side, check_exact=True)
+
+
+class PostprocessPoolTests(SimpleTestCase):
+
+    def test_pack_round_trip(self):
+        df = synthetic_cell7(1_000)
+        header, name, spans = pack([('PLC_Tags', df)])
+        self.assertIsNotNone(name)  # the column data went through shared memory
+        self.assertLess(len(header), df.memory_usage().sum() / 2)
+        (measurement, result), = receive(header, name, spans)
+        self.assertEqual(measurement, 'PLC_Tags')
+        pd.testing.assert_frame_equal(result, df)
+
+    def test_pool_matches_in_process(self):
+        exporter = Exporter()
+        df = synthetic_cell7(20_000)
+        expected = exporter.combine([('PLC_Tags', df.copy())], exporter.cellconfig['cell7'])
+
+        postprocess_pool = PostprocessPool(1, timeout=60)
+        self.addCleanup(postprocess_pool.close)
+        pd.testing.assert_frame_equal(postprocess_pool.combine('cell7', [('PLC_Tags', df)]), expected)
+        self.assertEqual(postprocess_pool.combine('tribology', [('TE', df)]).shape, df.shape)
+
+
+class MergeTests(SimpleTestCase):
+
+    def frames(self):
+        rng = np.random.default_rng(3)
+
+        def frame(rows, columns, dtype=float):
+            times = np.sort(rng.integers(0, 5_000, rows)) * 1_000_000_000  # whole seconds so plenty of ties
+            index = pd.DatetimeIndex(pd.to_datetime(times, utc=True), name='time').tz_convert('America/Chicago')
+            return pd.DataFrame({col: rng.integers(0, 100, rows).astype(dtype) for col in columns}, index=index)
+
+        return [frame(2_000, ['a', 'b']), frame(300, ['c'], np.int64), frame(50, ['d'], np.float32),
+                frame(700, ['a']), frame(0, ['e'])]
+
+    def test_matches_concat_and_stable_sort(self):
+        frames = self.frames()
+        expected = pd.concat(frames).sort_index(kind='stable')
+        pd.testing.assert_frame_equal(merge_sorted(frames), expected)
+        pd.testing.assert_frame_equal(merge_sorted(frames[1:3]), pd.concat(frames[1:3]).sort_index(kind='stable'))
+        self.assertIs(merge_sorted(frames[:1]), frames[0])
+
+
+class LeanPipelineTests(SimpleTestCase):
+
+    def export(self, series, cellname, lean):
+        exporter = Exporter()
+        exporter.lean = lean
+        with mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)), \
+                mock.patch('export.models.pool', ClientPool()):
+            return exporter.get_range(datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), cellname)
+
+    def test_cell7_matches_within_float32(self):
+        series = cell7_series(synthetic_cell7(20_000))
+        full, lean = self.export(series, 'cell7', False), self.export(series, 'cell7', True)
+        self.assertEqual(list(lean.columns), list(full.columns))  # Unused_Tag was dropped along the way either way
+        self.assertTrue((lean.dtypes.drop('Elapse Hours') == np.float32).all())  # elapse hours stays float64
+        pd.testing.assert_frame_equal(lean, full, check_dtype=False, check_exact=False, rtol=1e-5)
+
+    def test_downcast(self):
+        df = pd.DataFrame({'f': [1.5, np.nan], 'i': [1, 300], 'big': [0, 2 ** 40], 's': ['a', 'b']})
+        self.assertEqual(Exporter.downcast(df).dtypes.tolist(),
+                         [np.dtype('float32'), np.dtype('int16'), np.dtype('int64'), np.dtype('O')])
+
+
+class TailTests(SimpleTestCase):
+
+    def patched(self, series):
+        return mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)), \
+            mock.patch('export.models.pool', ClientPool())
+
+    def test_cell5_pieces_add_up_to_the_day(self):
+        rng = np.random.default_rng(1)
+        times = pd.Timestamp('2023-03-01 06:00', tz='UTC').value + np.cumsum(rng.integers(1, 4_000_000_000, 30_000))
+        series = {'data1': pd.DataFrame({'time': times, 'a': rng.random(len(times))}),
+                  'data2': pd.DataFrame({'time': times[::3], 'b': rng.random(len(times[::3]))})}
+        chicago = tz.gettz('America/Chicago')
+        influx, pool_ = self.patched(series)
+        with influx, pool_:
+            day = Exporter().get_range(datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'cell5')
+            pieces = []
+            cursor = None
+            for until in ('2023-03-01 00:00:10', '2023-03-01 10:00:20', '2023-03-01 10:00:30', '2023-03-01 17:13:07',
+                          '2023-03-02 00:00'):
+                df, cursor = Exporter().get_tail('cell5', cursor, pd.Timestamp(until, tz=chicago).to_pydatetime())
+                if df is not None:
+                    self.assertGreaterEqual(df.index[0].value, pieces[-1].index[-1].value if pieces else 0)
+                    pieces.append(df)
+            self.assertEqual(cursor, day.index[-1].value)
+
+        # the bucket that was still open gets sent again, the newest copy of each bucket wins
+        merged = pd.concat(pieces)
+        merged = merged[~merged.index.duplicated(keep='last')]
+        pd.testing.assert_frame_equal(merged, day, check_freq=False)
+
+    def test_cell7_tail_matches_full_export(self):
+        series = cell7_series(synthetic_cell7(20_000))
+        influx, pool_ = self.patched(series)
+        with influx, pool_:
+            day = Exporter().get_range(datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'cell7')
+            since = pd.Timestamp('2023-03-01 02:31:17', tz='America/Chicago')
+            until = datetime.datetime(2023, 3, 2, tzinfo=tz.gettz('America/Chicago'))
+            tail, cursor = Exporter().get_tail('cell7', since.value, until)
+        self.assertEqual(tail.index[0], pd.Timestamp('2023-03-01 02:30:00', tz='America/Chicago'))
+        pd.testing.assert_frame_equal(tail, day[day.index >= tail.index[0]])
+        self.assertEqual(cursor, day.index[-1].value)
+
+    def test_view(self):
+        times = pd.Timestamp.now(tz='UTC').floor('min') - pd.to_timedelta(np.arange(5, 0, -1), unit='min')
+        series = {'TE': pd.DataFrame({'time': times.asi8, 'a': np.arange(5.0)})}
+        influx, pool_ = self.patched(series)
+        with influx, pool_:
+            response = self.client.get(f'/export/tribology/tail?since={times[2].value}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content).decode().count('\n'), 3)  # header and two rows
+            self.assertEqual(response['X-Next-Cursor'], str(times[4].value))
+            self.assertEqual(self.client.get(f"/export/tribology/tail?since={response['X-Next-Cursor']}").status_code,
+                             204)
+        self.assertEqual(self.client.get('/export/tribology/tail?since=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/export/nocell/tail').status_code, 404)
+
+    def test_cell_without_export_config(self):
+        with self.assertRaises(NotImplementedError):
+            Exporter().get_tail('cell8')
+        with mock.patch('export.views.get_cell', lambda cellname: get_registry().get('cell8')):
+            self.assertEqual(self.client.get('/export/cell8/tail').status_code, 404)
+
+    def test_stage_timings(self):
+        times = pd.Timestamp.now(tz='UTC').floor('min') - pd.to_timedelta(np.arange(5, 0, -1), unit='min')
+        series = {'TE': pd.DataFrame({'time': times.asi8, 'a': np.arange(5.0)})}
+        influx, pool_ = self.patched(series)
+        with influx, pool_, mock.patch('FPIWebsite.metrics.metrics', Metrics()) as metrics:
+            response = self.client.get(f'/export/tribology/tail?since={times[0].value}')
+            content = b''.join(response.streaming_content)
+            text = self.client.get('/metrics').content.decode()
+        stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertTrue({'query', 'parse', 'merge', 'total'} <= set(stages), stages)
+        self.assertIn('fpi_stage_seconds_count{cell="tribology",stage="query"} 1', text)
+        self.assertIn('fpi_stage_rows_total{cell="tribology",stage="parse"} 5', text)
+        self.assertIn(f'fpi_stage_bytes_total{{cell="tribology",stage="render"}} {len(content)}', text)
+        self.assertIn('fpi_request_seconds_count{view="/export/<str:cellname>/tail",method="GET",status="200"} 1', text)
+
+
+class RollupTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = RollupStore(directory.name)
+        self.influx = FakeInfluxClient(cell7_series(synthetic_cell7(20_000)))
+        for patcher in (mock.patch('export.influx.InfluxDBClient', lambda **kwargs: self.influx),
+                        mock.patch('export.models.pool', ClientPool()),
+                        mock.patch('export.models.get_rollup_store', lambda: self.store),
+                        mock.patch('export.rollup.get_rollup_store', lambda: self.store)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_day_served_from_rollup(self):
+        expected = Exporter().get_day(1, 3, 2023, 'cell7')
+        results = rollup_range(datetime.date(2023, 3, 1), datetime.date(2023, 3, 2), ['cell7', 'cell5'], workers=2)
+        self.assertEqual(results[('cell7', datetime.date(2023, 3, 1))], True)
+        self.assertEqual(results[('cell7', datetime.date(2023, 3, 2))], False)  # no data, nothing stored
+
+        self.influx.queries.clear()
+        pd.testing.assert_frame_equal(Exporter().get_day(1, 3, 2023, 'cell7'), expected, check_freq=False)
+        self.assertEqual(self.influx.queries, [])
+
+        # a day without data is asked for again, points may have come in late
+        self.assertIsNone(Exporter().get_day(2, 3, 2023, 'cell7'))
+        self.assertNotEqual(self.influx.queries, [])
+        self.influx.queries.clear()
+
+        # a range that isn't exactly one day still goes to influx
+        Exporter().get_range(datetime.datetime(2023, 3, 1, 1), datetime.datetime(2023, 3, 2), 'cell7')
+        self.assertNotEqual(self.influx.queries, [])
+
+    def test_command_skips_stored_days(self):
+        out = io.StringIO()
+        call_command('rollup', '--start', '2023-03-01', '--end', '2023-03-03', '--cell', 'cell7', stdout=out)
+        self.assertIn('1 day(s) rolled up, 0 failed.', out.getvalue())  # the other two had no data
+        out = io.StringIO()
+        call_command('rollup', '--date', '2023-03-01', '--cell', 'cell7', stdout=out)
+        self.assertIn('0 day(s) rolled up, 0 failed.', out.getvalue())
+
+        # editing the config makes a new version, prune drops the old one
+        self.assertEqual(self.store.prune('cell7', dict(Exporter().cellconfig['cell7'], slice=None)), 1)
+        self.assertIsNone(self.store.get('cell7', datetime.date(2023, 3, 1), Exporter().cellconfig['cell7']))
+
+
+    def test_failed_put_leaves_nothing_behind(self):
+        config = Exporter().cellconfig['cell7']
+        df = pd.DataFrame({'a': [1.0]}, index=pd.DatetimeIndex(['2023-03-01'], tz='UTC'))
+        with mock.patch.object(pd.DataFrame, 'to_parquet', side_effect=OSError("disk full")), \
+                self.assertRaises(OSError):
+            self.store.put('cell7', datetime.date(2023, 3, 1), config, df)
+        self.assertEqual(list(self.store.folder('cell7', config).iterdir()), [])
+        self.assertIsNone(self.store.get('cell7', datetime.date(2023, 3, 1), config))
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class ExportJobTests(TransactionTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        times = pd.date_range('2023-03-01 06:00', '2023-03-02 06:00', freq='10s', tz='UTC', inclusive='left').asi8
+        series = {'TE': pd.DataFrame({'time': times, 'a': np.arange(len(times), dtype=float)})}
+        job_settings = override_settings(EXPORT_JOBS={'DIR': self.directory.name, 'RETENTION': 60})
+        job_settings.enable()
+        self.addCleanup(job_settings.disable)
+        for patcher in (mock.patch('export.influx.InfluxDBClient', lambda **kwargs: FakeInfluxClient(series)),
+                        mock.patch('export.models.pool', ClientPool()),
+                        mock.patch('export.jobs.get_executor', InlineExecutor)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_background_export(self):
+        response = self.client.post('/export/tribology/', {'date': '03/01/2023', 'format': 'csv', 'background': 'on'})
+        self.assertEqual(response.status_code, 202)
+        status = self.client.get(response.json()['status_url']).json()
+        self.assertEqual((status['status'], status['progress']), ('done', 1))
+
+        download = self.client.get(status['download_url'])
+        self.assertIn('filename="tribology_3-1-2023.csv"', download['Content-Disposition'])
+        direct = self.client.post('/export/tribology/', {'date': '03/01/2023', 'format': 'csv'})
+        self.assertEqual(b''.join(download.streaming_content), b''.join(direct.streaming_content))
+
+    def test_failed_job_and_cleanup(self):
+        job = jobs.submit('tribology', datetime.datetime(2023, 4, 1), datetime.datetime(2023, 4, 2), 'csv')
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertEqual(job.message, 'No data available for 4/1/2023.')
+        self.assertEqual(self.client.get(f'/export/jobs/{job.pk}/download').status_code, 404)
+
+        done = jobs.submit('tribology', datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'parquet')
+        done.refresh_from_db()
+        self.assertTrue(os.path.exists(done.file))
+        ExportJob.objects.update(finished=done.finished - datetime.timedelta(minutes=5))
+        self.assertEqual(jobs.cleanup_jobs(), 2)
+        self.assertFalse(os.path.exists(done.file))
+
+    def test_writer_failure_fails_the_job(self):
+        def writer(df):
+            yield df.to_csv()
+            raise ValueError("disk full")
+
+        with mock.patch.dict(FORMATS, csv=dict(FORMATS['csv'], writer=writer)), self.assertLogs('export.jobs'):
+            job = jobs.submit('tribology', datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'csv')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), (ExportJob.FAILED, 'Unknown error occurred. disk full'))
+        self.assertEqual(os.listdir(self.directory.name), [])  # the half written file is gone
+
+    def test_progress_errors_dont_fail_the_job(self):
+        update = QuerySet.update
+
+        def locked(queryset, **kwargs):
+            if 'progress' in kwargs:
+                raise OperationalError("database is locked")
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', locked), self.assertLogs('export.jobs', 'WARNING'):
+            job = jobs.submit('tribology', datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'csv')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (ExportJob.DONE, 1))
+
+    def test_stale_jobs_fail(self):
+        with mock.patch('export.jobs.get_executor'):  # queued, but the process goes away before it runs
+            lost = jobs.submit('tribology', datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'csv')
+            waiting = jobs.submit('tribology', datetime.datetime(2023, 3, 1), datetime.datetime(2023, 3, 2), 'csv')
+        ExportJob.objects.filter(pk=lost.pk).update(created=timezone.now() - datetime.timedelta(hours=7))
+        open(os.path.join(self.directory.name, f'{lost.pk}.csv.tmp'), 'w').close()
+
+        with self.assertLogs('export.jobs', 'WARNING'):
+            self.assertEqual(jobs.cleanup_jobs(), 0)
+        lost.refresh_from_db()
+        waiting.refresh_from_db()
+        self.assertEqual(lost.status, ExportJob.FAILED)
+        self.assertEqual(self.client.get(f'/export/jobs/{lost.pk}/').json()['status'], 'failed')
+        self.assertEqual(waiting.status, ExportJob.QUEUED)
+        self.assertEqual(os.listdir(self.directory.name), [])
@@ -4,5 +4,8 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('jobs/<uuid:job_id>/', views.job_status, name='jobstatus'),
+    path('jobs/<uuid:job_id>/download', views.job_download, name='jobdownload'),
     path('<str:cellname>/', views.cell, name='cellpage'),
+    path('<str:cellname>/tail', views.tail, name='tail'),
 ]
\ No newline at end of file
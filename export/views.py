@@ -1,9 +1,14 @@
 import datetime
-from django.shortcuts import render
-from django.http import HttpResponse
-from .models import Exporter
+from django.shortcuts import render, get_object_or_404
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from FPIWebsite.cells import get_registry
+from FPIWebsite.metrics import timed_stream
+from .models import Exporter, ExportJob
+from . import jobs
 from django.template import loader
 from .forms import DateForm
+from .formats import FORMATS
 import requests
 import logging
 
@@ -21,6 +26,35 @@ def get_client_ip(request):
     return _ip
 
 
+def describe_range(start, stop, sep='/'):
+    """
+    Short human readable name for an export range, used in messages and filenames.
+    :param start: datetime of the start of the range
+    :param stop: datetime of the end of the range
+    :param sep: separator between month, day and year
+    :return: 'M/D/YYYY' for a single whole day, otherwise 'M/D/YYYY to M/D/YYYY' with times when they aren't midnight
+    """
+    def fmt(d):
+        text = f'{d.month}{sep}{d.day}{sep}{d.year}'
+        if d.hour or d.minute:
+            text += f' {d.hour:02}:{d.minute:02}'
+        return text
+
+    if start.hour == start.minute == stop.hour == stop.minute == 0:
+        stop -= datetime.timedelta(days=1)  # whole day ranges are named by their last day, not the midnight after it
+        if stop.date() == start.date():
+            return fmt(start)
+    return f'{fmt(start)} to {fmt(stop)}'
+
+
+def range_filename(cellname, start, stop, extension):
+    """
+    Download filename for an export, e.g. cell7_3-1-2023.csv or cell7_3-1-2023_to_3-7-2023.csv
+    """
+    name = describe_range(start, stop, '-').replace(' ', '_').replace(':', '')
+    return f'{cellname}_{name}.{extension}'
+
+
 def error(request, cellname, message=None):
     if isinstance(message, str):
         messages = [message]
@@ -41,27 +75,23 @@ def error(request, cellname, message=None):
 
 def index(request):
     template = loader.get_template('index.html')
+    return HttpResponse(template.render({'cells': get_registry().exportable()}, request))
 
-    context = {
-        'cells': [
-            {
-                "name": "cell5",
-                'common_name': "Cell 5"
-            },
-            {
-                "name": "cell7",
-                'common_name': "Cell 7"
-            },
-            {
-                "name": "tribology",
-                'common_name': "Tribology Lab"
-            },
-        ]
-    }
-    return HttpResponse(template.render(context, request))
+
+def get_cell(cellname):
+    """
+    :param cellname: cell name or slug from the url
+    :return: the Cell from the registry, 404 if it can't be exported
+    """
+    cell = get_registry().get(cellname)
+    if cell is None or cell.export is None:
+        raise Http404(f"Unknown cell {cellname}")
+    return cell
 
 
 def cell(request, cellname):
+    cell = get_cell(cellname)
+    cellname = cell.name
     # request will be POST if the user just submitted the form
     if request.method == 'POST':
         # create a form instance and populate it with data from the request:
@@ -69,34 +99,42 @@ def cell(request, cellname):
 
         # check whether it's valid:
         if form.is_valid():
-            date = form.cleaned_data['date']  # datetime object
+            start = form.cleaned_data['start']  # datetime objects
+            stop = form.cleaned_data['stop']
+            ip = get_client_ip(request)
+
+            if form.cleaned_data['background']:
+                # hand the export to the job pool and let the page poll for it
+                job = jobs.submit(cellname, start, stop, form.cleaned_data['format'])
+                logger.info(str(datetime.datetime.now()) +
+                            f' {cellname} background download for {describe_range(start, stop)} requested by {ip}',
+                            {
+                                'action': 'download',
+                                'cellname': cellname,
+                                'ip': ip
+                            })
+                return JsonResponse(job_json(job), status=202)
+
             exporter = Exporter()
             try:
-                # specifically unwrapping datetime object here and re wrapping it in the method so that the user input
-                # gets cleaned a bit and will cause an error if something weird gets through instead of being injectable
-                df = exporter.get_day(date.day, date.month, date.year, cellname)
+                df = exporter.get_range(start, stop, cellname)
             except requests.exceptions.ConnectionError as e:
                 return error(request, cellname, f"Connection error occurred with database. Please contact site admin. {e}")
             except Exception as e:
                 return error(request, cellname, f"Unknown error occurred. {e}")
-            finally:
-                exporter.close()  # always close your connections!
 
             if df is None:
-                exporter.close()
-                return error(request, cellname, f'No data available for that day ({date.month}/{date.day}/{date.year}).')
-            # df = exporter.cell7convert(df)  # special cell 7 conversions
-
-            response = HttpResponse(df.to_csv(), content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename=cell7_{date.month}-{date.day}-{date.year}.csv'
+                return error(request, cellname, f'No data available for {describe_range(start, stop)}.')
 
-            # response = HttpResponse(content_type='text/csv')
-            # response['Content-Disposition'] = f'attachment; filename=cell7_{date.month}-{date.day}-{date.year}.csv'
-            # df.to_csv(path_or_buf=response)  # for some reason pandas can write directly to a download buffer
+            # stream the file out in pieces instead of rendering the whole range into one string first
+            fmt = FORMATS[form.cleaned_data['format']]
+            response = StreamingHttpResponse(timed_stream(fmt['writer'](df), 'render', cellname),
+                                             content_type=fmt['content_type'])
+            filename = range_filename(cellname, start, stop, fmt['extension'])
+            response['Content-Disposition'] = f'attachment; filename={filename}'
 
-            ip = get_client_ip(request)
             logger.info(str(datetime.datetime.now()) +
-                        f' {cellname} download for {date.month}/{date.day}/{date.year} requested by {ip}',
+                        f' {cellname} download for {describe_range(start, stop)} requested by {ip}',
                         {
                             'action': 'download',
                             'cellname': cellname,
@@ -105,9 +143,63 @@ def cell(request, cellname):
 
             return response
         else:
-            return error(request, cellname, 'Invalid date. Please use format: M/D/YYYY.')
+            return error(request, cellname, list(form.non_field_errors()) or 'Invalid date. Please use format: M/D/YYYY.')
 
     # if request is GET we send the normal page
     else:
         form = DateForm()
-        return render(request, 'cell.html', {'form': form, 'cellname': cellname})
+        return render(request, 'cell.html', {'form': form, 'cellname': cell.slug})
+
+
+def job_json(job):
+    return {
+        'id': str(job.pk),
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'status_url': reverse('jobstatus', args=[job.pk]),
+        'download_url': reverse('jobdownload', args=[job.pk]) if job.status == ExportJob.DONE else None,
+    }
+
+
+def job_status(request, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id)
+    return JsonResponse(job_json(job))
+
+
+def job_download(request, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id, status=ExportJob.DONE)
+    try:
+        return FileResponse(open(job.file, 'rb'), as_attachment=True, filename=job.filename)
+    except FileNotFoundError:
+        raise Http404("Export file has been cleaned up, please run the export again.")
+
+
+def tail(request, cellname):
+    """
+    Incremental export for polling a running test, GET /export/<cellname>/tail?since=<cursor>. Returns only the rows
+    newer than the cursor (plus the last resample bucket again, it may have grown) and the cursor for the next call in
+    the X-Next-Cursor header. Leave since off to start from midnight today. 204 means nothing new yet.
+    """
+    cellname = get_cell(cellname).name
+    since = request.GET.get('since')
+    if since is not None and not since.lstrip('-').isdigit():
+        return HttpResponseBadRequest("since has to be the cursor from X-Next-Cursor, epoch nanoseconds")
+    fmt = FORMATS.get(request.GET.get('format', 'csv'))
+    if fmt is None:
+        return HttpResponseBadRequest(f"format has to be one of {', '.join(FORMATS)}")
+
+    try:
+        df, cursor = Exporter().get_tail(cellname, None if since is None else int(since))
+    except requests.exceptions.ConnectionError as e:
+        return HttpResponse(f"Connection error occurred with database. {e}", status=502)
+    except NotImplementedError as e:
+        raise Http404(str(e))
+
+    if df is None:
+        response = HttpResponse(status=204)
+    else:
+        response = StreamingHttpResponse(timed_stream(fmt['writer'](df), 'render', cellname),
+                                         content_type=fmt['content_type'])
+    response['X-Next-Cursor'] = str(cursor)
+    return response
@@ -1,3 +1,218 @@
-from django.test import TestCase
+import contextvars
+import logging
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from export.cache import get_cache
+from export.processing import get_postprocess_pool
+from export.rollup import get_rollup_store
+from FPIWebsite.logqueue import BatchingQueueHandler, LogConfigurator, LokiBatchHandler
+from FPIWebsite.metrics import Metrics, current_timings, for_cell, span, timed_stream
+
+
+class Sink(logging.Handler):
+    """
+    Handler that remembers what it got, waits on `gate` before each record and takes `delay` seconds per record
+    """
+
+    def __init__(self, name, delay=0):
+        super().__init__()
+        self.set_name(name)
+        self.delay = delay
+        self.gate = threading.Event()
+        self.gate.set()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait()
+        time.sleep(self.delay)
+        self.messages.append(record.getMessage())
+
+
+class BatchSink(Sink):
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.batches = []
+
+    def emit_batch(self, records):
+        self.batches.append([record.getMessage() for record in records])
+
+
+class LogQueueTests(SimpleTestCase):
+
+    def test_tests_log_to_the_console_only(self):
+        for name in ('django', 'export.views', 'upload.views'):
+            handlers = logging.getLogger(name).handlers
+            self.assertEqual([type(handler) for handler in handlers], [logging.StreamHandler], name)
+
+    def test_tests_run_without_export_caches(self):
+        for getter in (get_cache, get_postprocess_pool, get_rollup_store):
+            self.assertIsNone(getter(), getter.__name__)
+
+    def make_logger(self, *sinks, **options):
+        options.setdefault('flush_interval', 0.1)
+        handler = BatchingQueueHandler(sinks, **options)
+        self.addCleanup(handler.close)
+        logger = logging.Logger(f'logqueue-test-{id(handler)}')
+        logger.addHandler(handler)
+        return logger, handler
+
+    def test_configurator_passes_handlers(self):
+        configurator = LogConfigurator({'version': 1, 'handlers': {
+            'queue': {'class': 'FPIWebsite.logqueue.BatchingQueueHandler', 'handlers': ['sink'], 'flush_interval': 0.1},
+            'sink': {'()': lambda: BatchSink('sink')},
+        }})
+        handlers = configurator.config['handlers']
+        with self.assertRaises(ValueError) as failed:
+            configurator.configure_handler(handlers['queue'])
+        self.assertIn('target not configured yet', str(failed.exception.__cause__))  # so dictConfig defers it
+
+        handlers['sink'] = configurator.configure_handler(handlers['sink'])
+        handler = configurator.configure_handler(handlers['queue'])
+        self.addCleanup(handler.close)
+        self.assertEqual(handler.listener.handlers, [handlers['sink']])
+        logger = logging.Logger('logqueue-test-configurator')
+        logger.addHandler(handler)
+        logger.warning("record")
+        handler.flush()
+        self.assertEqual(handlers['sink'].batches, [["record"]])
+
+    def test_slow_sink_doesnt_block(self):
+        sink = Sink('slow-sink', delay=0.05)
+        logger, handler = self.make_logger(sink)
+        started = time.monotonic()
+        for n in range(20):
+            logger.warning(f"record {n}")
+        self.assertLess(time.monotonic() - started, 0.2)  # the sink alone needs a second for these
+        handler.flush()
+        self.assertEqual(sink.messages, [f"record {n}" for n in range(20)])
+
+    def test_batches(self):
+        sink = BatchSink('batch-sink')
+        logger, handler = self.make_logger(sink, batch_size=10, flush_interval=0.5)
+        for n in range(25):
+            logger.warning(f"record {n}")
+        handler.flush()
+        self.assertEqual(sum(sink.batches, []), [f"record {n}" for n in range(25)])
+        self.assertLess(len(sink.batches), 25)
+        self.assertTrue(all(len(batch) <= 10 for batch in sink.batches))
+
+    def test_overflow(self):
+        for overflow, kept in (('drop_oldest', list(range(15, 20))), ('drop_new', list(range(1, 6)))):
+            with self.subTest(overflow=overflow):
+                sink = Sink(f'{overflow}-sink')
+                sink.gate.clear()
+                logger, handler = self.make_logger(sink, capacity=5, overflow=overflow, batch_size=1)
+                logger.warning("record 0")
+                while not handler.queue.empty():  # wait until the listener is stuck holding record 0
+                    time.sleep(0.01)
+                for n in range(1, 20):
+                    logger.warning(f"record {n}")
+                sink.gate.set()
+                handler.flush()
+                handler.close()
+                self.assertEqual(sink.messages, ["record 0", "Log queue was full, dropped 14 records"] +
+                                 [f"record {n}" for n in kept])
+
+    def test_close_flushes(self):
+        sink = Sink('closing-sink', delay=0.01)
+        logger, handler = self.make_logger(sink)
+        for n in range(10):
+            logger.warning(f"record {n}")
+        handler.close()
+        self.assertEqual(len(sink.messages), 10)
+        self.assertFalse(handler.listener.is_alive())
+
+    def test_loki_push(self):
+        loki = LokiBatchHandler('http://loki/api/prom/push', 'FPIWebsite')
+        loki.set_name('test-loki')
+        logger, handler = self.make_logger(loki)
+        with mock.patch.object(loki.session, 'post') as post:
+            logger.warning("Invalid data entered (1)", {'action': 'upload', 'cellname': 'cell7', 'ip': '10.0.0.5'})
+            logger.warning("Invalid data entered (1)", {'action': 'upload', 'cellname': 'cell7', 'ip': '10.0.0.5'})
+            logger.error("Not Found: /nowhere")
+            handler.flush()
+        post.assert_called_once()  # one push for the whole batch
+        streams = post.call_args.kwargs['json']['streams']
+        self.assertEqual(len(streams), 2)
+        self.assertEqual(streams[0]['labels'], '{action="upload",cellname="cell7",ip="10.0.0.5",job="FPIWebsite",'
+                                               f'level="warning",logger="{logger.name}"}}')
+        self.assertEqual([entry['line'] for entry in streams[0]['entries']], ["Invalid data entered (1)"] * 2)
+        self.assertEqual(streams[1]['entries'][0]['line'], "Not Found: /nowhere")
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('FPIWebsite.metrics.metrics', Metrics())
+        self.metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_spans(self):
+        with for_cell('cell7'):
+            with span('parse_points') as timing:
+                timing.rows = 12
+            with span('plc_write'):
+                pass
+        with self.assertRaises(IOError), span('plc_read', 'cell8'):
+            raise IOError("unreachable")  # failures are still timed
+        self.metrics.observe('query', 0.3, 'cell7')
+        self.metrics.observe('query', 7, 'cell7')
+
+        text = self.metrics.render()
+        self.assertIn('fpi_stage_seconds_count{cell="cell7",stage="parse_points"} 1', text)
+        self.assertIn('fpi_stage_seconds_count{cell="cell8",stage="plc_read"} 1', text)
+        self.assertIn('fpi_stage_rows_total{cell="cell7",stage="parse_points"} 12', text)
+        # buckets count everything up to their bound
+        self.assertIn('fpi_stage_seconds_bucket{cell="cell7",stage="query",le="0.25"} 0', text)
+        self.assertIn('fpi_stage_seconds_bucket{cell="cell7",stage="query",le="0.5"} 1', text)
+        self.assertIn('fpi_stage_seconds_bucket{cell="cell7",stage="query",le="10"} 2', text)
+        self.assertIn('fpi_stage_seconds_bucket{cell="cell7",stage="query",le="+Inf"} 2', text)
+        self.assertIn('fpi_stage_seconds_sum{cell="cell7",stage="query"} 7.3', text)
+
+    def test_request_timings_from_threads_add_up(self):
+        class Timings(dict):
+            def get(self, key, default=None):
+                value = super().get(key, default)
+                time.sleep(0)  # let another thread in between reading the total and writing it back
+                return value
+
+        timings = Timings()
+        token = current_timings.set(timings)
+        self.addCleanup(current_timings.reset, token)
+
+        def parse():
+            for _ in range(200):
+                self.metrics.observe('parse', 1, 'cell5')
+
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(parse,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(timings, {'parse': 800})
+
+    def test_labels_are_escaped(self):
+        self.metrics.observe('query', 0.1, 'Stand "4"\\')
+        self.assertIn('cell="Stand \\"4\\"\\\\"', self.metrics.render())
+
+    def test_timed_stream(self):
+        pieces = timed_stream(iter(['a,b\n', '1,2\n', b'\x00\x01']), 'render', 'cell5')
+        self.assertEqual(list(pieces), ['a,b\n', '1,2\n', b'\x00\x01'])
+        self.assertIn('fpi_stage_bytes_total{cell="cell5",stage="render"} 10', self.metrics.render())
+
+        pieces = timed_stream(iter(['a,b\n', '1,2\n']), 'render', 'cell8')
+        next(pieces)
+        pieces.close()  # the client went away, what was sent is still counted
+        self.assertIn('fpi_stage_bytes_total{cell="cell8",stage="render"} 4', self.metrics.render())
+
+    def test_endpoint(self):
+        self.client.get('/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('fpi_request_seconds_count{view="/",method="GET",status="200"} 1', response.content.decode())
+        self.assertIn('total;dur=', response['Server-Timing'])
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class UploadConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'upload'
+
+    def ready(self):
+        from FPIWebsite.cells import get_registry
+        get_registry()  # load the cells file at startup so a mistake in it shows up straight away
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PointsCache:
+    """
+    The last test points read from each cell's PLC, kept for ttl seconds so everyone who has the cell page open isn't
+    each doing their own read. Our own uploads drop a cell's entry straight away. Points get changed on the HMI too,
+    the ttl is how stale those can be. With poll set, a thread re-reads the cells someone has viewed in the last
+    view_timeout seconds every poll seconds, so they're always warm.
+    """
+
+    def __init__(self, ttl=10, poll=None, view_timeout=120):
+        """
+        :param ttl: seconds a read is reused for
+        :param poll: seconds between background reads of viewed cells, None to not poll
+        :param view_timeout: seconds after the last view a cell stops being polled
+        """
+        self.ttl = ttl
+        self.poll = poll
+        self.view_timeout = view_timeout
+        self.entries = {}  # cellname -> (points, etag, monotonic time read)
+        self.generations = {}  # cellname -> count of invalidations, so a read that raced an upload isn't stored
+        self.viewed = {}  # cellname -> monotonic time of the last view
+        self.locks = {}  # cellname -> lock held while reading the PLC, so concurrent misses only read once
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def get(self, cellname, read):
+        """
+        :param cellname: name of the cell
+        :param read: function reading the cell's points from the PLC, called on a miss
+        :return: (points, etag)
+        """
+        self.view(cellname)
+        entry = self.fresh(cellname)
+        if entry is not None:
+            return entry
+
+        with self.lock:
+            lock = self.locks.setdefault(cellname, threading.Lock())
+        with lock:
+            entry = self.fresh(cellname)  # someone else may have read it while this waited
+            if entry is not None:
+                return entry
+            return self.refresh(cellname, read)
+
+    def fresh(self, cellname):
+        with self.lock:
+            entry = self.entries.get(cellname)
+        if entry is not None and time.monotonic() - entry[2] < self.ttl:
+            return entry[:2]
+        return None
+
+    def refresh(self, cellname, read):
+        """
+        Reads a cell's points and stores them.
+        :return: (points, etag)
+        """
+        with self.lock:
+            generation = self.generations.get(cellname, 0)
+        points = read(cellname)
+        entry = (points, etag(points), time.monotonic())
+        with self.lock:
+            if self.generations.get(cellname, 0) == generation:
+                self.entries[cellname] = entry
+        return entry[:2]
+
+    def invalidate(self, cellname):
+        with self.lock:
+            self.entries.pop(cellname, None)
+            self.generations[cellname] = self.generations.get(cellname, 0) + 1
+
+    def view(self, cellname):
+        """
+        Records that someone is looking at a cell and starts the poller if it's turned on and not running.
+        """
+        with self.lock:
+            self.viewed[cellname] = time.monotonic()
+            if self.poll and (self.poller is None or not self.poller.is_alive()):
+                self.poller = threading.Thread(target=self.run_poller, name='points-poller', daemon=True)
+                self.poller.start()
+
+    def run_poller(self):
+        from .models import get_points
+
+        while True:
+            time.sleep(self.poll)
+            cutoff = time.monotonic() - self.view_timeout
+            with self.lock:
+                cells = [cellname for cellname, viewed in self.viewed.items() if viewed >= cutoff]
+                if not cells:
+                    self.poller = None  # nobody's looking, the next view starts it again
+                    return
+            for cellname in cells:
+                try:
+                    self.refresh(cellname, get_points)
+                except Exception:
+                    logger.exception(f"Polling {cellname} points failed")
+
+
+def etag(points) -> str:
+    """
+    :return: quoted ETag of a cell's points
+    """
+    return '"' + hashlib.sha1(json.dumps(points).encode()).hexdigest()[:20] + '"'
+
+
+@lru_cache(maxsize=None)
+def get_points_cache():
+    """
+    :return: the process wide PointsCache built from settings.UPLOAD_POINTS_CACHE, None if it is turned off
+    """
+    options = getattr(settings, 'UPLOAD_POINTS_CACHE', None)
+    if not options:
+        return None
+    return PointsCache(options.get('TTL', 10), options.get('POLL'), options.get('VIEW_TIMEOUT', 120))
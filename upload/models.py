@@ -1,188 +1,227 @@
-from django.db import models
-from pylogix import PLC
+import re
+from functools import lru_cache
+
+from django.conf import settings
 import numpy as np
 
+from FPIWebsite.cells import get_registry
+from FPIWebsite.metrics import for_cell, span
+
+from .cache import get_points_cache
+from .plc import plcs
+
+# unchanged runs this short between two changes get rewritten anyway, one longer write is cheaper than another service
+DIFF_GAP = 8
+
+# parse_points turns the brackets into spaces and drops the quotes, leaving comma separated numbers
+NUMBERS_ONLY = str.maketrans('[]', '  ', '"')
+DINT_RANGE = (-2 ** 31, 2 ** 31 - 1)
 
-def cell7validation(points):
-    prev_time = 0
-    for i, [hour, minute] in enumerate(points):
 
-        if hour == 0 and minute == 0 and i != 0:  # zero row found, i.e. end of data found
-            for [h, m] in points[i:]:  # verify that there are no data points after zero row
-                if h != 0 or m != 0:
-                    return False
-            return True
+def data_end(points) -> int:
+    """
+    :param points: 2d array of rows
+    :return: index of the first all zero row after the first row, i.e. where the data ends, len(points) if there's none
+    """
+    zero = ~points[1:].any(axis=1)
+    return int(zero.argmax()) + 1 if zero.any() else len(points)
 
-        if minute < 0 or minute > 59:  # minute out of range
-            return False
 
-        cur_time = hour + (minute/60)
-        if prev_time >= cur_time:
-            return False
-        prev_time = cur_time
+def zeros_after_end(points, end) -> bool:
+    """
+    Rule: nothing but zero rows after the end of the data
+    """
+    return not points[end:].any()
 
-    return True
+
+def in_range(values, low, high) -> bool:
+    """
+    Rule: every value is from low to high
+    """
+    return bool(((values >= low) & (values <= high)).all())
+
+
+def increasing(values, start=0) -> bool:
+    """
+    Rule: values go strictly up, starting above start
+    """
+    return bool((np.diff(values, prepend=start) > 0).all())
+
+
+def cell7validation(points):
+    points = np.asarray(points)
+    end = data_end(points)
+    hours, minutes = points[:end].T
+    return (zeros_after_end(points, end) and
+            in_range(minutes, 0, 59) and
+            increasing(hours * 60 + minutes))  # minutes since the start, so each point has to be later than the last
 
 
 def cell7postupload(points):
-    end = len(points)
-    for i, [h, m] in enumerate(points):
-        if h == 0 and m == 0 and i != 0:
-            end = i
-            break
+    end = data_end(np.asarray(points))
 
-    cd = CellData()
     ch, cm = points[end-1]
     plus_twenty = int(cm) + 20
-    complete_hours = ch + (plus_twenty // 60)
+    complete_hours = int(ch) + (plus_twenty // 60)
     complete_minutes = plus_twenty % 60
 
-    with PLC() as comm:
-        comm.IPAddress = cd.get_ip("cell7")
-        comm.Write('Total_Auto_Samples', end)
-        comm.Write('Test_Complete_Hours', complete_hours)
-        comm.Write('Test_Complete_Minutes', complete_minutes)
-        comm.Write('FAL_Control_hours.LEN', end)
-        comm.Write('FAL_Control_minutes.LEN', end)
-
-
-class CellData(models.Model):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.cells = {
-            'cell7': {
-                'columns': ('Hours', 'Minutes'),
-                'tagnames': ('Time_Hours', 'Time_Minutes'),
-                'common_name': "Cell 7",
-                'ip': '192.168.10.17',
-                'link': "/upload/cell7",
-                'max input': 12,
-                'validation': cell7validation,
-                'post_upload': cell7postupload,
-            },
-            'cell8': {
-                'columns': ('Main Motor Test Points', 'Load Motor Test Points', 'Pressure Test Points'),
-                'tagnames': ('MainMotorTestPoints', 'LoadMotorTestPoints', 'PressureTestPoints'),
-                'common_name': "Cell 8",
-                'ip': '192.168.10.10',
-                'link': "/upload/cell8",
-                'max input': 600,
-            },
-            'Stand 4':{
-                'columns': ('Cycle Number', 'Pressure Test Points', 'Displacement Test Points', 'Temperature Test Points'),
-                'tagnames': ('Cycle_Number_TestPoints', 'Pressure_TestPoints', 'Displacement_TestPoints', 'Temperature_TestPoints'),
-                'common_name': "Stand 4",
-                'ip': '192.168.20.14',
-                'link': "/upload/stand4",
-                'max input': 100,                
-            },
-        }
-
-    def get_context(self, cellname):
-        """
-        Returns the template context
-        :param cellname:
-        :return:
-        """
-        context = {'cellname': cellname}
-        for key in ('columns', 'common_name'):
-            context[key] = self.cells[cellname][key]
-        return context
-
-    def get_ip(self, cellname):
-        """
-        Returns the ip of the cell's PLC
-        :param cellname:
-        :return:
-        """
-        return self.cells[cellname]['ip']
-
-    def cell_list(self):
-        """
-        Returns the context for the index page that lists the cells
-        :return:
-        """
-        cell_list = []
-        for k, v in self.cells.items():
-            cell_list.append({
-                'name': k,
-                'link': v['link'],
-                'common_name': v['common_name']
-            })
-        return {'cells': cell_list}
-
-    def tag_names(self, cellname):
-        return self.cells[cellname]['tagnames']
-
-    def max_input(self, cellname):
-        return self.cells[cellname]['max input']
-
-    def validation(self, cellname):
-        """
-        Return the validation function for cell if present, otherwise return always true function
-        :param cellname: cell to provide validation function for
-        :return: function for validation
-        """
-        celldata = self.cells[cellname]
-        if 'validation' in celldata:
-            return celldata['validation']
-        return lambda *x: True
-
-    def post_upload(self, cellname):
-        """
-        Return the post upload function for cell if present, otherwise returns useless function
-        :param cellname: cell to provide post upload function for
-        :return: function for post upload
-        """
-        celldata = self.cells[cellname]
-        if 'post_upload' in celldata:
-            return celldata['post_upload']
-        return lambda *x: None
-
-
-def upload_points(points, cellname):
-    cd = CellData()
-
-    with PLC() as comm:
-        comm.IPAddress = cd.get_ip(cellname)
-        for c, data in zip(cd.tag_names(cellname), np.array(points).T):
-            comm.Write(c, [0] * CellData().max_input(cellname))
-            comm.Write(c, list(data))
-    cd.post_upload(cellname)(points)
+    # run from upload_points this gets the connection the upload is already holding
+    with plcs.session(upload_config("cell7")['ip']) as comm:
+        check(comm.Write([
+            ('Total_Auto_Samples', end),
+            ('Test_Complete_Hours', complete_hours),
+            ('Test_Complete_Minutes', complete_minutes),
+            ('FAL_Control_hours.LEN', end),
+            ('FAL_Control_minutes.LEN', end),
+        ]))
+
+
+def upload_config(cellname) -> dict:
+    """
+    :param cellname: name or slug of the cell
+    :return: the cell's upload settings from the cell registry, its PLC ip, columns, tagnames, max_input and the
+    optional validation and post_upload functions
+    """
+    cell = get_registry().get(cellname)
+    if cell is None or cell.upload is None:
+        raise KeyError(f"{cellname} isn't a cell that takes uploads")
+    return cell.upload
+
+
+def check(responses):
+    """
+    Raises if any tag in a pylogix batch read or write failed.
+    :param responses: list of pylogix Responses
+    :return: the responses
+    """
+    failed = [f"{response.TagName}: {response.Status}" for response in responses if response.Status != 'Success']
+    if failed:
+        raise IOError("PLC error on " + ", ".join(failed))
+    return responses
+
+
+def upload_points(points, cellname, diff=None):
+    """
+    Writes test points to a cell's PLC. Each column goes out as its data followed by zeros to the end of the array, one
+    write per tag (see write_array). The upload and the post upload hook hold the PLC together, nobody else's upload to
+    the cell can land in between.
+    :param points: list of rows
+    :param cellname: cell to upload to
+    :param diff: only write the parts of the arrays that changed, then read them back to check. Defaults to
+    settings.UPLOAD_DIFF_WRITES
+    """
+    config = upload_config(cellname)
+    max_input = config['max_input']
+    tags = config['tagnames']
+    if diff is None:
+        diff = getattr(settings, 'UPLOAD_DIFF_WRITES', False)
+
+    columns = np.zeros((len(tags), max_input), dtype=int)
+    columns[:, :len(points)] = np.array(points, dtype=int).reshape(len(points), -1).T
+
+    def upload(comm):
+        if diff:
+            current = read_arrays(comm, tags, max_input)
+            for c, now, target in zip(tags, current, columns):
+                for start, stop in changed_ranges(now, target):
+                    write_array(comm, f"{c}[{start}]", target[start:stop].tolist())
+            if not np.array_equal(read_arrays(comm, tags, max_input), columns):
+                raise IOError("PLC arrays don't match the upload after writing them")
+        else:
+            for c, data in zip(tags, columns):
+                write_array(comm, c, data.tolist())
+        if 'post_upload' in config:
+            config['post_upload'](points)
+
+    try:
+        with for_cell(cellname), span('plc_write') as timing:
+            plcs.run(config['ip'], upload)
+            timing.rows = len(points)
+    finally:
+        cache = get_points_cache()
+        if cache is not None:
+            cache.invalidate(cellname)  # even a failed upload may have written some of it
+
+
+def write_array(comm, tag, values):
+    """
+    Writes a list to an array tag on its own, pylogix splits it into as many requests as ConnectionSize needs. Arrays
+    can't go in a batched write, pylogix sends those as one multi-service request whatever the size and the PLC refuses
+    anything over ConnectionSize (508 bytes, 4002 with a large forward open), a hundred or so DINTs is already too many.
+    :param tag: array tag, or Tag[start] to write from start on
+    :param values: list of ints
+    """
+    check([comm.Write(tag, values)])
+
+
+def read_arrays(comm, tags, length) -> np.ndarray:
+    """
+    :return: 2d array of the values of each array tag, one row per tag
+    """
+    return np.array([response.Value for response in check(comm.Read([(c, length) for c in tags]))], dtype=int)
+
+
+def changed_ranges(current, target, gap=DIFF_GAP):
+    """
+    Finds the parts of an array that differ from what should be in it.
+    :param current: array as it is in the PLC
+    :param target: array as it should be
+    :param gap: runs of unchanged elements this short between changes are included to make fewer, longer writes
+    :return: list of (start, stop) slices to write
+    """
+    changed = np.flatnonzero(np.asarray(current) != np.asarray(target))
+    if len(changed) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(changed) > gap + 1)
+    starts = np.concatenate(([changed[0]], changed[breaks + 1]))
+    stops = np.concatenate((changed[breaks], [changed[-1]])) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
 
 
 def parse_points(points, cellname):
-    points = points.replace('""', '0')
-    points = points.replace('"', '')
-
-    if not isinstance(points, str):
-        return None
-    if len(points) == 0:
-        return None
-
-    points_new = []
-    for inner in points[2:-2].split('],['):
-        row = inner.split(',')
-        row = [int(item) for item in row]
-        points_new.append(row)
-
-    if len(points_new) > CellData().max_input(cellname):
-        return None
-
-    if CellData().validation(cellname)(points_new):
-        return points_new
+    """
+    Parses the spreadsheet data posted from the upload page, a JSON list of rows. Cells can be integers or strings of
+    an integer, empty cells are 0. Anything else, a row with the wrong number of columns, more rows than the PLC arrays
+    hold or values that don't fit in a DINT rejects the whole upload, as does the cell's validation.
+    :param points: the JSON text
+    :param cellname: cell being uploaded to
+    :return: 2d int array of the rows, None if it was rejected
+    """
+    config = upload_config(cellname)
+    columns = len(config['tagnames'])
+    with span('parse_points', cellname) as timing:
+        if not isinstance(points, str) or points_grammar(columns).fullmatch(points) is None:
+            return None
+        timing.size = len(points)
+
+        # with the grammar checked the text is just numbers between brackets and quotes, numpy reads them in one go
+        values = np.fromstring(points.replace('""', '0').translate(NUMBERS_ONLY), dtype=np.int64, sep=',')
+        parsed = values.reshape(-1, columns)
+        timing.rows = len(parsed)
+        if len(parsed) > config['max_input'] or not in_range(parsed, *DINT_RANGE):
+            return None
+        if 'validation' not in config or config['validation'](parsed):
+            return parsed
+
+
+@lru_cache(maxsize=None)
+def points_grammar(columns):
+    """
+    :param columns: number of columns every row has to have
+    :return: regex matching the JSON the upload page posts, a non empty list of rows of integers or integer strings
+    """
+    cell = r'(?:"-?[0-9]{1,10}"|""|-?[0-9]{1,10})'
+    row = rf'\[\s*{cell}(?:\s*,\s*{cell}){{{columns - 1}}}\s*\]'
+    return re.compile(rf'\s*\[\s*{row}(?:\s*,\s*{row})*\s*\]\s*')
 
 
 def get_points(cellname: str):
-    cd = CellData()
-    max_input = cd.max_input(cellname)
-
-    with PLC() as comm:
-        comm.IPAddress = cd.get_ip(cellname)
-        col_data = []
-        for c in cd.tag_names(cellname):
-            ret = comm.Read(c, max_input)
-            col_data.append(ret.Value)
+    config = upload_config(cellname)
+    max_input = config['max_input']
+
+    with for_cell(cellname), span('plc_read') as timing:
+        col_data = plcs.run(config['ip'], lambda comm: read_arrays(comm, config['tagnames'], max_input).tolist())
+        timing.rows = max_input
     points = []
 
     end = max_input + 1
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from pylogix import PLC
+
+from FPIWebsite.metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class Controller:
+    """
+    One PLC's connection and the lock that everything talking to it has to hold, plus counters of where the time goes.
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.lock = threading.RLock()
+        self.comm = None
+        self.depth = 0  # sessions open on the thread holding the lock
+        self.last_used = 0.0
+        self.stats = {'connects': 0, 'connect_seconds': 0.0, 'sessions': 0, 'transfer_seconds': 0.0, 'failures': 0}
+
+    def disconnect(self):
+        if self.comm is not None:
+            try:
+                self.comm.Close()
+            except OSError:
+                pass  # the socket is already gone
+            self.comm = None
+
+
+class ConnectionManager:
+    """
+    Process wide set of pylogix connections keyed by PLC IP. The session registration and Forward Open are done once and
+    reused by every upload and read after it instead of once per click. Only one thread at a time gets a controller, so
+    two people uploading to the same cell can't interleave their writes, and the lock is re-entrant so a post upload
+    hook running inside an upload gets the same connection. Connections idle past idle_timeout are closed (the PLC
+    drops them eventually anyway) and a session that fails on a dead connection is run again once on a new one.
+    """
+
+    def __init__(self, idle_timeout=60, timeout=5.0):
+        """
+        :param idle_timeout: seconds an unused connection is kept open
+        :param timeout: socket timeout for the PLC, seconds
+        """
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.controllers = {}  # ip -> Controller
+        self.lock = threading.Lock()
+
+    def controller(self, ip) -> Controller:
+        with self.lock:
+            if ip not in self.controllers:
+                self.controllers[ip] = Controller(ip)
+            return self.controllers[ip]
+
+    @contextmanager
+    def session(self, ip):
+        """
+        Holds a PLC for the duration of the with block, connecting first if there isn't a live connection. If the block
+        raises the connection is dropped so the next session starts clean.
+        :param ip: IP address of the PLC
+        :return: connected pylogix PLC
+        """
+        self.evict()
+        controller = self.controller(ip)
+        with controller.lock:
+            if controller.depth:
+                # nested session on this thread, e.g. the post upload hook, the outer one does the bookkeeping
+                controller.depth += 1
+                try:
+                    yield controller.comm
+                finally:
+                    controller.depth -= 1
+                return
+
+            if controller.comm is not None and (not controller.comm.conn.SocketConnected or
+                                                time.monotonic() - controller.last_used > self.idle_timeout):
+                controller.disconnect()
+            if controller.comm is None:
+                controller.comm = self.connect(controller)
+
+            comm = controller.comm
+            controller.depth = 1
+            started = time.monotonic()
+            try:
+                yield comm
+            except BaseException:
+                controller.stats['failures'] += 1
+                controller.disconnect()
+                raise
+            finally:
+                controller.depth = 0
+                controller.last_used = time.monotonic()
+                controller.stats['sessions'] += 1
+                controller.stats['transfer_seconds'] += controller.last_used - started
+            logger.debug(f"PLC {ip} session took {(controller.last_used - started) * 1000:.1f} ms")
+
+    def connect(self, controller):
+        comm = PLC()
+        comm.IPAddress = controller.ip
+        comm.SocketTimeout = self.timeout
+        with span('plc_connect') as timing:
+            connected, status = comm.conn.connect()
+        elapsed = timing.seconds
+        controller.stats['connects'] += 1
+        controller.stats['connect_seconds'] += elapsed
+        if not connected:
+            controller.stats['failures'] += 1
+            comm.Close()
+            raise IOError(f"Couldn't connect to PLC {controller.ip}: {status}")
+        logger.debug(f"Connected to PLC {controller.ip} in {elapsed * 1000:.1f} ms")
+        return comm
+
+    def run(self, ip, operation):
+        """
+        Runs operation(comm) in a session, running it once more on a new connection if it failed because the
+        connection was dead. Only use it for operations that are safe to repeat, writing whole values is.
+        :param ip: IP address of the PLC
+        :param operation: function taking the connected pylogix PLC
+        :return: what operation returns
+        """
+        for attempt in range(2):
+            fresh = self.controller(ip).comm is None
+            with self.session(ip) as comm:
+                try:
+                    return operation(comm)
+                except IOError:
+                    # pylogix reports a dropped socket as a failed tag, only those are worth another go
+                    if attempt or fresh or comm.conn.SocketConnected:
+                        raise
+                    self.controller(ip).stats['failures'] += 1
+            logger.info(f"PLC {ip} connection was dead, reconnecting")
+
+    def evict(self):
+        """
+        Closes connections that have been idle longer than idle_timeout. Controllers in use are skipped.
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            controllers = list(self.controllers.values())
+        for controller in controllers:
+            if controller.comm is not None and controller.last_used < cutoff and controller.lock.acquire(blocking=False):
+                try:
+                    if controller.comm is not None and not controller.depth and controller.last_used < cutoff:
+                        controller.disconnect()
+                finally:
+                    controller.lock.release()
+
+    def stats(self) -> dict:
+        """
+        :return: dict of ip to counters, connect time is session registration and Forward Open, transfer time is
+        everything done while holding the connection
+        """
+        with self.lock:
+            return {ip: dict(controller.stats, connected=controller.comm is not None)
+                    for ip, controller in self.controllers.items()}
+
+    def close(self):
+        """
+        Closes every connection.
+        """
+        with self.lock:
+            controllers = list(self.controllers.values())
+            self.controllers.clear()
+        for controller in controllers:
+            with controller.lock:
+                controller.disconnect()
+
+
+plcs = ConnectionManager()
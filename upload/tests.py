@@ -1,3 +1,493 @@
-from django.test import TestCase
+import datetime
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase
+from pylogix.lgx_response import Response
+
+from FPIWebsite.cells import CellRegistry, get_registry
+from FPIWebsite.metrics import Metrics
+from .cache import PointsCache
+from .models import cell7validation, changed_ranges, get_points, parse_points, upload_points
+from .plc import ConnectionManager
+
+
+class FakePLC:
+    """
+    Stand-in for pylogix.PLC that keeps tags in a dict and counts the requests that would go over the network. Like
+    pylogix, reading or writing one array takes as many requests as its DINTs need at ConnectionSize bytes apiece, a
+    batched read sends every array that way and the scalars together, and a batched write is one multi-service request
+    that the PLC refuses with "Too much data" if it's bigger than ConnectionSize.
+    :param tags: dict of tag name to value, arrays are lists
+    """
+    # what pylogix leaves for the headers of a request when it splits up a write, see PLC._convert_write_data
+    PACKET_OVERHEAD = 110
+    # per tag in a multi-service request, its offset, service, path and data type headers
+    SERVICE_OVERHEAD = 12
+    DINT = 4
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.requests = 0
+        self.failing = set()
+        self.written = []
+        self.IPAddress = None
+        self.SocketTimeout = None
+        self.ConnectionSize = 508  # pylogix's default, without a large forward open
+        self.conn = self
+        self.SocketConnected = False
+        self.connects = 0
+
+    def __call__(self):
+        return self  # so it can be patched in for the PLC class
+
+    def connect(self):
+        self.connects += 1
+        self.SocketConnected = True
+        return True, 'Success'
+
+    def Close(self):
+        self.SocketConnected = False
+
+    def packets(self, tag, count):
+        """
+        :return: requests it takes to read or write count DINTs of tag on their own
+        """
+        name = tag.split('[')[0]
+        payload = self.ConnectionSize - self.PACKET_OVERHEAD - len(name) - len(name) % 2
+        return max(1, -(-count * self.DINT // payload))
+
+    def response(self, tag, value=None):
+        if tag in self.failing or tag.split('[')[0] not in self.tags:
+            return Response(tag, None, 4)  # "Path segment error"
+        return Response(tag, value, 0)
+
+    def read(self, tag, count=1):
+        if tag not in self.tags or tag in self.failing:
+            return self.response(tag)
+        value = self.tags[tag]
+        return self.response(tag, list(value[:count]) if isinstance(value, list) else value)
+
+    def write(self, tag, value):
+        response = self.response(tag, value)
+        if response.Status == 'Success':
+            self.written.append((tag, value))
+            name, _, start = tag.rstrip(']').partition('[')
+            if isinstance(value, list):
+                start = int(start or 0)
+                self.tags[name][start:start + len(value)] = value
+            else:
+                self.tags[tag] = value
+        return response
+
+    def write_one(self, tag, value):
+        self.requests += self.packets(tag, len(value) if isinstance(value, list) else 1)
+        return self.write(tag, value)
+
+    def Read(self, tag, count=1, datatype=None):
+        if not isinstance(tag, (list, tuple)):
+            self.requests += self.packets(tag, count)
+            return self.read(tag, count)
+        tags = [t if isinstance(t, (list, tuple)) else (t, 1) for t in tag]
+        self.requests += sum(self.packets(t, n) for t, n in tags if n > 1) + any(n == 1 for _, n in tags)
+        return [self.read(t, n) for t, n in tags]
+
+    def Write(self, tag, value=None, datatype=None):
+        if isinstance(tag, (list, tuple)) and len(tag) == 1:
+            return [self.write_one(*tag[0])]  # pylogix writes a single tag on its own
+        if not isinstance(tag, (list, tuple)):
+            return self.write_one(tag, value)
+        self.requests += 1
+        size = self.PACKET_OVERHEAD + sum(self.SERVICE_OVERHEAD + len(t) + len(t) % 2 +
+                                          self.DINT * (len(v) if isinstance(v, list) else 1) for t, v in tag)
+        if size > self.ConnectionSize:
+            return [Response(t, None, 21) for t, _ in tag]  # "Too much data"
+        return [self.write(t, v) for t, v in tag]
+
+
+@contextmanager
+def patch_plc(plc, manager=None):
+    """
+    Patches a FakePLC in for pylogix with its own connection manager, so connections don't carry over between tests.
+    """
+    manager = manager or ConnectionManager()
+    with mock.patch('upload.plc.PLC', plc), mock.patch('upload.models.plcs', manager):
+        yield manager
+    manager.close()
+
+
+def legacy_cell7validation(points):
+    """
+    The original row by row cell 7 validation, what the vectorized one is checked against
+    """
+    prev_time = 0
+    for i, [hour, minute] in enumerate(points):
+        if hour == 0 and minute == 0 and i != 0:
+            for [h, m] in points[i:]:
+                if h != 0 or m != 0:
+                    return False
+            return True
+        if minute < 0 or minute > 59:
+            return False
+        cur_time = hour + (minute / 60)
+        if prev_time >= cur_time:
+            return False
+        prev_time = cur_time
+    return True
+
+
+def random_cell7(rng):
+    """
+    :return: a cell 7 recipe that's usually almost valid, with the odd mistake an operator would make
+    """
+    rows = []
+    hour, minute = 0, 0
+    for _ in range(rng.randint(1, 12)):
+        minute += rng.choice([1, 5, 15, 30, 45])
+        hour, minute = hour + minute // 60, minute % 60
+        rows.append([hour, minute])
+    rows += [[0, 0]] * rng.randint(0, 12 - len(rows))
+    if rng.random() < 0.7:
+        row = rng.randrange(len(rows))
+        rows[row][rng.randrange(2)] = rng.choice([0, -1, 59, 60, 75, rows[row - 1][0], rng.randint(0, 30)])
+    return rows
+
+
+def cell7_plc():
+    return FakePLC({'Time_Hours': [0] * 12, 'Time_Minutes': [0] * 12, 'Total_Auto_Samples': 0,
+                    'Test_Complete_Hours': 0, 'Test_Complete_Minutes': 0, 'FAL_Control_hours.LEN': 0,
+                    'FAL_Control_minutes.LEN': 0})
+
+
+class BatchedPLCTests(SimpleTestCase):
+
+    def test_upload_is_three_round_trips(self):
+        plc = cell7_plc()
+        plc.tags['Time_Hours'] = [9] * 12  # an older, longer recipe that has to be cleared
+        with patch_plc(plc):
+            upload_points([[0, 0], [1, 30], [2, 50]], 'cell7', diff=False)
+        self.assertEqual(plc.requests, 3)  # each array, then the post upload settings together
+        self.assertEqual(plc.tags['Time_Hours'], [0, 1, 2] + [0] * 9)
+        self.assertEqual(plc.tags['Time_Minutes'], [0, 30, 50] + [0] * 9)
+        self.assertEqual((plc.tags['Total_Auto_Samples'], plc.tags['Test_Complete_Hours'],
+                          plc.tags['Test_Complete_Minutes']), (3, 3, 10))
+
+    def test_arrays_bigger_than_a_packet(self):
+        tags = ['MainMotorTestPoints', 'LoadMotorTestPoints', 'PressureTestPoints']
+        plc = FakePLC({tag: [0] * 600 for tag in tags})
+        points = [[n, 2 * n, 3 * n] for n in range(1, 601)]
+        with patch_plc(plc):
+            upload_points(points, 'cell8', diff=False)
+        self.assertEqual(plc.tags['PressureTestPoints'], [3 * n for n in range(1, 601)])
+        self.assertEqual(plc.requests, 21)  # 2400 bytes apiece, 7 packets at the default ConnectionSize
+
+        # which is why they can't be batched
+        responses = plc.Write([(tag, [0] * 600) for tag in tags])
+        self.assertEqual({response.Status for response in responses}, {'Too much data'})
+        self.assertEqual(plc.tags['PressureTestPoints'][-1], 1800)
+
+    def test_read_points(self):
+        plc = cell7_plc()
+        plc.tags['Time_Hours'][:3] = [0, 1, 2]
+        plc.tags['Time_Minutes'][:3] = [0, 30, 50]
+        with patch_plc(plc):
+            self.assertEqual(get_points('cell7'), [[0, 0], [1, 30], [2, 50]])
+        self.assertEqual(plc.requests, 2)  # pylogix reads each array with its own request
+
+    def test_stage_timings(self):
+        plc = cell7_plc()
+        with patch_plc(plc), mock.patch('FPIWebsite.metrics.metrics', Metrics()) as metrics:
+            upload_points([[0, 0], [1, 30], [2, 50]], 'cell7', diff=False)
+            get_points('cell7')
+        text = metrics.render()
+        for stage in ('plc_connect', 'plc_write', 'plc_read'):
+            self.assertIn(f'fpi_stage_seconds_count{{cell="cell7",stage="{stage}"}} 1', text)
+        self.assertIn('fpi_stage_rows_total{cell="cell7",stage="plc_write"} 3', text)
+
+    def test_errors_name_the_tag(self):
+        plc = cell7_plc()
+        plc.failing.add('Time_Minutes')
+        with patch_plc(plc), self.assertRaisesRegex(IOError, 'Time_Minutes'):
+            get_points('cell7')
+        with patch_plc(plc), self.assertRaisesRegex(IOError, 'Time_Minutes: Path segment'):
+            upload_points([[0, 0], [1, 30]], 'cell7', diff=False)
+
+
+class DiffUploadTests(SimpleTestCase):
+
+    def test_changed_ranges(self):
+        self.assertEqual(changed_ranges([1, 2, 3], [1, 2, 3]), [])
+        current = [0] * 40
+        target = [0] * 40
+        target[3] = target[5] = 1  # close together, one write
+        target[20:23] = [1, 1, 1]
+        target[39] = 1
+        self.assertEqual(changed_ranges(current, target, gap=4), [(3, 6), (20, 23), (39, 40)])
+        self.assertEqual(changed_ranges(current, target, gap=100), [(3, 40)])
+
+    def test_only_changes_are_written(self):
+        plc = FakePLC({'MainMotorTestPoints': [0] * 600, 'LoadMotorTestPoints': [0] * 600,
+                       'PressureTestPoints': [0] * 600})
+        points = [[n, 2 * n, 3 * n] for n in range(1, 501)]
+        with patch_plc(plc):
+            upload_points(points, 'cell8', diff=True)
+            self.assertEqual(plc.tags['PressureTestPoints'], [3 * n for n in range(1, 501)] + [0] * 100)
+
+            # the operator edits one row and drops the last ten
+            plc.written.clear()
+            points[100][1] = 7
+            upload_points(points[:490], 'cell8', diff=True)
+        self.assertEqual(plc.written, [('MainMotorTestPoints[490]', [0] * 10), ('LoadMotorTestPoints[100]', [7]),
+                                       ('LoadMotorTestPoints[490]', [0] * 10), ('PressureTestPoints[490]', [0] * 10)])
+        self.assertEqual(plc.tags['LoadMotorTestPoints'][99:102], [200, 7, 204])
+        self.assertEqual(plc.tags['MainMotorTestPoints'][488:], [489, 490] + [0] * 110)
+
+    def test_full_writes_by_default(self):
+        plc = cell7_plc()
+        with patch_plc(plc):
+            upload_points([[0, 0], [1, 30]], 'cell7')
+        self.assertEqual(plc.written[:2], [('Time_Hours', [0, 1] + [0] * 10), ('Time_Minutes', [0, 30] + [0] * 10)])
+
+    def test_verify_catches_a_bad_write(self):
+        plc = cell7_plc()
+        write = plc.write
+        plc.write = lambda tag, value: write(tag, value[:-1] if isinstance(value, list) else value)  # drops data
+        with patch_plc(plc), self.assertRaisesRegex(IOError, "don't match"):
+            upload_points([[0, 0], [1, 30], [2, 50]], 'cell7', diff=True)
+
+
+class ConnectionManagerTests(SimpleTestCase):
+
+    def test_connection_is_reused(self):
+        plc = cell7_plc()
+        with patch_plc(plc) as manager:
+            upload_points([[0, 0], [1, 30], [2, 50]], 'cell7', diff=False)
+            self.assertEqual(get_points('cell7'), [[0, 0], [1, 30], [2, 50]])
+            stats = manager.stats()['192.168.10.17']
+        self.assertEqual(plc.connects, 1)  # the post upload hook and the read went over the same connection
+        self.assertEqual((stats['connects'], stats['sessions'], stats['failures']), (1, 2, 0))
+        self.assertTrue(stats['connected'])
+        self.assertGreaterEqual(stats['transfer_seconds'], 0)
+
+    def test_reconnects_after_dropped_connection(self):
+        plc = cell7_plc()
+        read = plc.read
+        dropped = []
+
+        def drop_once(tag, count=1):
+            if plc.connects == 1 and dropped:
+                plc.SocketConnected = False  # what pylogix does when the socket dies mid request
+                return Response(tag, None, 1)
+            return read(tag, count)
+
+        plc.read = drop_once
+        with patch_plc(plc) as manager:
+            get_points('cell7')  # connects
+            dropped.append(True)  # the PLC restarts while the connection sits idle
+            plc.tags['Time_Hours'][0] = 5
+            self.assertEqual(get_points('cell7'), [[5, 0]])
+            self.assertEqual(manager.stats()['192.168.10.17']['failures'], 1)
+        self.assertEqual(plc.connects, 2)
+
+    def test_tag_errors_are_not_retried(self):
+        plc = cell7_plc()
+        plc.failing.add('Time_Hours')
+        with patch_plc(plc):
+            with self.assertRaises(IOError):
+                get_points('cell7')
+            with self.assertRaises(IOError):
+                get_points('cell7')
+        self.assertEqual(plc.requests, 4)  # each tried once, 2 requests apiece
+
+    def test_idle_connections_are_closed(self):
+        plc = cell7_plc()
+        with patch_plc(plc, ConnectionManager(idle_timeout=0)) as manager:
+            get_points('cell7')
+            time.sleep(0.01)
+            manager.evict()
+            self.assertFalse(manager.stats()['192.168.10.17']['connected'])
+            get_points('cell7')
+        self.assertEqual(plc.connects, 2)
+
+    def test_sessions_on_one_plc_dont_overlap(self):
+        plc = cell7_plc()
+        active = []
+        overlaps = []
+
+        def slow_upload(comm):
+            active.append(1)
+            overlaps.append(len(active))
+            time.sleep(0.02)
+            active.pop()
+
+        with patch_plc(plc) as manager:
+            threads = [threading.Thread(target=manager.run, args=('192.168.10.17', slow_upload)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(overlaps, [1, 1, 1, 1])
+        self.assertEqual(plc.connects, 1)
+
+
+class PointsCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.plc = cell7_plc()
+        self.plc.tags['Time_Hours'][:2] = [0, 1]
+        self.plc.tags['Time_Minutes'][:2] = [0, 30]
+        self.cache = PointsCache(ttl=60)
+        for target in ('upload.views.get_points_cache', 'upload.models.get_points_cache'):
+            patcher = mock.patch(target, lambda: self.cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeat_loads_dont_read_the_plc(self):
+        with patch_plc(self.plc):
+            first = self.client.get('/upload/cell7/readpoints')
+            second = self.client.get('/upload/cell7/readpoints')
+            unchanged = self.client.get('/upload/cell7/readpoints', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(first.json(), {'cell7': [[0, 0], [1, 30]]})
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged['ETag'], first['ETag'])
+        self.assertEqual(self.plc.requests, 2)  # just the first load
+
+    def test_upload_invalidates(self):
+        with patch_plc(self.plc):
+            first = self.client.get('/upload/cell7/readpoints')
+            upload_points([[0, 0], [1, 30], [2, 10]], 'cell7', diff=False)
+            after = self.client.get('/upload/cell7/readpoints', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.json(), {'cell7': [[0, 0], [1, 30], [2, 10]]})
+        self.assertNotEqual(after['ETag'], first['ETag'])
+
+    def test_concurrent_misses_read_once(self):
+        reads = []
+
+        def slow_read(cellname):
+            reads.append(cellname)
+            time.sleep(0.02)
+            return [[1, 2]]
+
+        threads = [threading.Thread(target=self.cache.get, args=('cell7', slow_read)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(reads, ['cell7'])
+
+    def test_read_racing_an_upload_isnt_stored(self):
+        def read_then_upload(cellname):
+            self.cache.invalidate(cellname)  # an upload finishes while the read is on its way back
+            return [[1, 2]]
+
+        self.assertEqual(self.cache.get('cell7', read_then_upload)[0], [[1, 2]])
+        self.assertIsNone(self.cache.fresh('cell7'))
+
+    def test_poller_keeps_viewed_cells_warm(self):
+        self.cache.poll = 0.01
+        with patch_plc(self.plc):
+            self.cache.get('cell7', get_points)
+            self.plc.tags['Time_Minutes'][1] = 45  # changed on the HMI
+            deadline = time.monotonic() + 2
+            while self.cache.fresh('cell7')[0] != [[0, 0], [1, 45]] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            poller = self.cache.poller
+            self.cache.view_timeout = 0  # page closed, the poller stops
+            poller.join(2)
+        self.assertEqual(self.cache.fresh('cell7')[0], [[0, 0], [1, 45]])
+        self.assertIsNone(self.cache.poller)
+
+
+class ParsePointsTests(SimpleTestCase):
+
+    def test_spreadsheet_payload(self):
+        payload = json.dumps([['1', '30'], ['2', '45'], ['', ''], ['', '']])
+        parsed = parse_points(payload, 'cell7')
+        self.assertEqual(parsed.dtype, 'int64')
+        self.assertEqual(parsed.tolist(), [[1, 30], [2, 45], [0, 0], [0, 0]])
+        self.assertEqual(parse_points('[[1, 2, 3], [4, "5", ""]]', 'cell8').tolist(), [[1, 2, 3], [4, 5, 0]])
+
+    def test_rejects(self):
+        for payload in ['', 'nope', '[]', '{}', '[[1, 30]', '[[1, "3.5"]]', '[[1, 2.0]]', '[[1, true]]',
+                        '[[1, " 30"]]', '[[1, "1_0"]]', '[[1, null]]', '[[1, 30, 0]]', '[[1]]', '[1, 30]',
+                        '[[1, "-"]]', '[[1, 99999999999]]', json.dumps([[n, 0] for n in range(1, 14)]),
+                        '[[1, 30], [1, 20]]', '[[1, 60]]', '[[0, 0]]', '[[1, 30], [0, 0], [2, 0]]']:
+            with self.subTest(payload=payload):
+                self.assertIsNone(parse_points(payload, 'cell7'))
+        self.assertIsNone(parse_points(json.dumps([[1, 2, 2 ** 31]]), 'cell8'))
+
+    def test_matches_legacy_validation(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            rows = random_cell7(rng)
+            with self.subTest(rows=rows):
+                self.assertEqual(cell7validation(rows), legacy_cell7validation(rows))
+
+    def test_fuzz_never_raises(self):
+        rng = random.Random(21)
+        alphabet = '[]",-0123456789 .e{}:truefalsenul\\'
+        for _ in range(3000):
+            text = json.dumps([[str(value) for value in row] for row in random_cell7(rng)])
+            for _ in range(rng.randint(1, 4)):
+                at = rng.randrange(len(text))
+                op = rng.randrange(3)
+                if op == 0:
+                    text = text[:at] + text[at + 1:]
+                elif op == 1:
+                    text = text[:at] + rng.choice(alphabet) + text[at:]
+                else:
+                    text = text[:at] + rng.choice(alphabet) + text[at + 1:]
+            with self.subTest(text=text):
+                parsed = parse_points(text, 'cell7')
+                if parsed is not None:
+                    self.assertEqual(parsed.shape[1], 2)
+                    self.assertTrue(legacy_cell7validation(parsed.tolist()))
+
+    def test_bad_upload_shows_error_page(self):
+        plc = cell7_plc()
+        with patch_plc(plc):
+            response = self.client.post('/upload/cell7', {'data': '[[1, "1.5"]]'})
+        self.assertContains(response, 'Invalid data entered (1)')
+        self.assertEqual(plc.requests, 0)
+
+
+class CellRegistryTests(SimpleTestCase):
+
+    def test_lookups(self):
+        registry = get_registry()
+        self.assertIs(registry.get('stand4'), registry.get('Stand 4'))
+        self.assertIsNone(registry.get('stand5'))
+        self.assertEqual([cell.name for cell in registry.uploadable()], ['cell7', 'cell8', 'Stand 4'])
+        self.assertEqual([cell.name for cell in registry.exportable()], ['cell5', 'cell7', 'tribology'])
+        self.assertIs(registry.get('cell7').upload['validation'], cell7validation)
+        self.assertEqual(registry.export_configs['cell7']['slice'], datetime.timedelta(hours=4))
+        self.assertEqual(registry.export_configs['cell7']['measurements'], ('PLC_Tags', 'TE', 'Trident'))
+
+    def test_stand4_page_uses_its_slug(self):
+        plc = FakePLC({'Cycle_Number_TestPoints': [1, 2] + [0] * 98, 'Pressure_TestPoints': [5, 6] + [0] * 98,
+                       'Displacement_TestPoints': [0] * 100, 'Temperature_TestPoints': [0] * 100})
+        index = self.client.get('/upload/')
+        self.assertContains(index, 'href="/upload/stand4"')
+        page = self.client.get('/upload/stand4')
+        self.assertContains(page, "fetch('/upload/stand4/readpoints')")
+        with patch_plc(plc):
+            self.assertEqual(self.client.get('/upload/stand4/readpoints').json(), {'stand4': [[1, 5, 0, 0], [2, 6, 0, 0]]})
+        self.assertEqual(self.client.get('/upload/cell5').status_code, 404)  # export only
+
+    def test_bad_config(self):
+        entry = {'upload': {'ip': '1.2.3.4', 'columns': ['A'], 'tagnames': ['A'], 'max_input': 5}}
+        self.assertEqual(CellRegistry({'Cell 9': entry}).get('cell-9').name, 'Cell 9')
+        for cells in [{'a': {'upload': {'ip': '1.2.3.4'}}},
+                      {'a': {'upload': dict(entry['upload'], tagnames=['A', 'B'])}},
+                      {'a': {'upload': dict(entry['upload'], validation='upload.models:nothing')}},
+                      {'a': {'export': {'database': 'a', 'measurements': ['m'], 'slice': '4 hours'}}},
+                      {'a': entry, 'b': dict(entry, slug='a')}]:
+            with self.subTest(cells=cells), self.assertRaises(ImproperlyConfigured):
+                CellRegistry(cells)
@@ -1,6 +1,10 @@
 from django.shortcuts import render
-from .models import upload_points, CellData, parse_points, get_points
-from django.http import JsonResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from FPIWebsite.cells import get_registry
+from .cache import etag, get_points_cache
+from .models import upload_points, parse_points, get_points
+from django.http import Http404, HttpResponseNotModified, JsonResponse
 import logging
 import datetime
 
@@ -18,9 +22,19 @@ def get_client_ip(request):
     return _ip
 
 
+def get_cell(cellname):
+    """
+    :param cellname: cell name or slug from the url
+    :return: the Cell from the registry, 404 if it doesn't take uploads
+    """
+    cell = get_registry().get(cellname)
+    if cell is None or cell.upload is None:
+        raise Http404(f"Unknown cell {cellname}")
+    return cell
+
+
 def index(request):
-    context = CellData().cell_list()
-    return render(request, 'upload.html', context)
+    return render(request, 'upload.html', {'cells': get_registry().uploadable()})
 
 
 def error(request, cellname, message=None):
@@ -41,6 +55,8 @@ def error(request, cellname, message=None):
 
 
 def cell(request, cellname):
+    cell = get_cell(cellname)
+    cellname = cell.name
     # request will be POST if the user just submitted the form
     if request.method == 'POST':
         try:
@@ -56,10 +72,29 @@ def cell(request, cellname):
                 'ip': ip,
             })
         except IOError as e:
-            print(e)
-            return error(request, cellname, "Invalid data entered (2)")
-    return render(request, 'cellupload.html', CellData().get_context(cellname))
+            return error(request, cellname, ["Invalid data entered (2)", str(e)])
+    return render(request, 'cellupload.html', {
+        'cellname': cell.slug,
+        'columns': cell.upload['columns'],
+        'common_name': cell.common_name,
+    })
 
 
 def readpoints(request, cellname):
-    return JsonResponse({cellname: get_points(cellname)}, safe=False)
+    cell = get_cell(cellname)
+    cellname = cell.name
+    # served from the points cache when it's on, a browser that already has these points gets a 304
+    cache = get_points_cache()
+    if cache is None:
+        points = get_points(cellname)
+        tag = etag(points)
+    else:
+        points, tag = cache.get(cellname, get_points)
+
+    if tag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({cell.slug: points}, safe=False)  # the page knows the cell by its slug
+    response['ETag'] = tag
+    patch_cache_control(response, no_cache=True)  # always check back, the PLC can change any time
+    return response